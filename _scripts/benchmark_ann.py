@@ -0,0 +1,139 @@
+"""Recall@k and latency of the local IVF index against exact search.
+
+On SciFact (corpus and queries embedded with the app's embeddings model, through
+its cache), from a BEIR download such as datasets/scifact:
+
+    python _scripts/benchmark_ann.py --dataset datasets/scifact
+
+Offline, on clustered random vectors of the same dimension:
+
+    python _scripts/benchmark_ann.py --synthetic 200000
+
+For every --nprobe value it reports recall@k of the IVF search (the fraction of
+the exact top k it returns) and p50/p99 search latency, next to exact search.
+"""
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from local_vector_store import LocalVectorStore  # noqa: E402
+
+
+def load_scifact(dataset: Path) -> Tuple[List[str], List[str]]:
+    def texts(name: str, fields: Tuple[str, ...]) -> List[str]:
+        with open(dataset / name, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        return ["\n\n".join(row[k] for k in fields if row.get(k)) for row in rows]
+
+    return texts("corpus.jsonl", ("title", "text")), texts("queries.jsonl", ("text",))
+
+
+def synthetic(rows: int, queries: int, dim: int, clusters: int = 1000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+
+    def sample(n: int) -> np.ndarray:
+        noise = rng.normal(scale=0.7, size=(n, dim)).astype(np.float32)
+        return centers[rng.integers(0, clusters, n)] + noise
+
+    return sample(rows), sample(queries)
+
+
+def percentile(values: List[float], q: int) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def measure(store: LocalVectorStore, queries: np.ndarray, k: int, **search) -> dict:
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        rows, _ = store.search_rows(query, k, **search)
+        latencies.append(time.perf_counter() - start)
+        results.append(set(rows.tolist()))
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=Path, help="BEIR dataset directory")
+    parser.add_argument("--synthetic", type=int, default=0, help="random rows")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--index-dir", help="keep the index here instead of a temp dir")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        vectors, queries = synthetic(args.synthetic, args.queries, args.dim)
+        texts = [str(i) for i in range(len(vectors))]
+    elif args.dataset:
+        from utils import get_embeddings_model
+
+        embeddings = get_embeddings_model()
+        texts, query_texts = load_scifact(args.dataset)
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        queries = np.asarray(
+            [embeddings.embed_query(q) for q in query_texts[: args.queries]], dtype=np.float32
+        )
+    else:
+        parser.error("pass --dataset or --synthetic")
+
+    # Train once, after loading, instead of at every growth step on the way.
+    store = LocalVectorStore(
+        args.index_dir or tempfile.mkdtemp(),
+        embedding=None,
+        ann_min_rows=len(vectors) + 1,
+        nlist=args.nlist,
+    )
+    if not len(store):
+        for start in range(0, len(vectors), 10000):
+            batch = slice(start, start + 10000)
+            store.add_embeddings(
+                list(zip(texts[batch], vectors[batch])),
+                ids=[str(i) for i in range(start, start + len(texts[batch]))],
+            )
+    store.ann_min_rows = 0
+    start = time.perf_counter()
+    store.build_ann_index()
+    build_seconds = time.perf_counter() - start
+
+    exact = measure(store, queries, args.k, exact=True)
+    report = {
+        "rows": len(store),
+        "nlist": len(store._ivf.centroids),
+        "build_seconds": round(build_seconds, 2),
+        "exact": {key: exact[key] for key in ("p50_ms", "p99_ms")},
+        "ivf": [],
+    }
+    for nprobe in args.nprobe:
+        approx = measure(store, queries, args.k, nprobe=nprobe)
+        hits = sum(len(a & e) for a, e in zip(approx["results"], exact["results"]))
+        total = sum(len(e) for e in exact["results"])
+        report["ivf"].append(
+            {
+                "nprobe": nprobe,
+                f"recall@{args.k}": round(hits / total, 4),
+                "p50_ms": approx["p50_ms"],
+                "p99_ms": approx["p99_ms"],
+            }
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
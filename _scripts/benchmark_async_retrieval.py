@@ -0,0 +1,179 @@
+"""Concurrent-request latency of the sync vs. async retrieval paths.
+
+"sync" is the previous path: the langchain Weaviate retriever, whose async calls run
+the v3 client in the default executor. "async" is AsyncWeaviateRetriever: async
+embedding plus the nearVector query over the pooled httpx client.
+
+Against the Weaviate from WEAVIATE_URL/WEAVIATE_API_KEY and the real embeddings:
+
+    python _scripts/benchmark_async_retrieval.py --index-name <index>
+
+Offline, against an in-process stand-in that answers Weaviate's HTTP API after
+--search-latency seconds, with fake embeddings taking --embed-latency seconds:
+
+    python _scripts/benchmark_async_retrieval.py --stand-in --concurrency 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from langchain_core.embeddings import Embeddings  # noqa: E402
+
+
+class LatencyEmbeddings(Embeddings):
+    """Constant vectors after a fixed delay, blocking in sync, awaiting in async."""
+
+    def __init__(self, latency: float, size: int = 1024):
+        self.latency = latency
+        self.size = size
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [[0.1] * self.size for _ in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return [[0.1] * self.size for _ in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+def start_stand_in(index_name: str, k: int, latency: float) -> str:
+    """Serve the few Weaviate endpoints the v3 client and the retrievers call."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status: int, body: dict) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path.startswith("/v1/meta"):
+                self._reply(200, {"version": "1.23.7", "modules": {}})
+            elif self.path.startswith("/v1/.well-known/ready"):
+                self._reply(200, {})
+            else:
+                self._reply(404, {})
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency)
+            hits = [
+                {"text": f"chunk {i}", "source": f"https://example.com/{i}", "title": ""}
+                for i in range(k)
+            ]
+            self._reply(200, {"data": {"Get": {index_name: hits}}})
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        request_queue_size = 1024
+
+    server = Server(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def percentile(values: List[float], q: float) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[int(q) - 1]
+
+
+async def run(retriever, requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await retriever.ainvoke(f"question {i}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "requests_per_second": round(requests / elapsed, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index-name", default="Benchmark_Index")
+    parser.add_argument("--stand-in", action="store_true")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.03)
+    args = parser.parse_args()
+
+    if args.stand_in:
+        os.environ["WEAVIATE_URL"] = start_stand_in(
+            args.index_name, args.k, args.search_latency
+        )
+        os.environ["WEAVIATE_API_KEY"] = "stand-in"
+
+    import weaviate
+    from langchain_community.vectorstores import Weaviate
+    from vector_store_manage import AsyncWeaviateRetriever
+
+    if args.stand_in:
+        embeddings = LatencyEmbeddings(args.embed_latency)
+    else:
+        from utils import get_embeddings_model
+
+        embeddings = get_embeddings_model()
+
+    client = weaviate.Client(
+        url=os.environ["WEAVIATE_URL"],
+        auth_client_secret=weaviate.AuthApiKey(api_key=os.environ["WEAVIATE_API_KEY"]),
+    )
+    vectorstore = Weaviate(
+        client=client,
+        index_name=args.index_name,
+        text_key="text",
+        embedding=embeddings,
+        by_text=False,
+        attributes=["source", "title"],
+    )
+    retrievers = {
+        "sync": vectorstore.as_retriever(search_kwargs=dict(k=args.k)),
+        "async": AsyncWeaviateRetriever(
+            vectorstore=vectorstore,
+            url=os.environ["WEAVIATE_URL"],
+            api_key=os.environ["WEAVIATE_API_KEY"],
+            k=args.k,
+        ),
+    }
+    results = {
+        name: asyncio.run(run(retriever, args.requests, args.concurrency))
+        for name, retriever in retrievers.items()
+    }
+    print(json.dumps({"config": vars(args), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
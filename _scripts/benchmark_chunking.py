@@ -0,0 +1,121 @@
+"""Chunks, chunk sizes in tokens and speed of the old and new text splitters.
+
+Splits a corpus with ``RecursiveCharacterTextSplitter(4000, 200)`` (what ingest
+used before) and with ``markdown_splitter.MarkdownTokenSplitter`` (what it uses
+now), through the same ``ingest_pipeline.transform_documents``. For each it
+reports the chunk count, tokens per chunk (cl100k_base, as in
+``utils.token_length``), chunks over --chunk-tokens, chunks that cut a fenced
+code block open, and throughput.
+
+The corpus is a directory of saved .html doc pages (see
+benchmark_html_extract.py), extracted to Markdown with ``html_extract``, plus
+any --text files (such as the 王氏之死 book); without either, --synthetic doc
+pages are generated:
+
+    python _scripts/benchmark_chunking.py --corpus pages/ --text 王氏之死.txt
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter  # noqa: E402
+from langchain_core.documents import Document  # noqa: E402
+
+from benchmark_html_extract import load_corpus, synthetic_page  # noqa: E402
+from benchmark_rag import git_commit  # noqa: E402
+from html_extract import extract_pages  # noqa: E402
+from ingest_pipeline import transform_documents  # noqa: E402
+from markdown_splitter import MarkdownTokenSplitter  # noqa: E402
+from utils import token_length  # noqa: E402
+
+
+def percentile(values: List[int], q: float) -> int:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+def measure(docs: List[Document], splitter, budget: int) -> dict:
+    # Keep collections of the already loaded objects out of the timing.
+    gc.collect()
+    gc.freeze()
+    start = time.perf_counter()
+    copies = (Document(page_content=d.page_content, metadata=dict(d.metadata)) for d in docs)
+    chunks = list(transform_documents(copies, splitter))
+    seconds = time.perf_counter() - start
+    tokens = [token_length(chunk.page_content) for chunk in chunks]
+    megabytes = sum(len(d.page_content.encode()) for d in docs) / 1e6
+    return {
+        "chunks": len(chunks),
+        "seconds": round(seconds, 3),
+        "chunks_per_second": round(len(chunks) / seconds, 1) if seconds else None,
+        "megabytes_per_second": round(megabytes / seconds, 2) if seconds else None,
+        "tokens_total": sum(tokens),
+        "tokens_mean": round(sum(tokens) / len(tokens), 1) if tokens else 0,
+        "tokens_p95": percentile(tokens, 0.95),
+        "tokens_max": max(tokens, default=0),
+        "over_budget": sum(1 for t in tokens if t > budget),
+        "broken_code_fences": sum(1 for c in chunks if c.page_content.count("```") % 2),
+        "with_headings": sum(1 for c in chunks if c.metadata.get("headings")),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", type=Path, help="directory of saved .html pages")
+    parser.add_argument("--text", type=Path, nargs="*", default=[], help="plain text or Markdown files")
+    parser.add_argument("--synthetic", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-tokens", type=int, default=512)
+    parser.add_argument("--overlap-tokens", type=int, default=32)
+    parser.add_argument("--output", help="write the JSON results here as well")
+    args = parser.parse_args()
+
+    if args.corpus:
+        pages = load_corpus(args.corpus)
+    elif not args.text:
+        rng = random.Random(args.seed)
+        pages = [(f"synthetic/{i}", synthetic_page(rng, i)) for i in range(args.synthetic)]
+    else:
+        pages = []
+    docs = [
+        Document(page_content=text, metadata={"source": url, "title": metadata["title"]})
+        for url, text, metadata in extract_pages((url, html, None) for url, html in pages)
+    ]
+    docs += [
+        Document(page_content=path.read_text(encoding="utf-8"), metadata={"source": str(path)})
+        for path in args.text
+    ]
+    if not docs:
+        parser.error("nothing to split")
+
+    old = RecursiveCharacterTextSplitter(chunk_size=4000, chunk_overlap=200)
+    new = MarkdownTokenSplitter(chunk_size=args.chunk_tokens, chunk_overlap=args.overlap_tokens)
+    report = {
+        "commit": git_commit(),
+        "config": {
+            **vars(args),
+            "corpus": str(args.corpus) if args.corpus else None,
+            "text": [str(path) for path in args.text],
+        },
+        "documents": len(docs),
+        "megabytes": round(sum(len(d.page_content.encode()) for d in docs) / 1e6, 2),
+        "results": {
+            "recursive_4000_chars": measure(docs, old, args.chunk_tokens),
+            f"markdown_{args.chunk_tokens}_tokens": measure(docs, new, args.chunk_tokens),
+        },
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
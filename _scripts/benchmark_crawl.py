@@ -0,0 +1,233 @@
+"""Wall time and egress of a full crawl against a nightly (incremental) one.
+
+Serves --pages synthetic doc pages, a sitemap with ``lastmod`` and an index page
+linking every page from a local HTTP stand-in. The stand-in answers
+``If-None-Match``/``If-Modified-Since`` with 304 and adds --latency seconds to
+every response. It then runs the app's crawl layer (``crawler.Crawler``) and the
+docs extraction (``html_extract.extract_documents``), as
+``ingest.load_langchain_docs`` does:
+
+1. ``cold``: empty response store, everything is downloaded and extracted;
+2. ``nightly_sitemap``: --change-share of the pages changed (with a new
+   lastmod), unchanged pages are skipped on their lastmod;
+3. ``nightly_recursive``: another --change-share changed, crawled from the index
+   page without a sitemap, so every page is revalidated with a conditional GET.
+
+Only changed pages are extracted in the nightly runs (``changed_only``), while
+the crawl is still running. The crawler's report gives throughput and latency
+per host.
+
+    python _scripts/benchmark_crawl.py --pages 500 --change-share 0.05 --latency 0.05
+"""
+import argparse
+import email.utils
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from benchmark_html_extract import synthetic_page  # noqa: E402
+from benchmark_rag import git_commit  # noqa: E402
+from crawler import CrawlClient, Crawler, ResponseStore  # noqa: E402
+from html_extract import ExtractionCache, extract_documents  # noqa: E402
+
+
+class Site:
+    """Pages of the stand-in, by path: (body, ETag, Last-Modified)."""
+
+    def __init__(self):
+        self.pages: Dict[str, Tuple[bytes, str, str]] = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+
+    def put(self, path: str, body: str, modified: float) -> None:
+        data = body.encode("utf-8")
+        etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+        self.pages[path] = (data, etag, email.utils.formatdate(modified, usegmt=True))
+
+    def counters(self) -> dict:
+        return {
+            "requests": self.requests,
+            "not_modified": self.not_modified,
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, site: Site, latency: float, **kwargs):
+        self.site = site
+        self.latency = latency
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        page = self.site.pages.get(self.path)
+        with self.site.lock:
+            self.site.requests += 1
+        if page is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body, etag, last_modified = page
+        if self.headers.get("If-None-Match") == etag or (
+            "If-None-Match" not in self.headers
+            and self.headers.get("If-Modified-Since") == last_modified
+        ):
+            with self.site.lock:
+                self.site.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        content_type = "application/xml" if self.path.endswith(".xml") else "text/html"
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.site.lock:
+            self.site.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def publish(site: Site, base: str, bodies: Dict[str, str], lastmods: Dict[str, str]) -> None:
+    now = time.time()
+    for path, body in bodies.items():
+        if path not in site.pages or site.pages[path][0] != body.encode("utf-8"):
+            site.put(path, body, now)
+    urls = "".join(
+        f"<url><loc>{base}{path}</loc><lastmod>{lastmods[path]}</lastmod></url>"
+        for path in bodies
+    )
+    site.put(
+        "/sitemap.xml",
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>',
+        now,
+    )
+    links = "".join(f'<li><a href="{path}">{path}</a></li>' for path in bodies)
+    site.put("/docs/", f"<html><body><ul>{links}</ul></body></html>", now)
+
+
+def change(rng: random.Random, bodies, lastmods, share: float, round_: int) -> int:
+    changed = rng.sample(sorted(bodies), max(1, int(len(bodies) * share)))
+    for path in changed:
+        bodies[path] = bodies[path].replace("</article>", f"<p>Revision {round_}.</p></article>")
+        lastmods[path] = f"2024-02-{round_ + 1:02d}"
+    return len(changed)
+
+
+def run(site, crawl, extraction_cache, workers) -> dict:
+    before = site.counters()
+    start = time.perf_counter()
+    crawler, pages = crawl()
+    seen = []
+    docs = list(
+        extract_documents(
+            (page for page in pages if seen.append(page) or page.changed),
+            extraction_cache,
+            workers,
+        )
+    )
+    # Stands in for a successful ingest of the extracted documents.
+    crawler.acknowledge()
+    seconds = time.perf_counter() - start
+    after = site.counters()
+    return {
+        "seconds": round(seconds, 3),
+        "pages": len(seen),
+        "documents_to_ingest": len(docs),
+        "crawler": crawler.stats.to_dict(),
+        "server": {key: after[key] - before[key] for key in after},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--change-share", type=float, default=0.05)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per response")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--per-host-concurrency", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results here as well")
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    site = Site()
+    handler = functools.partial(Handler, site=site, latency=args.latency)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{args.port}"
+
+    rng = random.Random(args.seed)
+    bodies = {f"/docs/page-{i}": synthetic_page(rng, i) for i in range(args.pages)}
+    lastmods = {path: "2024-01-01" for path in bodies}
+    publish(site, base, bodies, lastmods)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        store = ResponseStore(os.path.join(workdir, "crawl.sqlite"))
+        extraction_cache = ExtractionCache(os.path.join(workdir, "extract.sqlite"))
+        client = CrawlClient(per_host_concurrency=args.per_host_concurrency)
+
+        def sitemap_crawl():
+            crawler = Crawler(store, client, concurrency=args.concurrency)
+            return crawler, crawler.sitemap(f"{base}/sitemap.xml")
+
+        def recursive_crawl():
+            crawler = Crawler(store, client, concurrency=args.concurrency)
+            return crawler, crawler.recursive(f"{base}/docs/", max_depth=2, use_sitemaps=False)
+
+        results["cold"] = run(site, sitemap_crawl, extraction_cache, args.workers)
+        changed = change(rng, bodies, lastmods, args.change_share, 1)
+        publish(site, base, bodies, lastmods)
+        results["nightly_sitemap"] = run(site, sitemap_crawl, extraction_cache, args.workers)
+        results["nightly_sitemap"]["pages_changed"] = changed
+        changed = change(rng, bodies, lastmods, args.change_share, 2)
+        publish(site, base, bodies, lastmods)
+        results["nightly_recursive"] = run(site, recursive_crawl, extraction_cache, args.workers)
+        results["nightly_recursive"]["pages_changed"] = changed
+        client.close()
+    server.shutdown()
+    server.server_close()
+
+    cold = results["cold"]
+    for name in ("nightly_sitemap", "nightly_recursive"):
+        nightly = results[name]
+        nightly["speedup"] = round(cold["seconds"] / nightly["seconds"], 1)
+        nightly["egress_reduction"] = round(
+            cold["server"]["bytes_sent"] / max(nightly["server"]["bytes_sent"], 1), 1
+        )
+    output = json.dumps(
+        {"commit": git_commit(), "config": vars(args), "results": results}, indent=2
+    )
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Chunks, tokens and time saved by near-duplicate removal at ingest.
+
+Builds --pages synthetic doc pages that, like the LangChain docs, share
+snippets: each page takes --shared-share of its sections from a pool of
+--snippets common sections (install blocks, setup paragraphs), a few words
+changed per copy. The pages are chunked as ingest does
+(``markdown_splitter.get_text_splitter``) and run through
+``near_dedup.NearDuplicateFilter`` twice:
+
+1. ``full``: a full ingest, chunks deduplicated against each other;
+2. ``incremental``: --change-share of the pages re-ingested against the stored
+   signatures of the first run.
+
+Tokens kept against tokens before are what embedding cost and index size
+shrink by.
+
+    python _scripts/benchmark_dedup.py --pages 500 --threshold 0.85
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from langchain_core.documents import Document  # noqa: E402
+
+from benchmark_html_extract import WORDS, synthetic_page  # noqa: E402
+from benchmark_rag import git_commit  # noqa: E402
+from html_extract import extract_pages  # noqa: E402
+from ingest_pipeline import transform_documents  # noqa: E402
+from markdown_splitter import get_text_splitter  # noqa: E402
+from near_dedup import NearDuplicateFilter, SignatureStore  # noqa: E402
+from utils import token_length  # noqa: E402
+
+
+def shared_pages(rng: random.Random, pages: int, snippets: int, share: float) -> List[Document]:
+    pool = [
+        f"## {' '.join(rng.sample(WORDS, 3))}\n\n"
+        + "\n\n".join(" ".join(rng.choice(WORDS) for _ in range(60)) for _ in range(3))
+        for _ in range(snippets)
+    ]
+    docs = []
+    for url, text, metadata in extract_pages(
+        (f"https://docs.example.com/page-{i}", synthetic_page(rng, i), None) for i in range(pages)
+    ):
+        sections = text.split("\n\n## ")
+        for i in range(1, len(sections)):
+            if rng.random() < share:
+                words = rng.choice(pool)[3:].split(" ")
+                words[rng.randrange(5, len(words))] = rng.choice(WORDS)
+                sections[i] = " ".join(words)
+        docs.append(
+            Document(
+                page_content="\n\n## ".join(sections),
+                metadata={"source": url, "title": metadata["title"]},
+            )
+        )
+    return docs
+
+
+def run(docs: List[Document], dedup: NearDuplicateFilter) -> dict:
+    splitter = get_text_splitter()
+    chunks = list(transform_documents(docs, splitter))
+    start = time.perf_counter()
+    kept = list(dedup.filter(chunks))
+    seconds = time.perf_counter() - start
+    tokens_before = sum(token_length(chunk.page_content) for chunk in chunks)
+    tokens_after = sum(token_length(chunk.page_content) for chunk in kept)
+    return {
+        "chunks_before": len(chunks),
+        "chunks_after": len(kept),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "token_reduction": round(1 - tokens_after / tokens_before, 3) if tokens_before else 0.0,
+        "dedup_seconds": round(seconds, 3),
+        "chunks_per_second": round(len(chunks) / seconds, 1) if seconds else None,
+        "stats": dict(dedup.stats),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--snippets", type=int, default=20)
+    parser.add_argument("--shared-share", type=float, default=0.3)
+    parser.add_argument("--change-share", type=float, default=0.1)
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results here as well")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    docs = shared_pages(rng, args.pages, args.snippets, args.shared_share)
+    changed = rng.sample(docs, max(1, int(len(docs) * args.change_share)))
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        store = SignatureStore(os.path.join(workdir, "signatures.sqlite"))
+        full = NearDuplicateFilter("bench", store, threshold=args.threshold)
+        full.reset()
+        results["full"] = run(docs, full)
+        # Every stored chunk counts as indexed.
+        incremental = NearDuplicateFilter(
+            "bench", store, exists=lambda uids: [True] * len(uids), threshold=args.threshold
+        )
+        results["incremental"] = run(changed, incremental)
+
+    output = json.dumps({"commit": git_commit(), "config": vars(args), "results": results}, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""Pages per second of the docs extraction, old (BeautifulSoup) against new (lxml).
+
+Runs both extractors over a saved corpus of documentation pages and checks that
+``html_extract`` gives byte-identical text and metadata to
+``parser.langchain_docs_extractor`` and ``ingest.metadata_extractor`` on every
+page. The new engine is timed in this process, in a pool of --workers
+processes, and again against a warm extraction cache.
+
+Save a corpus once (any directory of .html files works too), then benchmark it:
+
+    python _scripts/benchmark_html_extract.py --corpus pages/ \
+        --download https://python.langchain.com/sitemap.xml --limit 300
+    python _scripts/benchmark_html_extract.py --corpus pages/ --output extract.json
+
+Without --corpus, --synthetic pages shaped like the Docusaurus docs (navigation,
+sidebars, prism code blocks, tabs, tables) are generated instead.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from bs4 import BeautifulSoup, SoupStrainer  # noqa: E402
+
+from benchmark_rag import git_commit  # noqa: E402
+from html_extract import ExtractionCache, extract_pages  # noqa: E402
+from ingest import metadata_extractor  # noqa: E402
+from parser import langchain_docs_extractor  # noqa: E402
+
+# As in ingest.load_langchain_docs.
+STRAINER = SoupStrainer(name=("article", "title", "html", "lang", "content"))
+WORDS = (
+    "chain retriever vector store embeddings prompt model agent tool memory "
+    "document loader splitter callback runnable stream batch async index query"
+).split()
+
+
+def bs4_extract(markup: str) -> Tuple[str, Dict[str, str]]:
+    soup = BeautifulSoup(markup, "lxml", parse_only=STRAINER)
+    text = langchain_docs_extractor(soup)
+    metadata = metadata_extractor({"loc": ""}, soup)
+    return text, {key: metadata[key] for key in ("title", "description", "language")}
+
+
+def download(corpus: Path, sitemap: str, limit: int) -> None:
+    from langchain_community.document_loaders import SitemapLoader
+
+    loader = SitemapLoader(sitemap, continue_on_failure=True)
+    els = loader.parse_sitemap(loader._scrape(sitemap, parser="xml"))
+    urls = [el["loc"].strip() for el in els if "loc" in el][:limit]
+    corpus.mkdir(parents=True, exist_ok=True)
+    index = {}
+    for url, html in zip(urls, asyncio.run(loader.fetch_all(urls))):
+        if html:
+            name = hashlib.sha256(url.encode()).hexdigest()[:16] + ".html"
+            (corpus / name).write_text(html, encoding="utf-8")
+            index[name] = url
+    (corpus / "urls.json").write_text(json.dumps(index, indent=2), encoding="utf-8")
+
+
+def load_corpus(corpus: Path) -> List[Tuple[str, str]]:
+    index_path = corpus / "urls.json"
+    index = json.loads(index_path.read_text(encoding="utf-8")) if index_path.exists() else {}
+    pages = []
+    for path in sorted(corpus.rglob("*.html")):
+        name = str(path.relative_to(corpus))
+        pages.append((index.get(name, name), path.read_text(encoding="utf-8")))
+    return pages
+
+
+def synthetic_page(rng: random.Random, i: int) -> str:
+    def words(n: int) -> str:
+        return " ".join(rng.choice(WORDS) for _ in range(n))
+
+    def code_block() -> str:
+        lines = "".join(
+            '<span class="token-line">'
+            + "".join(
+                f'<span class="token {rng.choice(["keyword", "plain", "string"])}">'
+                f"{rng.choice(WORDS)}</span> "
+                for _ in range(rng.randint(2, 8))
+            )
+            + "\n</span>"
+            for _ in range(rng.randint(3, 15))
+        )
+        return (
+            f'<div class="codeBlockContainer"><pre class="prism-code language-python">'
+            f'<code class="codeBlockLines">{lines}</code></pre>'
+            f'<button type="button" aria-label="Copy code">Copy</button></div>'
+        )
+
+    def section() -> str:
+        parts = [f"<h2>{words(3)}</h2>"]
+        for _ in range(rng.randint(2, 5)):
+            kind = rng.random()
+            if kind < 0.4:
+                parts.append(
+                    f"<p>{words(20)} <a href=\"/docs/{rng.choice(WORDS)}\">{words(2)}</a> "
+                    f"<code>{rng.choice(WORDS)}()</code> <strong>{words(2)}</strong> {words(15)}</p>"
+                )
+            elif kind < 0.6:
+                parts.append(code_block())
+            elif kind < 0.75:
+                items = "".join(f"<li><p>{words(8)}</p></li>" for _ in range(rng.randint(2, 6)))
+                parts.append(f"<ul>{items}</ul>")
+            elif kind < 0.9:
+                tabs = rng.sample(["pip", "conda", "poetry"], 2)
+                parts.append(
+                    '<div class="tabs-container"><ul role="tablist">'
+                    + "".join(f'<li role="tab">{tab}</li>' for tab in tabs)
+                    + "</ul>"
+                    + "".join(f'<div role="tabpanel">{code_block()}</div>' for _ in tabs)
+                    + "</div>"
+                )
+            else:
+                rows = "".join(
+                    f"<tr><td>{rng.choice(WORDS)}</td><td>{words(4)}</td></tr>"
+                    for _ in range(rng.randint(2, 8))
+                )
+                parts.append(
+                    f"<table><thead><tr><th>Name</th><th>Description</th></tr></thead>"
+                    f"<tbody>{rows}</tbody></table>"
+                )
+        return "\n".join(parts)
+
+    sidebar = "".join(f'<li><a href="/docs/{w}">{w}</a></li>' for w in rng.sample(WORDS, 10))
+    return (
+        f'<!DOCTYPE html>\n<html lang="en"><head><meta charset="UTF-8">'
+        f"<title>{words(3)} | LangChain</title>"
+        f'<meta name="description" content="{words(12)}">'
+        f"<script>window.dataLayer = [];</script><style>.x {{ color: red }}</style></head>"
+        f'<body><nav class="navbar"><a href="/">LangChain</a>{words(5)}</nav>'
+        f'<div class="main-wrapper"><aside class="sidebar"><ul>{sidebar}</ul></aside>'
+        f"<main><article><h1>{words(4)} {i}</h1>"
+        + "".join(section() for _ in range(rng.randint(2, 6)))
+        + f"</article></main></div><footer>{words(10)}</footer></body></html>"
+    )
+
+
+def timed(fn) -> Tuple[object, float]:
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def rate(pages: int, seconds: float) -> dict:
+    return {"seconds": round(seconds, 3), "pages_per_second": round(pages / seconds, 1)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", type=Path, help="directory of saved .html pages")
+    parser.add_argument("--download", metavar="SITEMAP", help="save the sitemap's pages to --corpus first")
+    parser.add_argument("--limit", type=int, default=300)
+    parser.add_argument("--synthetic", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output", help="write the JSON results here as well")
+    args = parser.parse_args()
+
+    if args.download:
+        if not args.corpus:
+            parser.error("--download needs --corpus")
+        download(args.corpus, args.download, args.limit)
+    if args.corpus:
+        pages = load_corpus(args.corpus)
+    else:
+        rng = random.Random(args.seed)
+        pages = [(f"synthetic/{i}", synthetic_page(rng, i)) for i in range(args.synthetic)]
+    if not pages:
+        parser.error("no pages to extract")
+    items = [(url, html, None) for url, html in pages]
+
+    expected, old_seconds = timed(lambda: [bs4_extract(html) for _, html in pages])
+    serial, serial_seconds = timed(lambda: list(extract_pages(items, max_workers=1)))
+    pooled, pooled_seconds = timed(lambda: list(extract_pages(items, max_workers=args.workers)))
+    with tempfile.TemporaryDirectory() as workdir:
+        cache = ExtractionCache(os.path.join(workdir, "extract.sqlite"))
+        _, cold_seconds = timed(lambda: list(extract_pages(items, cache, args.workers)))
+        cached, warm_seconds = timed(lambda: list(extract_pages(items, cache, args.workers)))
+
+    mismatches = [
+        url
+        for (url, _), want, *got in zip(pages, expected, serial, pooled, cached)
+        if any((text, metadata) != want for _, text, metadata in got)
+    ]
+    report = {
+        "commit": git_commit(),
+        "config": {**vars(args), "corpus": str(args.corpus) if args.corpus else None},
+        "pages": len(pages),
+        "megabytes": round(sum(len(html.encode()) for _, html in pages) / 1e6, 2),
+        "byte_identical": not mismatches,
+        "mismatched_pages": mismatches[:20],
+        "results": {
+            "beautifulsoup": rate(len(pages), old_seconds),
+            "lxml_serial": rate(len(pages), serial_seconds),
+            f"lxml_{args.workers}_workers": rate(len(pages), pooled_seconds),
+            "lxml_cache_cold": rate(len(pages), cold_seconds),
+            "lxml_cache_warm": rate(len(pages), warm_seconds),
+        },
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
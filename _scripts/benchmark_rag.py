@@ -0,0 +1,367 @@
+"""Offline throughput and latency of ingest and chat, for comparing commits.
+
+Everything runs in process, with no network: deterministic hashed embeddings, a
+stand-in chat model that streams after --llm-ttft seconds, and the local vector
+store and keyword index in a temporary directory. The code under test is the
+app's own: the ingest pipeline (split, dedup, embed, write) and
+``chain.create_chain`` with its retriever, reranker, condenser and answer cache.
+
+    python _scripts/benchmark_rag.py --output bench.json
+    python _scripts/benchmark_rag.py --concurrency 1 16 64 --llm-ttft 0.5
+
+Ingest runs --ingest-jobs jobs of --docs-per-job synthetic documents, each into
+its own index, on 1, 2, ... worker threads (--ingest-concurrency). Chat sends
+--requests distinct questions at each --concurrency level. Both report
+throughput and p50/p95/p99 latency, chat also time to first token, and each
+level the process RSS after it and the peak RSS so far.
+
+Token counting still uses tiktoken: without network, its cl100k_base file must
+already be in the tiktoken cache (TIKTOKEN_CACHE_DIR).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from langchain_core.documents import Document  # noqa: E402
+from langchain_core.embeddings import Embeddings  # noqa: E402
+from langchain_core.language_models.chat_models import (  # noqa: E402
+    BaseChatModel,
+    generate_from_stream,
+)
+from langchain_core.messages import AIMessageChunk, BaseMessage  # noqa: E402
+from langchain_core.outputs import ChatGenerationChunk, ChatResult  # noqa: E402
+
+_WORDS = [
+    "index", "vector", "chunk", "query", "retriever", "embedding", "latency", "cache",
+    "stream", "token", "prompt", "model", "answer", "source", "document", "search",
+    "keyword", "rerank", "budget", "history", "router", "provider", "ingest", "batch",
+    "split", "overlap", "record", "manager", "weaviate", "local", "segment", "merge",
+]
+
+
+class HashEmbeddings(Embeddings):
+    """Unit vectors of hashed word counts: equal texts get equal vectors."""
+
+    def __init__(self, size: int = 256, latency: float = 0.0):
+        self.size = size
+        self.latency = latency
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in text.lower().split():
+            digest = hashlib.blake2b(word.encode(), digest_size=4).digest()
+            vector[int.from_bytes(digest, "little") % self.size] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+class StandInChatModel(BaseChatModel):
+    """Streams ``answer_tokens`` words after ``ttft`` seconds, one per ``token_latency``."""
+
+    ttft: float = 0.2
+    token_latency: float = 0.01
+    answer_tokens: int = 40
+
+    @property
+    def _llm_type(self) -> str:
+        return "stand-in"
+
+    def _words(self, messages: List[BaseMessage]) -> List[str]:
+        seed = hashlib.blake2b(messages[-1].content.encode(), digest_size=4).digest()
+        rng = random.Random(seed)
+        return [rng.choice(_WORDS) + " " for _ in range(self.answer_tokens)]
+
+    def _stream(
+        self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.ttft)
+        for i, word in enumerate(self._words(messages)):
+            if i:
+                time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+    async def _astream(
+        self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.ttft)
+        for i, word in enumerate(self._words(messages)):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+    def _generate(
+        self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any
+    ) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, **kwargs))
+
+
+def use_stand_ins(workdir: str, embed_size: int = 256, embed_latency: float = 0.0) -> None:
+    """Point the app at local stores in ``workdir`` and at ``HashEmbeddings``.
+
+    Call before importing ``chain``, which builds its stores and caches on import.
+    """
+    os.environ.update(
+        VECTOR_STORE_BACKEND="local",
+        LOCAL_VECTOR_STORE_DIR=os.path.join(workdir, "vector_store"),
+        KEYWORD_INDEX_DIR=os.path.join(workdir, "keyword_index"),
+        EMBEDDING_CACHE_PATH="",
+        LLM_CACHE_PATH="",
+        LANGCHAIN_TRACING_V2="false",
+    )
+    for key in ("ZHIPUAI_API_KEY", "OPENAI_API_KEY", "DEEPSEEK_API_KEY"):
+        os.environ.setdefault(key, "stand-in")
+
+    import utils
+    from embedding_cache import CachedEmbeddings
+
+    utils._embeddings_model = CachedEmbeddings(HashEmbeddings(embed_size, embed_latency))
+
+
+def stand_in_llm(ttft: float, token_latency: float, answer_tokens: int) -> BaseChatModel:
+    """A ``StandInChatModel`` behind the latency router, like the real providers."""
+    from llm_router import LatencyRouter, RouterStats
+
+    model = StandInChatModel(ttft=ttft, token_latency=token_latency, answer_tokens=answer_tokens)
+    return LatencyRouter(providers={"stand_in": model}, stats=RouterStats())
+
+
+def synthetic_docs(count: int, words: int, seed: int, prefix: str) -> List[Document]:
+    rng = random.Random(seed)
+    vocabulary = _WORDS + [f"term{i}" for i in range(5000)]
+    docs = []
+    for i in range(count):
+        text = " ".join(rng.choice(vocabulary) for _ in range(words))
+        source = f"https://bench.example.com/{prefix}/{i}"
+        docs.append(Document(page_content=text, metadata={"source": source, "title": f"Doc {i}"}))
+    return docs
+
+
+def percentile(values: List[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def latency_summary(values: List[float], prefix: str) -> dict:
+    return {
+        f"{prefix}_p{q}_ms": round(percentile(values, q) * 1000, 2) for q in (50, 95, 99)
+    }
+
+
+def memory() -> dict:
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    memory = {"peak_rss_mb": round(peak_kb / 1024, 1)}
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        memory["rss_mb"] = round(pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except OSError:
+        pass
+    return memory
+
+
+def ingest(docs: List[Document], index_name: str, workdir: str) -> dict:
+    """The batch path of ingest.py: prefetched transform, then index_documents."""
+    from langchain.indexes import SQLRecordManager
+
+    from chain import vector_store_manager
+    from indexing import index_documents
+    from ingest_pipeline import prefetch, transform_documents
+    from markdown_splitter import get_text_splitter
+    from near_dedup import DEDUP_THRESHOLD, NearDuplicateFilter, SignatureStore
+
+    record_manager = SQLRecordManager(
+        f"local/{index_name}", db_url=f"sqlite:///{workdir}/{index_name}.records.db"
+    )
+    record_manager.create_schema()
+    text_splitter = get_text_splitter()
+    dedup = None
+    if DEDUP_THRESHOLD:
+        dedup = NearDuplicateFilter(
+            record_manager.namespace,
+            SignatureStore(f"{workdir}/signatures.sqlite"),
+            exists=record_manager.exists,
+            threshold=DEDUP_THRESHOLD,
+        ).filter
+    return index_documents(
+        prefetch(transform_documents(docs, text_splitter, dedup), window=4 * 64),
+        record_manager,
+        vector_store_manager.get_vector_store(index_name),
+        batch_size=64,
+        cleanup="full",
+        source_id_key="source",
+        keyword_index=vector_store_manager.get_keyword_index(index_name),
+    )
+
+
+def bench_ingest(args, workdir: str) -> dict:
+    results = {}
+    for concurrency in args.ingest_concurrency:
+        jobs = [
+            (synthetic_docs(args.docs_per_job, args.doc_words, job, f"c{concurrency}j{job}"),
+             f"Bench_Ingest_{concurrency}_{job}")
+            for job in range(args.ingest_jobs)
+        ]
+        latencies: List[float] = []
+        chunks = 0
+
+        def run(job):
+            docs, index_name = job
+            start = time.perf_counter()
+            stats = ingest(docs, index_name, workdir)
+            latencies.append(time.perf_counter() - start)
+            return stats["num_added"]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            chunks = sum(pool.map(run, jobs))
+        elapsed = time.perf_counter() - start
+        results[str(concurrency)] = {
+            "jobs": len(jobs),
+            "chunks": chunks,
+            "docs_per_second": round(len(jobs) * args.docs_per_job / elapsed, 1),
+            "chunks_per_second": round(chunks / elapsed, 1),
+            **latency_summary(latencies, "job"),
+            **memory(),
+        }
+    return results
+
+
+def question(rng: random.Random) -> str:
+    return "what about " + " ".join(rng.choice(_WORDS) for _ in range(6)) + "?"
+
+
+async def bench_chat(args, answer_chain) -> dict:
+    results = {}
+    for concurrency in args.concurrency:
+        rng = random.Random(concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies: List[float] = []
+        ttfts: List[float] = []
+
+        async def one(i: int) -> None:
+            history = [
+                {"human": question(rng), "ai": "an earlier answer"}
+                for _ in range(args.history_turns)
+            ]
+            request = {"question": f"{question(rng)} ({concurrency}/{i})", "chat_history": history}
+            async with semaphore:
+                start = time.perf_counter()
+                first: Optional[float] = None
+                async for piece in answer_chain.astream(request):
+                    if first is None and piece:
+                        first = time.perf_counter() - start
+                latencies.append(time.perf_counter() - start)
+                ttfts.append(first if first is not None else latencies[-1])
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - start
+        results[str(concurrency)] = {
+            "requests": args.requests,
+            "requests_per_second": round(args.requests / elapsed, 2),
+            **latency_summary(latencies, "latency"),
+            **latency_summary(ttfts, "ttft"),
+            **memory(),
+        }
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="write the JSON results here as well")
+    parser.add_argument("--skip-ingest", action="store_true")
+    parser.add_argument("--skip-chat", action="store_true")
+    parser.add_argument("--ingest-jobs", type=int, default=8)
+    parser.add_argument("--ingest-concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--docs-per-job", type=int, default=50)
+    parser.add_argument("--doc-words", type=int, default=1500)
+    parser.add_argument("--chat-docs", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--history-turns", type=int, default=0)
+    parser.add_argument("--embed-latency", type=float, default=0.0)
+    parser.add_argument("--embed-size", type=int, default=256)
+    parser.add_argument("--llm-ttft", type=float, default=0.2)
+    parser.add_argument("--llm-token-latency", type=float, default=0.01)
+    parser.add_argument("--llm-answer-tokens", type=int, default=40)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="benchmark_rag_")
+    use_stand_ins(workdir, args.embed_size, args.embed_latency)
+    import chain
+
+    results = {}
+    if not args.skip_ingest:
+        results["ingest"] = bench_ingest(args, workdir)
+    if not args.skip_chat:
+        index_name = "Bench_Chat"
+        ingest(synthetic_docs(args.chat_docs, args.doc_words, -1, "chat"), index_name, workdir)
+        llm = stand_in_llm(args.llm_ttft, args.llm_token_latency, args.llm_answer_tokens)
+        answer_chain = chain.create_chain(
+            llm,
+            chain.get_retriever(index_name),
+            index_name,
+            chain.answer_cache,
+            chain.question_condenser,
+        )
+        results["chat"] = asyncio.run(bench_chat(args, answer_chain))
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Retrieval-only evaluation on BEIR SciFact: recall@k, MRR@k and nDCG@k.
+
+Scores the retriever the app serves (``chain.get_retriever``: dense or hybrid
+search, then the reranker) on an index built by ``ingest.py`` from the same
+corpus, against the qrels of a BEIR download such as datasets/scifact:
+
+    python _scripts/evaluate_retrieval.py --dataset datasets/scifact
+    RERANKER=none python _scripts/evaluate_retrieval.py --dataset datasets/scifact --k 1 5 10 20
+
+Retriever settings come from the app's environment (RERANKER, RERANK_FETCH_K,
+HYBRID_SEARCH, ...). The queries are embedded up front in batches, then run
+--concurrency at a time through the async path, once, at the largest --k; every
+smaller cutoff is scored on a prefix of the same ranking. Rankings are cached
+in SQLite per (index, query, retriever settings, index size), with the k they
+were retrieved at: a rerun or a sweep up to that k does not query again, and a
+larger k re-queries and keeps the longer ranking.
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from constants import WEAVIATE_SCIFACT_INDEX_NAME  # noqa: E402
+
+
+def load_beir(dataset: Path, split: str):
+    """Test queries (id -> text) and their qrels (query id -> corpus id -> grade)."""
+    qrels: Dict[str, Dict[str, int]] = defaultdict(dict)
+    with open(dataset / "qrels" / f"{split}.tsv", encoding="utf-8") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            qrels[row["query-id"]][row["corpus-id"]] = int(row["score"])
+    queries = {}
+    with open(dataset / "queries.jsonl", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                query = json.loads(line)
+                if query["_id"] in qrels:
+                    queries[query["_id"]] = query["text"]
+    return queries, dict(qrels)
+
+
+def corpus_id(metadata: dict) -> str:
+    # ingest.py stores the BEIR id as corpus_id and as the source's fragment.
+    return str(metadata.get("corpus_id") or metadata.get("source", "").rsplit("#", 1)[-1])
+
+
+def ranked_ids(docs) -> List[str]:
+    """Corpus ids in rank order, each once even if several of its chunks came back."""
+    return list(dict.fromkeys(corpus_id(doc.metadata) for doc in docs))
+
+
+def recall(ranking: Sequence[str], relevant: Dict[str, int], k: int) -> float:
+    hits = sum(1 for doc_id in ranking[:k] if relevant.get(doc_id, 0) > 0)
+    return hits / sum(1 for grade in relevant.values() if grade > 0)
+
+
+def reciprocal_rank(ranking: Sequence[str], relevant: Dict[str, int], k: int) -> float:
+    for rank, doc_id in enumerate(ranking[:k], 1):
+        if relevant.get(doc_id, 0) > 0:
+            return 1.0 / rank
+    return 0.0
+
+
+def ndcg(ranking: Sequence[str], relevant: Dict[str, int], k: int) -> float:
+    dcg = sum(
+        relevant.get(doc_id, 0) / math.log2(rank + 1)
+        for rank, doc_id in enumerate(ranking[:k], 1)
+    )
+    ideal = sorted(relevant.values(), reverse=True)[:k]
+    idcg = sum(grade / math.log2(rank + 1) for rank, grade in enumerate(ideal, 1))
+    return dcg / idcg if idcg else 0.0
+
+
+def score(rankings: Dict[str, List[str]], qrels: Dict[str, Dict[str, int]], ks) -> dict:
+    metrics = {}
+    for k in ks:
+        for name, metric in (("recall", recall), ("mrr", reciprocal_rank), ("ndcg", ndcg)):
+            values = [metric(rankings[qid], qrels[qid], k) for qid in rankings]
+            metrics[f"{name}@{k}"] = round(sum(values) / len(values), 4)
+    return metrics
+
+
+class RankingCache:
+    """Rankings (corpus ids) by a hash of everything but k that determines them,
+    with the k they were retrieved at."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(rankings)")}
+        if columns and "k" not in columns:
+            # Keyed on k as well: none of its keys would be looked up again.
+            self._conn.execute("DROP TABLE rankings")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rankings ("
+            " key TEXT PRIMARY KEY, k INTEGER NOT NULL, ids TEXT NOT NULL)"
+        )
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def get_many(self, keys: Sequence[str], k: int) -> Dict[str, List[str]]:
+        """Cached rankings retrieved at ``k`` or deeper, cut to ``k``."""
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._conn.execute(
+                f"SELECT key, ids FROM rankings WHERE k >= ? AND key IN ({placeholders})",
+                [k, *chunk],
+            )
+            found.update((key, json.loads(ids)[:k]) for key, ids in rows)
+        return found
+
+    def put_many(self, items: Dict[str, List[str]], k: int) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO rankings (key, k, ids) VALUES (?, ?, ?)",
+                [(key, k, json.dumps(ids)) for key, ids in items.items()],
+            )
+
+
+def retriever_settings(chain, index_name: str) -> dict:
+    """What the served rankings depend on, besides the query and k."""
+    manager = chain.vector_store_manager
+    settings = {
+        "backend": os.environ.get("VECTOR_STORE_BACKEND", "weaviate"),
+        "hybrid_search": manager.hybrid_search,
+        "hybrid_fetch_k": manager.hybrid_fetch_k if manager.hybrid_search else None,
+        "local_ann_nprobe": os.environ.get("LOCAL_ANN_NPROBE"),
+        "embeddings": getattr(chain.get_embeddings_model(), "namespace", None),
+        "reranker": chain.RERANKER,
+        "index_size": manager.count(index_name),
+    }
+    if chain.RERANKER != "none":
+        settings.update(
+            rerank_model=os.environ.get("RERANK_MODEL") if chain.RERANKER == "cross-encoder" else None,
+            rerank_fetch_k=chain.RERANK_FETCH_K,
+            rerank_max_tokens=chain.RERANK_MAX_TOKENS,
+            rerank_min_score=chain.RERANK_MIN_SCORE,
+            rerank_rrf_k=chain.RERANK_RRF_K if chain.RERANKER == "embedding" else None,
+        )
+    return settings
+
+
+async def retrieve(
+    retriever, embeddings, queries: Dict[str, str], concurrency: int, embed_batch: int
+) -> Tuple[Dict[str, List[str]], dict]:
+    timings = {}
+    start = time.perf_counter()
+    if hasattr(embeddings, "aembed_queries"):
+        texts = list(queries.values())
+        for i in range(0, len(texts), embed_batch):
+            await embeddings.aembed_queries(texts[i : i + embed_batch])
+    timings["embed_seconds"] = round(time.perf_counter() - start, 3)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(query: str) -> List[str]:
+        async with semaphore:
+            return ranked_ids(await retriever.ainvoke(query))
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(query) for query in queries.values()))
+    timings["search_seconds"] = round(time.perf_counter() - start, 3)
+    return dict(zip(queries, results)), timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=Path, required=True)
+    parser.add_argument("--split", default="test")
+    parser.add_argument("--index-name", default=WEAVIATE_SCIFACT_INDEX_NAME)
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 10])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--embed-batch", type=int, default=64)
+    parser.add_argument("--cache", help="SQLite file for rankings (default: .cache/)")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--output", help="write the JSON results here as well")
+    args = parser.parse_args()
+
+    import chain
+    from utils import CACHE_DIR
+
+    started = time.perf_counter()
+    queries, qrels = load_beir(args.dataset, args.split)
+    k = max(args.k)
+    settings = retriever_settings(chain, args.index_name)
+    cache: Optional[RankingCache] = None
+    rankings: Dict[str, List[str]] = {}
+    keys = {qid: RankingCache.key(args.index_name, text, settings) for qid, text in queries.items()}
+    if not args.no_cache:
+        cache = RankingCache(args.cache or str(CACHE_DIR / "retrieval_eval.sqlite"))
+        cached = cache.get_many(list(keys.values()), k)
+        rankings = {qid: cached[key] for qid, key in keys.items() if key in cached}
+
+    missing = {qid: text for qid, text in queries.items() if qid not in rankings}
+    timings = {}
+    if missing:
+        retriever = chain.get_retriever(args.index_name, k=k)
+        fresh, timings = asyncio.run(
+            retrieve(
+                retriever, chain.get_embeddings_model(), missing, args.concurrency, args.embed_batch
+            )
+        )
+        rankings.update(fresh)
+        if cache is not None:
+            cache.put_many({keys[qid]: ranking for qid, ranking in fresh.items()}, k)
+    timings["total_seconds"] = round(time.perf_counter() - started, 3)
+
+    report = {
+        "config": {**vars(args), "dataset": str(args.dataset)},
+        "retriever": settings,
+        "queries": len(queries),
+        "cached_rankings": len(queries) - len(missing),
+        "timings": timings,
+        "metrics": score(rankings, qrels, sorted(args.k)),
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Replay conversations against /chat/stream and /chat/invoke at set arrival rates.
+
+Conversations arrive as a Poisson process at each --rates value (conversations per
+second) for --duration seconds. Each one picks an index from --index-names and
+asks --turns questions in a row, sending the answers back as a growing
+``chat_history``; --invoke-share of the turns go to /chat/invoke, the rest are
+streamed. Per rate and endpoint it reports request and error counts (by kind),
+latency, time to first byte (response headers), and for streams the time to the
+first answer token and the gaps between tokens, as p50/p95/p99.
+
+Against a running server:
+
+    python _scripts/load_test_chat.py --url http://localhost:8080 --rates 1 5 10
+
+Against a stand-in: ``main.app`` in a single uvicorn worker started by this
+script, with hashed embeddings, local indexes of synthetic documents and a chat
+model that streams after --llm-ttft seconds:
+
+    python _scripts/load_test_chat.py --stand-in --rates 5 20 50 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from benchmark_rag import latency_summary  # noqa: E402
+from constants import WEAVIATE_DOCS_INDEX_NAME  # noqa: E402
+
+QUESTIONS = [
+    "How do I use a RecursiveUrlLoader to load content from a page?",
+    "How can I define the state schema for my LangGraph graph?",
+    "How can I run a model locally on my laptop with Ollama?",
+    "Explain RAG techniques and how LangGraph can implement them.",
+    "What is the difference between a retriever and a vector store?",
+    "How do I stream the output of a chain?",
+    "How do I add memory to a conversational chain?",
+    "What does the RunnablePassthrough.assign method do?",
+    "How do I split a long document into chunks with overlap?",
+    "Can you show me how to cache LLM responses?",
+    "Which embeddings models are supported?",
+    "How do I return the source documents with the answer?",
+]
+FOLLOW_UPS = [
+    "Can you give an example?",
+    "What are the alternatives?",
+    "How does that work with async?",
+    "Why is that faster?",
+    "What if the document is very large?",
+]
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors: Counter = Counter()
+        self.latency: List[float] = []
+        self.ttfb: List[float] = []
+        self.first_token: List[float] = []
+        self.token_gaps: List[float] = []
+
+    def summary(self) -> dict:
+        summary = {
+            "requests": self.requests,
+            "errors": sum(self.errors.values()),
+            "error_rate": round(sum(self.errors.values()) / self.requests, 4)
+            if self.requests
+            else 0.0,
+            "errors_by_kind": dict(self.errors),
+        }
+        for name in ("latency", "ttfb", "first_token", "token_gaps"):
+            values = getattr(self, name)
+            if values:
+                summary.update(latency_summary(values, name))
+        return summary
+
+
+def chat_input(question: str, history: List[Dict[str, str]], index_name: str) -> dict:
+    return {
+        "input": {"question": question, "chat_history": history, "index_name": index_name},
+        "config": {},
+    }
+
+
+async def stream_turn(
+    client: httpx.AsyncClient, body: dict, stats: EndpointStats
+) -> Optional[str]:
+    start = time.perf_counter()
+    pieces: List[str] = []
+    last_token: Optional[float] = None
+    event = None
+    async with client.stream("POST", "/chat/stream", json=body) as response:
+        stats.ttfb.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            stats.errors[f"http_{response.status_code}"] += 1
+            return None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[len("event:") :].strip()
+            elif line.startswith("data:") and event == "error":
+                stats.errors["stream_error"] += 1
+                return None
+            elif line.startswith("data:") and event == "data":
+                piece = json.loads(line[len("data:") :])
+                if not isinstance(piece, str) or not piece:
+                    continue
+                now = time.perf_counter()
+                if last_token is None:
+                    stats.first_token.append(now - start)
+                else:
+                    stats.token_gaps.append(now - last_token)
+                last_token = now
+                pieces.append(piece)
+    stats.latency.append(time.perf_counter() - start)
+    return "".join(pieces)
+
+
+async def invoke_turn(
+    client: httpx.AsyncClient, body: dict, stats: EndpointStats
+) -> Optional[str]:
+    start = time.perf_counter()
+    async with client.stream("POST", "/chat/invoke", json=body) as response:
+        stats.ttfb.append(time.perf_counter() - start)
+        payload = await response.aread()
+    if response.status_code != 200:
+        stats.errors[f"http_{response.status_code}"] += 1
+        return None
+    stats.latency.append(time.perf_counter() - start)
+    return json.loads(payload)["output"]
+
+
+async def conversation(
+    client: httpx.AsyncClient,
+    args,
+    rng: random.Random,
+    stats: Dict[str, EndpointStats],
+) -> None:
+    index_name = rng.choice(args.index_names)
+    history: List[Dict[str, str]] = []
+    for turn in range(args.turns):
+        question = rng.choice(QUESTIONS if turn == 0 else FOLLOW_UPS)
+        endpoint = "invoke" if rng.random() < args.invoke_share else "stream"
+        turn_stats = stats[endpoint]
+        turn_stats.requests += 1
+        body = chat_input(question, history, index_name)
+        try:
+            if endpoint == "stream":
+                answer = await stream_turn(client, body, turn_stats)
+            else:
+                answer = await invoke_turn(client, body, turn_stats)
+        except httpx.TimeoutException:
+            turn_stats.errors["timeout"] += 1
+            return
+        except httpx.HTTPError as e:
+            turn_stats.errors[type(e).__name__] += 1
+            return
+        if answer is None:
+            return
+        history.append({"human": question, "ai": answer})
+        if args.think_time:
+            await asyncio.sleep(rng.expovariate(1 / args.think_time))
+
+
+async def run_rate(args, rate: float) -> dict:
+    rng = random.Random(f"{args.seed}/{rate}")
+    stats = {"stream": EndpointStats(), "invoke": EndpointStats()}
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=args.keepalive)
+    async with httpx.AsyncClient(
+        base_url=args.url, limits=limits, timeout=httpx.Timeout(args.timeout)
+    ) as client:
+        conversations = []
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            conversations.append(
+                asyncio.ensure_future(conversation(client, args, rng, stats))
+            )
+            await asyncio.sleep(rng.expovariate(rate))
+        arrivals = time.perf_counter() - start
+        _, pending = await asyncio.wait(conversations, timeout=args.drain_timeout)
+        for task in pending:
+            task.cancel()
+        elapsed = time.perf_counter() - start
+    completed = sum(len(endpoint.latency) for endpoint in stats.values())
+    return {
+        "conversations": len(conversations),
+        "unfinished_conversations": len(pending),
+        "arrival_seconds": round(arrivals, 2),
+        "completed_requests_per_second": round(completed / elapsed, 2),
+        **{name: endpoint.summary() for name, endpoint in stats.items() if endpoint.requests},
+    }
+
+
+def serve_stand_in(args) -> None:
+    """Run ``main.app`` on stand-ins in this process (the --stand-in server)."""
+    from benchmark_rag import ingest, stand_in_llm, synthetic_docs, use_stand_ins
+
+    workdir = tempfile.mkdtemp(prefix="load_test_chat_")
+    use_stand_ins(workdir, embed_latency=args.embed_latency)
+    import chain
+
+    # Chains are compiled per index on first use, from this module-level llm.
+    chain.llm = stand_in_llm(args.llm_ttft, args.llm_token_latency, args.llm_answer_tokens)
+    for i, index_name in enumerate(args.index_names):
+        ingest(synthetic_docs(args.docs, 1500, i, index_name), index_name, workdir)
+
+    import uvicorn
+    from main import app
+
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def start_stand_in(args) -> subprocess.Popen:
+    command = [
+        sys.executable, __file__, "--serve-stand-in", "--port", str(args.port),
+        "--docs", str(args.docs), "--embed-latency", str(args.embed_latency),
+        "--llm-ttft", str(args.llm_ttft),
+        "--llm-token-latency", str(args.llm_token_latency),
+        "--llm-answer-tokens", str(args.llm_answer_tokens),
+        "--index-names", *args.index_names,
+    ]
+    server = subprocess.Popen(command)
+    deadline = time.monotonic() + 300
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"stand-in server exited with {server.returncode}")
+        try:
+            if httpx.get(f"{args.url}/", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("stand-in server did not start within 300 seconds")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="server to test (default: the stand-in)")
+    parser.add_argument("--output", help="write the JSON results here as well")
+    parser.add_argument("--rates", type=float, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--invoke-share", type=float, default=0.2)
+    parser.add_argument("--index-names", nargs="+", default=[WEAVIATE_DOCS_INDEX_NAME])
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--keepalive", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stand-in", action="store_true")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--embed-latency", type=float, default=0.02)
+    parser.add_argument("--llm-ttft", type=float, default=0.5)
+    parser.add_argument("--llm-token-latency", type=float, default=0.02)
+    parser.add_argument("--llm-answer-tokens", type=int, default=60)
+    parser.add_argument("--serve-stand-in", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_stand_in:
+        serve_stand_in(args)
+        return
+    if not args.stand_in and not args.url:
+        parser.error("pass --url, or --stand-in to start a local stand-in server")
+
+    server = None
+    if args.stand_in:
+        args.url = f"http://127.0.0.1:{args.port}"
+        server = start_stand_in(args)
+    try:
+        results = {str(rate): asyncio.run(run_rate(args, rate)) for rate in args.rates}
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    output = json.dumps({"config": vars(args), "results": results}, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Inverted-file (IVF) approximate nearest-neighbour index for LocalVectorStore.
+
+Vectors are clustered with spherical k-means into ``nlist`` lists. A query scores
+only the rows of the ``nprobe`` lists whose centroids are closest to it, so the
+cost of a search grows with ``nprobe / nlist`` of the index instead of all of it.
+Raising ``nprobe`` trades latency for recall.
+
+New rows are assigned to their nearest centroid as they are written and deleted
+rows are filtered by the store's live mask, so the index follows upserts and
+cleanups without being rebuilt. The centroids are retrained once the index has
+grown well past the size they were trained on.
+
+On disk, next to the store's files:
+
+- ``ivf.npz``: centroids, a training ``version`` and the number of rows trained on;
+- ``ivf.assign.<generation>.i32``: the training version, then one list id per row,
+  appended on write.
+
+An assignment file whose version does not match the centroids, or that is shorter
+than the matrix, is repaired by assigning the missing rows when the store opens.
+"""
+import os
+from typing import Optional
+
+import numpy as np
+
+# Rows scored per matrix product when assigning, to bound temporary memory.
+ASSIGN_BATCH_ROWS = 16384
+# Rebuild the list layout once this fraction of rows was appended after it.
+RELAYOUT_FRACTION = 0.1
+
+
+def default_nlist(rows: int) -> int:
+    return int(min(max(4 * np.sqrt(rows), 16), 65536))
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BATCH_ROWS):
+        batch = np.asarray(vectors[start : start + ASSIGN_BATCH_ROWS], dtype=np.float32)
+        assignments[start : start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(
+    sample: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0
+) -> np.ndarray:
+    """Spherical k-means over normalized ``sample`` rows."""
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist, len(sample))
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(sample, centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=nlist)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts[filled])[:-1]])
+        sums = np.add.reduceat(sample[order], starts, axis=0)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids[filled] = sums / np.where(norms == 0, 1, norms)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            # Re-seed empty lists from random rows instead of leaving them dead.
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """List assignments of every row of the matrix, and how to probe them.
+
+    Instances are not modified after construction: ``add`` and ``remapped`` return
+    new ones, so a search can use a snapshot without holding the store's lock.
+    """
+
+    def __init__(
+        self,
+        centroids: Optional[np.ndarray],
+        assignments: np.ndarray,
+        version: int = 0,
+        trained_rows: int = 0,
+        layout: Optional[tuple] = None,
+    ):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.version = version
+        self.trained_rows = trained_rows
+        if centroids is not None and layout is None:
+            order = np.argsort(assignments, kind="stable").astype(np.int64)
+            offsets = np.concatenate(
+                [[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))]
+            )
+            layout = (order, offsets, len(assignments))
+        # Rows [0, laid_out) grouped by list; later rows are scanned as a tail.
+        self._order, self._offsets, self._laid_out = layout or (None, None, 0)
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def add(self, vectors: np.ndarray) -> "IVFIndex":
+        if not self.trained:
+            return self
+        assignments = np.concatenate(
+            [self.assignments, nearest_centroids(vectors, self.centroids)]
+        )
+        tail = len(assignments) - self._laid_out
+        layout = None
+        if tail <= RELAYOUT_FRACTION * len(assignments):
+            layout = (self._order, self._offsets, self._laid_out)
+        return IVFIndex(self.centroids, assignments, self.version, self.trained_rows, layout)
+
+    def remapped(self, keep: np.ndarray) -> "IVFIndex":
+        """The index after the store dropped every row not in ``keep``."""
+        if not self.trained:
+            return self
+        return IVFIndex(self.centroids, self.assignments[keep], self.version, self.trained_rows)
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Rows in the ``nprobe`` lists nearest to ``query``."""
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = [self._order[self._offsets[i] : self._offsets[i + 1]] for i in probe]
+        tail = self.assignments[self._laid_out :]
+        if len(tail):
+            rows.append(self._laid_out + np.flatnonzero(np.isin(tail, probe)))
+        return np.concatenate(rows)
+
+    # -- persistence ----------------------------------------------------------
+
+    @staticmethod
+    def assignments_path(directory: str, generation: int) -> str:
+        return os.path.join(directory, f"ivf.assign.{generation}.i32")
+
+    def save(self, directory: str, generation: int) -> None:
+        """Write centroids and assignments for ``generation`` of the store."""
+        if not self.trained:
+            return
+        self.save_assignments(directory, generation)
+        path = os.path.join(directory, "ivf.npz")
+        with open(path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                version=self.version,
+                trained_rows=self.trained_rows,
+            )
+        os.replace(path + ".tmp", path)
+
+    def save_assignments(self, directory: str, generation: int) -> None:
+        if not self.trained:
+            return
+        path = self.assignments_path(directory, generation)
+        with open(path + ".tmp", "wb") as f:
+            f.write(np.int32(self.version).tobytes())
+            f.write(self.assignments.astype(np.int32).tobytes())
+        os.replace(path + ".tmp", path)
+
+    def append_assignments(self, directory: str, generation: int, count: int) -> None:
+        """Persist the assignments of the last ``count`` rows added."""
+        if not self.trained or not count:
+            return
+        with open(self.assignments_path(directory, generation), "ab") as f:
+            f.write(self.assignments[-count:].astype(np.int32).tobytes())
+
+    @classmethod
+    def load(cls, directory: str, generation: int, matrix: np.ndarray) -> "IVFIndex":
+        """Load the index for ``matrix``, assigning any rows the file is missing."""
+        empty = np.empty(0, dtype=np.int32)
+        path = os.path.join(directory, "ivf.npz")
+        if not os.path.exists(path):
+            return cls(None, empty)
+        with np.load(path) as data:
+            centroids = data["centroids"]
+            version = int(data["version"])
+            trained_rows = int(data["trained_rows"])
+
+        assignments, stored_rows = empty, -1
+        assign_path = cls.assignments_path(directory, generation)
+        if os.path.exists(assign_path):
+            stored = np.fromfile(assign_path, dtype=np.int32)
+            if len(stored) and stored[0] == version:
+                assignments, stored_rows = stored[1 : len(matrix) + 1], len(stored) - 1
+        # Rewrite the file unless it holds exactly one assignment per row.
+        repaired = stored_rows != len(matrix)
+        if len(assignments) < len(matrix):
+            missing = nearest_centroids(matrix[len(assignments) :], centroids)
+            assignments = np.concatenate([assignments, missing])
+        index = cls(centroids, assignments, version, trained_rows)
+        if repaired:
+            index.save_assignments(directory, generation)
+        return index
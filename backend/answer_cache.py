@@ -0,0 +1,210 @@
+"""Semantic cache of chat answers, keyed on the standalone question.
+
+Answers are stored per scope (index name plus model choice) together with the
+documents they cite. A question is a hit when its embedding's cosine similarity to
+a cached question of the same scope reaches ``threshold``. Entries expire after
+``ttl_seconds``, each scope keeps at most ``max_entries`` (least recently used
+evicted first), and a scope can be invalidated when its index is re-ingested.
+
+An answer is only stored if its index was not invalidated while it was being
+generated: callers take the scope's ``generation`` before the lookup and pass it
+to ``store``.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+Scope = Tuple[str, str]
+
+# Whitespace plus up to 8 non-space characters, so replayed answers stream in
+# token-sized pieces for both English and Chinese text.
+_ANSWER_PIECE = re.compile(r"\s*\S{1,8}|\s+$")
+
+
+def answer_pieces(answer: str) -> Iterator[str]:
+    """Split an answer into pieces that concatenate back to exactly ``answer``."""
+    for match in _ANSWER_PIECE.finditer(answer):
+        yield match.group(0)
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    docs: List[Document]
+    vector: np.ndarray
+    created_at: float
+
+
+class _ScopeEntries:
+    def __init__(self):
+        self.entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        # Stacked, normalized vectors of ``entries`` and their creation times;
+        # rebuilt lazily after changes.
+        self._matrix: Optional[np.ndarray] = None
+        self._created: Optional[np.ndarray] = None
+        self._keys: List[str] = []
+
+    def changed(self) -> None:
+        self._matrix = None
+
+    def matrix(self) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        if self._matrix is None:
+            self._keys = list(self.entries)
+            self._matrix = np.stack([self.entries[k].vector for k in self._keys])
+            self._created = np.array([self.entries[k].created_at for k in self._keys])
+        return self._keys, self._matrix, self._created
+
+
+def _normalize(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        threshold: float = 0.95,
+        ttl_seconds: float = 3600,
+        max_entries: int = 1000,
+    ):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._scopes: Dict[Scope, _ScopeEntries] = {}
+        # Invalidations of every index, and of each index on its own.
+        self._invalidations = 0
+        self._index_invalidations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cache_info(self) -> dict:
+        with self._lock:
+            size = sum(len(scope.entries) for scope in self._scopes.values())
+        return {"hits": self.hits, "misses": self.misses, "size": size}
+
+    @staticmethod
+    def _as_unit(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def _exact(self, scope: Scope, question: str) -> Optional[CachedAnswer]:
+        with self._lock:
+            entries = self._scopes.get(scope)
+            return self._fresh(entries, _normalize(question)) if entries else None
+
+    def _fresh(self, entries: _ScopeEntries, key: str) -> Optional[CachedAnswer]:
+        # Called with the lock held.
+        cached = entries.entries.get(key)
+        if cached is None:
+            return None
+        if time.time() - cached.created_at > self.ttl_seconds:
+            del entries.entries[key]
+            entries.changed()
+            return None
+        entries.entries.move_to_end(key)
+        return cached
+
+    def _nearest(self, scope: Scope, vector: np.ndarray) -> Optional[CachedAnswer]:
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if not entries or not entries.entries:
+                return None
+            keys, matrix, created = entries.matrix()
+            # Expired entries can't shadow a fresh, slightly less similar one.
+            fresh = created >= time.time() - self.ttl_seconds
+            scores = np.where(fresh, matrix @ vector, -np.inf)
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            return self._fresh(entries, keys[best])
+
+    def _count(self, cached: Optional[CachedAnswer]) -> Optional[CachedAnswer]:
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return cached
+
+    def lookup(self, scope: Scope, question: str) -> Optional[CachedAnswer]:
+        cached = self._exact(scope, question)
+        if cached is None:
+            vector = self._as_unit(self.embeddings.embed_query(question))
+            cached = self._nearest(scope, vector)
+        return self._count(cached)
+
+    async def alookup(self, scope: Scope, question: str) -> Optional[CachedAnswer]:
+        cached = self._exact(scope, question)
+        if cached is None:
+            vector = self._as_unit(await self.embeddings.aembed_query(question))
+            cached = self._nearest(scope, vector)
+        return self._count(cached)
+
+    def generation(self, scope: Scope) -> Tuple[int, int]:
+        """Changes whenever ``scope``'s index is invalidated."""
+        with self._lock:
+            return self._invalidations, self._index_invalidations.get(scope[0], 0)
+
+    def _put(
+        self, scope: Scope, cached: CachedAnswer, generation: Optional[Tuple[int, int]]
+    ) -> None:
+        with self._lock:
+            current = (self._invalidations, self._index_invalidations.get(scope[0], 0))
+            if generation is not None and generation != current:
+                # Generated from the index as it was before an invalidation.
+                return
+            entries = self._scopes.setdefault(scope, _ScopeEntries())
+            key = _normalize(cached.question)
+            entries.entries[key] = cached
+            entries.entries.move_to_end(key)
+            while len(entries.entries) > self.max_entries:
+                entries.entries.popitem(last=False)
+            entries.changed()
+
+    def store(
+        self,
+        scope: Scope,
+        question: str,
+        answer: str,
+        docs: List[Document],
+        generation: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        """Cache an answer, unless the index was invalidated since ``generation``."""
+        # The question embedding is already in the embeddings cache from lookup.
+        vector = self._as_unit(self.embeddings.embed_query(question))
+        self._put(scope, CachedAnswer(question, answer, docs, vector, time.time()), generation)
+
+    async def astore(
+        self,
+        scope: Scope,
+        question: str,
+        answer: str,
+        docs: List[Document],
+        generation: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        vector = self._as_unit(await self.embeddings.aembed_query(question))
+        self._put(scope, CachedAnswer(question, answer, docs, vector, time.time()), generation)
+
+    def invalidate(self, index_name: Optional[str] = None) -> None:
+        """Drop cached answers for one index, or for every index."""
+        with self._lock:
+            if index_name is None:
+                self._invalidations += 1
+            else:
+                self._index_invalidations[index_name] = (
+                    self._index_invalidations.get(index_name, 0) + 1
+                )
+            for scope in list(self._scopes):
+                if index_name is None or scope[0] == index_name:
+                    del self._scopes[scope]
@@ -0,0 +1,32 @@
+"""Pooled async HTTP client shared by the async retrieval path.
+
+One ``httpx.AsyncClient`` is kept per event loop, so connections to Weaviate and
+the embeddings provider are reused across requests instead of being opened per
+call.
+"""
+import asyncio
+import os
+import weakref
+
+import httpx
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(os.environ.get("HTTP_MAX_CONNECTIONS", "100")),
+                max_keepalive_connections=int(
+                    os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")
+                ),
+            ),
+            timeout=httpx.Timeout(float(os.environ.get("HTTP_TIMEOUT_SECONDS", "30"))),
+        )
+        _clients[loop] = client
+    return client
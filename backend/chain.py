@@ -1,9 +1,24 @@
 import os
+import time
+from collections import OrderedDict
 from operator import itemgetter
-from typing import Dict, List, Optional, Sequence
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import weaviate
-from vector_store_manage import VectorStoreManager
+from vector_store_manage import VectorStoreManager, validate_index_name
+from answer_cache import SemanticAnswerCache, answer_pieces
+from context_builder import ContextBuilder
+from question_condenser import QuestionCondenser, history_key
+from llm_router import LatencyRouter, RouterStats
+from stage_metrics import StageMetrics
+from reranker import (
+    DEFAULT_CROSS_ENCODER,
+    CrossEncoderScorer,
+    EmbeddingScorer,
+    RerankingRetriever,
+)
+from utils import cache_chat_model, count_tokens, get_embeddings_model
 from constants import WEAVIATE_DOCS_INDEX_NAME, WEAVIATE_WANG_DEATH_BOOK
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -12,7 +27,7 @@ from langchain_anthropic import ChatAnthropic
 from langchain_community.vectorstores import Weaviate
 from langchain_core.documents import Document
 from langchain_core.language_models import LanguageModelLike
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
 from langchain_core.output_parsers import StrOutputParser
 # from langchain_core.caches import BaseCache 
 from langchain_core.prompts import (
@@ -21,11 +36,12 @@ from langchain_core.prompts import (
     PromptTemplate,
 )
 # from langchain_core.pydantic_v1 import BaseModel
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from langchain_core.retrievers import BaseRetriever
 from langchain_core.runnables import (
     ConfigurableField,
     Runnable,
+    RunnableConfig,
     RunnableBranch,
     RunnableLambda,
     RunnablePassthrough,
@@ -122,8 +138,33 @@ app.add_middleware(
 )
 
 
-WEAVIATE_URL = os.environ["WEAVIATE_URL"]
-WEAVIATE_API_KEY = os.environ["WEAVIATE_API_KEY"]
+WEAVIATE_URL = os.environ.get("WEAVIATE_URL")
+WEAVIATE_API_KEY = os.environ.get("WEAVIATE_API_KEY")
+
+# Retrieval over-fetches RERANK_FETCH_K candidates, reranks them and keeps up to 6
+# that score at least RERANK_MIN_SCORE and fit in RERANK_MAX_TOKENS prompt tokens.
+# RERANKER is "embedding" (stored vectors, fused with the retrieval ranking by
+# reciprocal rank with RERANK_RRF_K), "cross-encoder" (RERANK_MODEL on CPU; needs
+# the cross-encoder extra, `poetry install -E cross-encoder`) or "none".
+# "embedding" reorders only under hybrid search; with HYBRID_SEARCH=false it
+# keeps the dense order and only applies the budget.
+RERANKER = os.environ.get("RERANKER", "embedding")
+RERANK_FETCH_K = int(os.environ.get("RERANK_FETCH_K", "20"))
+RERANK_RRF_K = int(os.environ.get("RERANK_RRF_K", "60"))
+RERANK_MAX_TOKENS = int(os.environ.get("RERANK_MAX_TOKENS", "3000"))
+RERANK_MIN_SCORE = os.environ.get("RERANK_MIN_SCORE")
+_rerank_scorer = None
+_rerank_scorer_lock = Lock()
+
+# Prompt budget: the system prompt, up to CONTEXT_HISTORY_TOKENS of the most recent
+# chat history, the question, and the retrieved documents in what is left of
+# CONTEXT_MAX_TOKENS.
+context_builder = ContextBuilder(
+    count_tokens,
+    max_tokens=int(os.environ.get("CONTEXT_MAX_TOKENS", "8000")),
+    history_tokens=int(os.environ.get("CONTEXT_HISTORY_TOKENS", "1500")),
+    system_prompt=RESPONSE_TEMPLATE,
+)
 
 
 class ChatRequest(BaseModel):
@@ -131,44 +172,127 @@ class ChatRequest(BaseModel):
     chat_history: Optional[List[Dict[str, str]]]
     index_name: Optional[str] = WEAVIATE_DOCS_INDEX_NAME
 
+    # Rejected with a 422 before any chain or store is built for it.
+    @field_validator("index_name")
+    @classmethod
+    def check_index_name(cls, index_name: Optional[str]) -> Optional[str]:
+        return index_name if index_name is None else validate_index_name(index_name)
 
-def get_retriever(index_name: str = WEAVIATE_DOCS_INDEX_NAME) -> BaseRetriever:
-    vector_store = vector_store_manager.get_vector_store(index_name)
-    return vector_store.as_retriever(search_kwargs=dict(k=6))
 
+def get_rerank_scorer(index_name: str = WEAVIATE_DOCS_INDEX_NAME):
+    if RERANKER == "embedding":
+        # Scores with the vectors stored in the index: no embedding calls per chat.
+        return EmbeddingScorer(
+            get_embeddings_model(), vector_store_manager.get_stored_vectors(index_name)
+        )
+    global _rerank_scorer
+    with _rerank_scorer_lock:
+        if _rerank_scorer is None:
+            if RERANKER == "cross-encoder":
+                _rerank_scorer = CrossEncoderScorer(
+                    os.environ.get("RERANK_MODEL", DEFAULT_CROSS_ENCODER)
+                )
+            else:
+                raise ValueError(
+                    f"Unknown RERANKER {RERANKER!r}; expected embedding, cross-encoder or none"
+                )
+        return _rerank_scorer
+
+
+def get_retriever(index_name: str = WEAVIATE_DOCS_INDEX_NAME, k: int = 6) -> BaseRetriever:
+    # Async under langserve: embedding and search don't occupy executor threads.
+    if RERANKER == "none":
+        return vector_store_manager.get_retriever(index_name, k=k)
+    return RerankingRetriever(
+        base=vector_store_manager.get_retriever(index_name, k=max(RERANK_FETCH_K, k)),
+        scorer=get_rerank_scorer(index_name),
+        count_tokens=count_tokens,
+        k=k,
+        min_score=float(RERANK_MIN_SCORE) if RERANK_MIN_SCORE else None,
+        max_tokens=RERANK_MAX_TOKENS or None,
+        # Cosine similarity refines the hybrid ranking; a cross-encoder replaces it.
+        rrf_k=RERANK_RRF_K if RERANKER == "embedding" else None,
+    )
 
-def create_retriever_chain(
-    llm: LanguageModelLike, retriever: BaseRetriever
+
+def create_condense_question_chain(
+    llm: LanguageModelLike, condenser: Optional[QuestionCondenser] = None
 ) -> Runnable:
+    """Turn the question into a standalone question, using the chat history.
+
+    With a ``condenser``, the LLM is only asked to rephrase questions that look
+    like they depend on the history, and its answers are cached per conversation.
+    """
     CONDENSE_QUESTION_PROMPT = PromptTemplate.from_template(REPHRASE_TEMPLATE)
     condense_question_chain = (
         CONDENSE_QUESTION_PROMPT | llm | StrOutputParser()
     ).with_config(
         run_name="CondenseQuestion",
     )
-    conversation_chain = condense_question_chain | retriever
-    return RunnableBranch(
-        (
-            RunnableLambda(lambda x: bool(x.get("chat_history"))).with_config(
-                run_name="HasChatHistoryCheck"
+    if condenser is None:
+        return RunnableBranch(
+            (
+                RunnableLambda(lambda x: bool(x.get("chat_history"))).with_config(
+                    run_name="HasChatHistoryCheck"
+                ),
+                condense_question_chain,
             ),
-            conversation_chain.with_config(run_name="RetrievalChainWithHistory"),
-        ),
-        (
             RunnableLambda(itemgetter("question")).with_config(
                 run_name="Itemgetter:question"
-            )
-            | retriever
-        ).with_config(run_name="RetrievalChainWithNoHistory"),
-    ).with_config(run_name="RouteDependingOnChatHistory")
+            ),
+        ).with_config(run_name="RouteDependingOnChatHistory")
+
+    def condense(x: dict, config: RunnableConfig) -> str:
+        question, chat_history = x["question"], x.get("chat_history")
+        if not chat_history:
+            return question
+        key = history_key(chat_history, question)
+        condensed = condenser.cached(key)
+        if condensed is not None:
+            return condensed
+        if not condenser.needs_rephrase(question, chat_history):
+            condenser.skip()
+            return question
+        condensed = condense_question_chain.invoke(x, config)
+        condenser.remember(key, condensed)
+        return condensed
+
+    async def acondense(x: dict, config: RunnableConfig) -> str:
+        question, chat_history = x["question"], x.get("chat_history")
+        if not chat_history:
+            return question
+        key = history_key(chat_history, question)
+        condensed = condenser.cached(key)
+        if condensed is not None:
+            return condensed
+        if not await condenser.aneeds_rephrase(question, chat_history):
+            condenser.skip()
+            return question
+        condensed = await condense_question_chain.ainvoke(x, config)
+        condenser.remember(key, condensed)
+        return condensed
+
+    return RunnableLambda(condense, afunc=acondense).with_config(
+        run_name="RouteDependingOnChatHistory"
+    )
 
 
-def format_docs(docs: Sequence[Document]) -> str:
-    formatted_docs = []
-    for i, doc in enumerate(docs):
-        doc_string = f"<doc id='{i}'>{doc.page_content}</doc>"
-        formatted_docs.append(doc_string)
-    return "\n".join(formatted_docs)
+def create_retriever_chain(
+    llm: LanguageModelLike,
+    retriever: BaseRetriever,
+    condenser: Optional[QuestionCondenser] = None,
+) -> Runnable:
+    return create_condense_question_chain(llm, condenser) | retriever
+
+
+def format_docs(
+    docs: Sequence[Document],
+    chat_history: Sequence[BaseMessage] = (),
+    question: str = "",
+) -> str:
+    """Docs as ``<doc id='i'>`` blocks, deduplicated and cut to the token budget."""
+    budget = context_builder.document_budget(chat_history, question)
+    return context_builder.format_docs(docs, budget)
 
 
 def serialize_history(request: ChatRequest):
@@ -179,17 +303,26 @@ def serialize_history(request: ChatRequest):
             converted_chat_history.append(HumanMessage(content=message["human"]))
         if message.get("ai") is not None:
             converted_chat_history.append(AIMessage(content=message["ai"]))
-    return converted_chat_history
+    return context_builder.history(converted_chat_history)
 
 
-def create_chain(llm: LanguageModelLike, retriever: BaseRetriever) -> Runnable:
-    retriever_chain = create_retriever_chain(
-        llm,
-        retriever,
+def create_chain(
+    llm: LanguageModelLike,
+    retriever: BaseRetriever,
+    index_name: str = WEAVIATE_DOCS_INDEX_NAME,
+    answer_cache: Optional[SemanticAnswerCache] = None,
+    condenser: Optional[QuestionCondenser] = None,
+) -> Runnable:
+    retriever_chain = (
+        RunnableLambda(itemgetter("standalone_question")) | retriever
     ).with_config(run_name="FindDocs")
     context = (
         RunnablePassthrough.assign(docs=retriever_chain)
-        .assign(context=lambda x: format_docs(x["docs"]))
+        .assign(
+            context=RunnableLambda(
+                lambda x: format_docs(x["docs"], x["chat_history"], x["question"])
+            ).with_config(run_name="FormatDocs")
+        )
         .with_config(run_name="RetrieveDocs")
     )
     prompt = ChatPromptTemplate.from_messages(
@@ -222,23 +355,82 @@ def create_chain(llm: LanguageModelLike, retriever: BaseRetriever) -> Runnable:
             # google_gemini_pro=default_response_synthesizer,
             # cohere_command=cohere_response_synthesizer,
             deepseek=default_response_synthesizer,
+            auto=default_response_synthesizer,
         )
         | StrOutputParser()
     ).with_config(run_name="GenerateResponse")
-    return (
-        RunnablePassthrough.assign(chat_history=serialize_history)
-        | context
-        | response_synthesizer
+    standalone_question = RunnablePassthrough.assign(
+        chat_history=serialize_history
+    ) | RunnablePassthrough.assign(
+        standalone_question=create_condense_question_chain(llm, condenser)
+    )
+    if answer_cache is None:
+        return standalone_question | context | response_synthesizer
+
+    # Replayed answers still emit a FindDocs run so clients get their sources.
+    cached_docs = RunnableLambda(lambda docs: docs).with_config(run_name="FindDocs")
+
+    def cache_scope(config: RunnableConfig):
+        llm_key = config.get("configurable", {}).get("llm", "openai_gpt_3_5_turbo")
+        return (index_name, llm_key)
+
+    def answer(x: dict, config: RunnableConfig):
+        scope = cache_scope(config)
+        generation = answer_cache.generation(scope)
+        cached = answer_cache.lookup(scope, x["standalone_question"])
+        if cached is not None:
+            cached_docs.invoke(cached.docs, config)
+            yield from answer_pieces(cached.answer)
+            return
+        x = context.invoke(x, config)
+        pieces = []
+        for piece in response_synthesizer.stream(x, config):
+            pieces.append(piece)
+            yield piece
+        if pieces:
+            answer_cache.store(
+                scope, x["standalone_question"], "".join(pieces), x["docs"], generation
+            )
+
+    async def aanswer(x: dict, config: RunnableConfig):
+        scope = cache_scope(config)
+        generation = answer_cache.generation(scope)
+        cached = await answer_cache.alookup(scope, x["standalone_question"])
+        if cached is not None:
+            await cached_docs.ainvoke(cached.docs, config)
+            for piece in answer_pieces(cached.answer):
+                yield piece
+            return
+        x = await context.ainvoke(x, config)
+        pieces = []
+        async for piece in response_synthesizer.astream(x, config):
+            pieces.append(piece)
+            yield piece
+        if pieces:
+            await answer_cache.astore(
+                scope, x["standalone_question"], "".join(pieces), x["docs"], generation
+            )
+
+    return standalone_question | RunnableLambda(answer, afunc=aanswer).with_config(
+        run_name="AnswerWithCache"
     )
+
+
 # ChatDeepSeek.model_rebuild()
 
-deepseek = ChatDeepSeek(
-    model="deepseek-chat",
-    temperature=0,
-    max_tokens=4096,
+# Identical prompts (same model and parameters) are answered from the LLM cache,
+# and concurrent ones share a single upstream call.
+deepseek = cache_chat_model(
+    ChatDeepSeek(
+        model="deepseek-chat",
+        temperature=0,
+        max_tokens=4096,
+    )
 )
 
-gpt_3_5 = ChatOpenAI(model="gpt-3.5-turbo-0125", temperature=0, streaming=True)
+gpt_3_5 = cache_chat_model(
+    ChatOpenAI(model="gpt-3.5-turbo-0125", temperature=0, streaming=True)
+)
 # claude_3_haiku = ChatAnthropic(
 #     model="claude-3-haiku-20240307",
 #     temperature=0,
@@ -263,28 +455,124 @@ gpt_3_5 = ChatOpenAI(model="gpt-3.5-turbo-0125", temperature=0, streaming=True)
 #     temperature=0,
 #     cohere_api_key=os.environ.get("COHERE_API_KEY", "not_provided"),
 # )
-llm = gpt_3_5.configurable_alternatives(
+# Each choice of the "llm" configurable routes to the chosen provider while it is
+# healthy, failing over to the fastest healthy one; "auto" always takes the
+# fastest. LLM_HEDGE=true also starts the next provider when the first has not
+# streamed a token within its p95 time-to-first-token.
+llm_router_stats = RouterStats()
+llm_providers = {
+    "openai_gpt_3_5_turbo": gpt_3_5,
+    "deepseek": deepseek,
+    # "anthropic_claude_3_haiku": claude_3_haiku,
+    # "fireworks_mixtral": fireworks_mixtral,
+    # "google_gemini_pro": gemini_pro,
+    # "cohere_command": cohere_command,
+}
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "false").lower() == "true"
+
+
+def route_llm(preferred: Optional[str]) -> LatencyRouter:
+    return LatencyRouter(
+        providers=llm_providers,
+        stats=llm_router_stats,
+        preferred=preferred,
+        hedge=LLM_HEDGE,
+    )
+
+
+# Also reports the per-provider metrics (see main.py).
+llm_router = route_llm(None)
+llm = route_llm("openai_gpt_3_5_turbo").configurable_alternatives(
     # This gives this field an id
     # When configuring the end runnable, we can then use this id to configure this field
     ConfigurableField(id="llm"),
-    deepseek=deepseek,
+    deepseek=route_llm("deepseek"),
+    auto=llm_router,
     default_key="openai_gpt_3_5_turbo",
-    # anthropic_claude_3_haiku=claude_3_haiku,
-    # fireworks_mixtral=fireworks_mixtral,
-    # google_gemini_pro=gemini_pro,
-    # cohere_command=cohere_command,
-).with_fallbacks(
-    # [gpt_3_5, claude_3_haiku, fireworks_mixtral, gemini_pro, cohere_command]
-    # [gpt_3_5, claude_3_haiku, fireworks_mixtral, gemini_pro,deepseek]
-    [deepseek, gpt_3_5]
 )
 
 
-def get_answer_chain(index_name: str = WEAVIATE_DOCS_INDEX_NAME) -> Runnable:
-    """Create answer chain with specified index."""
-    retriever = get_retriever(index_name)
-    return create_chain(llm, retriever)
+# Answers replayed for questions that embed within ANSWER_CACHE_THRESHOLD cosine
+# similarity of an earlier question on the same index. ANSWER_CACHE_SIZE=0 disables.
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "1000"))
+answer_cache = (
+    SemanticAnswerCache(
+        get_embeddings_model(),
+        threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95")),
+        ttl_seconds=float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600")),
+        max_entries=ANSWER_CACHE_SIZE,
+    )
+    if ANSWER_CACHE_SIZE
+    else None
+)
+
+# Follow-up questions are only sent to the condense LLM when they look like they
+# depend on the chat history.
+question_condenser = QuestionCondenser(
+    get_embeddings_model(),
+    similarity_threshold=float(os.environ.get("CONDENSE_SIMILARITY_THRESHOLD", "0.8")),
+    cache_size=int(os.environ.get("CONDENSE_CACHE_SIZE", "10000")),
+)
+
+# Compiled chains per index, most recently used last. Chains idle for longer than
+# ANSWER_CHAIN_IDLE_SECONDS, or beyond ANSWER_CHAIN_CACHE_SIZE, are dropped.
+ANSWER_CHAIN_CACHE_SIZE = int(os.environ.get("ANSWER_CHAIN_CACHE_SIZE", "16"))
+ANSWER_CHAIN_IDLE_SECONDS = float(os.environ.get("ANSWER_CHAIN_IDLE_SECONDS", "3600"))
+_answer_chains: "OrderedDict[str, Tuple[Runnable, float]]" = OrderedDict()
+_answer_chains_lock = Lock()
+
 
-# Default chain for backward compatibility
-retriever = get_retriever()
-answer_chain = get_answer_chain()
+def _evict_answer_chains(now: float) -> None:
+    while _answer_chains:
+        index_name, (_, last_used) = next(iter(_answer_chains.items()))
+        if (
+            len(_answer_chains) <= ANSWER_CHAIN_CACHE_SIZE
+            and now - last_used < ANSWER_CHAIN_IDLE_SECONDS
+        ):
+            break
+        del _answer_chains[index_name]
+        vector_store_manager.release(index_name)
+
+
+def get_answer_chain(index_name: str = WEAVIATE_DOCS_INDEX_NAME) -> Runnable:
+    """Get the answer chain for an index, compiling it on first use."""
+    now = time.monotonic()
+    with _answer_chains_lock:
+        cached = _answer_chains.pop(index_name, None)
+        answer_chain = cached[0] if cached else None
+        if answer_chain is None:
+            # The chain holds the index's stores until it is evicted.
+            vector_store_manager.acquire(index_name)
+            try:
+                retriever = get_retriever(index_name)
+                answer_chain = create_chain(
+                    llm, retriever, index_name, answer_cache, question_condenser
+                )
+            except Exception:
+                vector_store_manager.release(index_name)
+                raise
+        _answer_chains[index_name] = (answer_chain, now)
+        _evict_answer_chains(now)
+        return answer_chain
+
+
+def route_by_index(request: dict) -> Runnable:
+    """Dispatch a chat request to the chain for its ``index_name``."""
+    return get_answer_chain(request.get("index_name") or WEAVIATE_DOCS_INDEX_NAME)
+
+
+# Stage timings (condense, embed, search, prompt, time to first token, ...) of a
+# METRICS_SAMPLE_RATE share of chat requests, served by /metrics. 0 disables.
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1.0"))
+stage_metrics = StageMetrics(count_tokens, sample_rate=METRICS_SAMPLE_RATE)
+
+# Default chain for backward compatibility. Retrievers (and the Weaviate client)
+# are built per index on the first request, not at import.
+answer_chain = (
+    RunnableLambda(route_by_index)
+    .with_types(input_type=ChatRequest, output_type=str)
+    .with_config(
+        run_name="RouteByIndex",
+        callbacks=[stage_metrics] if METRICS_SAMPLE_RATE > 0 else None,
+    )
+)
@@ -0,0 +1,109 @@
+"""Fit the chat history and retrieved chunks into a prompt token budget.
+
+The budget is split three ways: the fixed system prompt, up to
+``history_tokens`` of chat history and the documents, which get whatever is
+left of ``max_tokens``. History is kept newest turn first; older turns are
+dropped, and a latest turn that alone exceeds the budget is truncated.
+
+Chunks are split with an overlap, so neighbouring chunks of the same source
+repeat text. The part of a chunk already in an earlier one is cut, and chunks
+fully contained in an earlier one are left out. Documents keep their retrieval
+position as ``<doc id>``, so citations still point at the right source.
+
+Token counts come from a cached counter and trimmed text is estimated from the
+share of characters kept, so building the context does not re-encode anything
+the cache has already seen.
+"""
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+
+# Fewest tokens of the document budget worth filling with a truncated chunk.
+MIN_TRUNCATED_TOKENS = 64
+# Overlap probe: the first characters of a chunk looked up near the end of the
+# previous chunk of the same source.
+_PROBE_CHARS = 32
+
+
+def overlap_length(previous: str, text: str, max_overlap: int) -> int:
+    """Length of the longest prefix of ``text`` that ends ``previous``."""
+    probe = text[:_PROBE_CHARS]
+    if len(probe) < _PROBE_CHARS:
+        return 0
+    start = previous.find(probe, max(len(previous) - max_overlap, 0))
+    while start != -1:
+        if text.startswith(previous[start:]):
+            return len(previous) - start
+        start = previous.find(probe, start + 1)
+    return 0
+
+
+class ContextBuilder:
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_tokens: int = 8000,
+        history_tokens: int = 1500,
+        system_prompt: str = "",
+        max_overlap: int = 400,
+    ):
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.history_tokens = history_tokens
+        self.system_prompt = system_prompt
+        self.max_overlap = max_overlap
+
+    def history(self, messages: Sequence[BaseMessage]) -> List[BaseMessage]:
+        """The most recent messages that fit in ``history_tokens``."""
+        kept: List[BaseMessage] = []
+        used = 0
+        for message in reversed(messages):
+            tokens = self.count_tokens(message.content)
+            if used + tokens > self.history_tokens:
+                if not kept and self.history_tokens > 0:
+                    chars = len(message.content) * self.history_tokens // tokens
+                    kept.append(message.model_copy(update={"content": message.content[:chars]}))
+                break
+            kept.append(message)
+            used += tokens
+        return kept[::-1]
+
+    def document_budget(self, history: Sequence[BaseMessage], question: str) -> int:
+        used = self.count_tokens(self.system_prompt) + self.count_tokens(question)
+        used += sum(self.count_tokens(message.content) for message in history)
+        return max(self.max_tokens - used, 0)
+
+    def select(self, docs: Sequence[Document], budget: int) -> List[Tuple[int, str]]:
+        """(retrieval position, text) of the documents to put in the prompt."""
+        selected: List[Tuple[int, str]] = []
+        seen: Dict[str, List[str]] = {}
+        used = 0
+        for i, doc in enumerate(docs):
+            text, tokens = doc.page_content, self.count_tokens(doc.page_content)
+            earlier = seen.setdefault(doc.metadata.get("source", ""), [])
+            if any(text in previous for previous in earlier):
+                continue
+            for previous in earlier:
+                # The chunk may follow or precede the earlier one in its source.
+                head = overlap_length(previous, text, self.max_overlap)
+                tail = overlap_length(text, previous, self.max_overlap)
+                if head or tail:
+                    kept = text[head : len(text) - tail]
+                    tokens = -(-tokens * len(kept) // len(text))
+                    text = kept
+                    break
+            earlier.append(doc.page_content)
+            if used + tokens > budget:
+                remaining = budget - used
+                if remaining >= MIN_TRUNCATED_TOKENS:
+                    selected.append((i, text[: len(text) * remaining // tokens]))
+                break
+            selected.append((i, text))
+            used += tokens
+        return selected
+
+    def format_docs(self, docs: Sequence[Document], budget: int) -> str:
+        return "\n".join(
+            f"<doc id='{i}'>{text}</doc>" for i, text in self.select(docs, budget)
+        )
@@ -0,0 +1,718 @@
+"""Incremental web crawling with conditional GETs and an on-disk response store.
+
+Every page fetched is kept in a SQLite ``ResponseStore`` (compressed body,
+``ETag``, ``Last-Modified``, the sitemap ``lastmod`` it was fetched under). On
+the next run a page is
+
+- skipped without a request when its sitemap ``lastmod`` is the one stored,
+- revalidated with ``If-None-Match``/``If-Modified-Since`` otherwise, and a
+  ``304 Not Modified`` answered from the store,
+- downloaded only when new or changed.
+
+Each ``CrawledPage`` says whether its content differs from the last content
+ingested, so loaders can hand only changed pages to the ingest pipeline. A page
+counts as ingested only once ``Crawler.acknowledge`` is called after the ingest
+succeeded; until then it stays changed, however often it is downloaded.
+Unchanged pages still carry their stored HTML, so a recursive crawl keeps
+following the links of pages it did not download.
+
+All crawls share one ``CrawlClient``: a pooled HTTP client on its own event loop
+with per-host concurrency and rate limits, robots.txt rules and retries. Pages
+are yielded as they arrive, so callers extract them while the crawl goes on,
+and ``CrawlStats`` reports throughput and latency per host at the end.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+import httpx
+from langchain_core.utils.html import extract_sub_links
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = os.environ.get("USER_AGENT", "chat-llm-crawler")
+# Entries of a sitemap <url> kept as document metadata, as in SitemapLoader.
+SITEMAP_FIELDS = ("loc", "lastmod", "changefreq", "priority")
+# Responses worth another attempt after a backoff.
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+T = TypeVar("T")
+
+
+@dataclass
+class StoredResponse:
+    url: str
+    content: str
+    content_hash: str
+    content_type: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    sitemap_lastmod: Optional[str]
+    # Hash of the content last acknowledged as ingested.
+    ingested_hash: Optional[str] = None
+
+
+class ResponseStore:
+    """Last successful response per URL, shared by every crawl in one file."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " url TEXT PRIMARY KEY,"
+            " content BLOB NOT NULL,"
+            " content_hash TEXT NOT NULL,"
+            " content_type TEXT NOT NULL,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " sitemap_lastmod TEXT,"
+            " fetched_at REAL NOT NULL,"
+            " checked_at REAL NOT NULL,"
+            " ingested_hash TEXT)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(responses)")}
+        if "ingested_hash" not in columns:
+            self._conn.execute("ALTER TABLE responses ADD COLUMN ingested_hash TEXT")
+        self._conn.commit()
+
+    def get(self, url: str) -> Optional[StoredResponse]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, content_hash, content_type, etag, last_modified,"
+                " sitemap_lastmod, ingested_hash FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        content = zlib.decompress(row[0]).decode("utf-8", "surrogatepass")
+        return StoredResponse(url, content, *row[1:])
+
+    def put(self, response: StoredResponse) -> None:
+        """Store a downloaded response; the ingested hash is left as it was."""
+        now = time.time()
+        blob = zlib.compress(response.content.encode("utf-8", "surrogatepass"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO responses (url, content, content_hash, content_type,"
+                " etag, last_modified, sitemap_lastmod, fetched_at, checked_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET"
+                " content = excluded.content, content_hash = excluded.content_hash,"
+                " content_type = excluded.content_type, etag = excluded.etag,"
+                " last_modified = excluded.last_modified,"
+                " sitemap_lastmod = excluded.sitemap_lastmod,"
+                " fetched_at = excluded.fetched_at, checked_at = excluded.checked_at",
+                (
+                    response.url, blob, response.content_hash, response.content_type,
+                    response.etag, response.last_modified, response.sitemap_lastmod,
+                    now, now,
+                ),
+            )
+            self._conn.commit()
+
+    def touch(self, stored: StoredResponse) -> None:
+        """Record that ``stored`` is still current (with its updated validators)."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE responses SET etag = ?, last_modified = ?, sitemap_lastmod = ?,"
+                " checked_at = ? WHERE url = ?",
+                (
+                    stored.etag, stored.last_modified, stored.sitemap_lastmod,
+                    time.time(), stored.url,
+                ),
+            )
+            self._conn.commit()
+
+    def mark_ingested(self, hashes: Dict[str, str]) -> None:
+        """Record the content hash by URL that the index now holds."""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE responses SET ingested_hash = ? WHERE url = ?",
+                [(digest, url) for url, digest in hashes.items()],
+            )
+            self._conn.commit()
+
+
+@dataclass
+class CrawledPage:
+    url: str
+    html: str
+    content_type: str
+    etag: Optional[str]
+    # Whether the content differs from the last one acknowledged as ingested.
+    changed: bool
+    # "downloaded", "not_modified" (304) or "skipped" (sitemap lastmod unchanged).
+    fetch: str
+    content_hash: str
+    # The page's <url> entry when it came from a sitemap.
+    sitemap: Dict[str, str] = field(default_factory=dict)
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.latencies: List[float] = []
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def ms(q: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1)
+
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "latency_p50_ms": ms(0.5),
+            "latency_p95_ms": ms(0.95),
+            "latency_max_ms": ms(1.0),
+        }
+
+
+@dataclass
+class CrawlStats:
+    requests: int = 0
+    downloaded: int = 0
+    not_modified: int = 0
+    skipped: int = 0
+    disallowed: int = 0
+    failed: int = 0
+    changed: int = 0
+    bytes_downloaded: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    hosts: Dict[str, HostStats] = field(default_factory=dict)
+
+    def host(self, url: str) -> HostStats:
+        netloc = urlparse(url).netloc
+        stats = self.hosts.get(netloc)
+        if stats is None:
+            stats = self.hosts[netloc] = HostStats()
+        return stats
+
+    def to_dict(self) -> dict:
+        """Counters, throughput over the crawl's wall time, and latency per host."""
+        seconds = ((self.finished_at or time.perf_counter()) - self.started_at) if self.started_at else 0.0
+        pages = self.downloaded + self.not_modified + self.skipped
+        return {
+            "requests": self.requests,
+            "downloaded": self.downloaded,
+            "not_modified": self.not_modified,
+            "skipped": self.skipped,
+            "disallowed": self.disallowed,
+            "failed": self.failed,
+            "changed": self.changed,
+            "bytes_downloaded": self.bytes_downloaded,
+            "seconds": round(seconds, 3),
+            "pages_per_second": round(pages / seconds, 1) if seconds else None,
+            "megabytes_per_second": round(self.bytes_downloaded / 1e6 / seconds, 2) if seconds else None,
+            "hosts": {host: stats.to_dict() for host, stats in sorted(self.hosts.items())},
+        }
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class RobotsDisallowed(Exception):
+    """Raised for URLs the site's robots.txt does not allow us to fetch."""
+
+
+class _Host:
+    """Per-host connection slots, request pacing and robots.txt rules."""
+
+    def __init__(self, concurrency: int, interval: float):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = interval
+        self.next_request = 0.0
+        self.robots: Optional[RobotFileParser] = None
+        self.robots_lock = asyncio.Lock()
+        self.robots_loaded = False
+
+    async def wait_turn(self) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self.next_request)
+        self.next_request = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class CrawlClient:
+    """Pooled HTTP client shared by every crawl in the process.
+
+    It runs on its own event loop thread, so synchronous callers (the ingest
+    loaders, ingestion job threads) share one connection pool and one set of
+    per-host limits: at most ``per_host_concurrency`` requests in flight and
+    ``per_host_rps`` started per second for each host (or the robots.txt
+    ``Crawl-delay``, if longer). Connection errors, 429 and 5xx responses are
+    retried ``retries`` times with exponential backoff and jitter, honouring
+    ``Retry-After``.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 64,
+        per_host_concurrency: int = 4,
+        per_host_rps: float = 0.0,
+        timeout: float = 60,
+        retries: int = 3,
+        backoff: float = 0.5,
+        respect_robots: bool = True,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        self.max_connections = max_connections
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_rps = per_host_rps
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.respect_robots = respect_robots
+        self.headers = {"User-Agent": USER_AGENT, **(headers or {})}
+        self._hosts: Dict[str, _Host] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    # -- event loop ------------------------------------------------------------
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="crawl-client", daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro):
+        """Run ``coro`` on the client's loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop()).result()
+
+    def iterate(self, agen: AsyncIterator[T]) -> Iterator[T]:
+        """Iterate an async generator from synchronous code.
+
+        The loop keeps crawling in its thread while the caller works on the
+        items it has, so fetching and processing overlap.
+        """
+
+        async def anext():
+            return await agen.__anext__()
+
+        loop = self.loop()
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(anext(), loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+    def close(self) -> None:
+        """Close the pooled connections and stop the loop thread."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result()
+            self._client = None
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+        self._hosts.clear()
+
+    # -- requests --------------------------------------------------------------
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=httpx.Timeout(self.timeout),
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    def _host(self, url: str) -> _Host:
+        netloc = urlparse(url).netloc
+        host = self._hosts.get(netloc)
+        if host is None:
+            interval = 1 / self.per_host_rps if self.per_host_rps > 0 else 0.0
+            host = self._hosts[netloc] = _Host(self.per_host_concurrency, interval)
+        return host
+
+    async def robots(self, url: str) -> Optional[RobotFileParser]:
+        """The robots.txt rules of ``url``'s host, fetched once per host."""
+        host = self._host(url)
+        async with host.robots_lock:
+            if not host.robots_loaded:
+                scheme, netloc = _scheme_and_domain(url)
+                robots = RobotFileParser(f"{scheme}://{netloc}/robots.txt")
+                try:
+                    response = await self._http().get(robots.url)
+                except httpx.HTTPError as e:
+                    logger.warning(f"Unable to load {robots.url}: {e!r}")
+                    robots.allow_all = True
+                else:
+                    if response.status_code in (401, 403):
+                        robots.disallow_all = True
+                    elif response.status_code >= 400:
+                        robots.allow_all = True
+                    else:
+                        robots.parse(response.text.splitlines())
+                delay = robots.crawl_delay(self.headers["User-Agent"])
+                if delay:
+                    host.interval = max(host.interval, float(delay))
+                host.robots = robots
+                host.robots_loaded = True
+        return host.robots
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+
+    async def get(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        stats: Optional[CrawlStats] = None,
+    ) -> httpx.Response:
+        """GET ``url`` within its host's limits, retrying transient failures.
+
+        Raises ``RobotsDisallowed`` if robots.txt forbids the URL, and the last
+        ``httpx`` error if every attempt failed to connect.
+        """
+        if self.respect_robots:
+            robots = await self.robots(url)
+            if not robots.can_fetch(self.headers["User-Agent"], url):
+                raise RobotsDisallowed(url)
+        host = self._host(url)
+        host_stats = stats.host(url) if stats is not None else HostStats()
+        for attempt in range(self.retries + 1):
+            response, error = None, None
+            async with host.semaphore:
+                await host.wait_turn()
+                if stats is not None:
+                    stats.requests += 1
+                host_stats.requests += 1
+                try:
+                    response = await self._http().get(url, headers=headers)
+                    host_stats.latencies.append(response.elapsed.total_seconds())
+                except httpx.TransportError as e:
+                    error = e
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                return response
+            if attempt == self.retries:
+                if response is not None:
+                    return response
+                raise error
+            host_stats.retries += 1
+            await asyncio.sleep(self._retry_delay(attempt, response))
+        raise AssertionError("unreachable")
+
+
+_crawl_client: Optional[CrawlClient] = None
+
+
+def get_crawl_client() -> CrawlClient:
+    """The process-wide ``CrawlClient``, configured from the environment."""
+    global _crawl_client
+    if _crawl_client is None:
+        _crawl_client = CrawlClient(
+            max_connections=int(os.environ.get("CRAWL_MAX_CONNECTIONS", "64")),
+            per_host_concurrency=int(os.environ.get("CRAWL_PER_HOST_CONCURRENCY", "4")),
+            per_host_rps=float(os.environ.get("CRAWL_PER_HOST_RPS", "0")),
+            timeout=float(os.environ.get("CRAWL_TIMEOUT_SECONDS", "60")),
+            retries=int(os.environ.get("CRAWL_RETRIES", "3")),
+            respect_robots=(os.environ.get("CRAWL_RESPECT_ROBOTS") or "true").lower() == "true",
+        )
+    return _crawl_client
+
+
+class Crawler:
+    """One crawl over a ``ResponseStore``, with its own ``stats``.
+
+    Requests go through the shared ``CrawlClient``. ``sitemap`` and
+    ``recursive`` yield pages as they arrive (not in link or sitemap order), so
+    callers can extract them while the crawl goes on. ``continue_on_failure``
+    logs and drops pages that fail to load instead of raising.
+
+    Call ``acknowledge`` once the pages are ingested; pages that are not
+    acknowledged are reported as changed again by the next crawl.
+    """
+
+    def __init__(
+        self,
+        store: ResponseStore,
+        client: Optional[CrawlClient] = None,
+        concurrency: int = 16,
+        continue_on_failure: bool = True,
+    ):
+        self.store = store
+        self.client = client or get_crawl_client()
+        self.concurrency = concurrency
+        self.continue_on_failure = continue_on_failure
+        self.stats = CrawlStats()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # Content hash by URL of the changed pages fetched, not yet acknowledged.
+        self._unacknowledged: Dict[str, str] = {}
+
+    def fetch_one(self, url: str) -> Optional[CrawledPage]:
+        return self.client.run(self._timed_fetch(url))
+
+    def acknowledge(self) -> None:
+        """Record the changed pages fetched so far as ingested."""
+        hashes, self._unacknowledged = self._unacknowledged, {}
+        if hashes:
+            self.store.mark_ingested(hashes)
+
+    def _page(self, stored: StoredResponse, fetch: str, document: bool) -> CrawledPage:
+        changed = stored.ingested_hash != stored.content_hash
+        if changed and document:
+            self.stats.changed += 1
+            self._unacknowledged[stored.url] = stored.content_hash
+        return CrawledPage(
+            stored.url, stored.content, stored.content_type, stored.etag, changed, fetch,
+            stored.content_hash,
+        )
+
+    def sitemap(
+        self,
+        sitemap_url: str,
+        filter_urls: Optional[Sequence[str]] = None,
+        restrict_to_same_domain: bool = True,
+        max_depth: int = 10,
+    ) -> Iterator[CrawledPage]:
+        """Pages listed in a sitemap (and its nested sitemaps).
+
+        Entries are filtered like ``SitemapLoader``: same scheme and host as the
+        sitemap, and matching one of the ``filter_urls`` regular expressions.
+        """
+        return self.client.iterate(
+            self._sitemap(sitemap_url, filter_urls, restrict_to_same_domain, max_depth)
+        )
+
+    def recursive(
+        self,
+        url: str,
+        max_depth: int = 2,
+        link_regex: Optional[str] = None,
+        prevent_outside: bool = True,
+        exclude_dirs: Sequence[str] = (),
+        use_sitemaps: bool = True,
+    ) -> Iterator[CrawledPage]:
+        """Pages reachable from ``url`` within ``max_depth`` levels, as
+        ``RecursiveUrlLoader`` follows them (``url`` itself is level one).
+
+        With ``use_sitemaps``, the sitemaps robots.txt lists give the pages'
+        ``lastmod``, so unchanged pages are not requested at all.
+        """
+        return self.client.iterate(
+            self._recursive(url, max_depth, link_regex, prevent_outside, exclude_dirs, use_sitemaps)
+        )
+
+    async def _timed_fetch(self, url: str) -> Optional[CrawledPage]:
+        self.stats.started_at = time.perf_counter()
+        try:
+            return await self.fetch(url)
+        finally:
+            self.stats.finished_at = time.perf_counter()
+
+    async def fetch(
+        self, url: str, lastmod: Optional[str] = None, document: bool = True
+    ) -> Optional[CrawledPage]:
+        """Fetch ``url`` through the store. ``document=False`` is for sitemaps,
+        which are never ingested: they are neither counted as changed nor left
+        to ``acknowledge``."""
+        stored = self.store.get(url)
+        if stored is not None and lastmod is not None and stored.sitemap_lastmod == lastmod:
+            self.stats.skipped += 1
+            return self._page(stored, "skipped", document)
+
+        headers = {}
+        if stored is not None:
+            if stored.etag:
+                headers["If-None-Match"] = stored.etag
+            if stored.last_modified:
+                headers["If-Modified-Since"] = stored.last_modified
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            async with self._semaphore:
+                response = await self.client.get(url, headers=headers, stats=self.stats)
+            if response.status_code != 304 or stored is None:
+                response.raise_for_status()
+        except RobotsDisallowed:
+            self.stats.disallowed += 1
+            logger.info(f"Skipping {url}: disallowed by robots.txt")
+            return None
+        except httpx.HTTPError as e:
+            self.stats.failed += 1
+            if not self.continue_on_failure:
+                raise
+            logger.warning(f"Unable to load {url}: {e!r}")
+            return None
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code == 304:
+            self.stats.not_modified += 1
+            stored.etag = etag or stored.etag
+            stored.last_modified = last_modified or stored.last_modified
+            stored.sitemap_lastmod = lastmod or stored.sitemap_lastmod
+            self.store.touch(stored)
+            return self._page(stored, "not_modified", document)
+
+        self.stats.downloaded += 1
+        self.stats.bytes_downloaded += len(response.content)
+        html = response.text
+        content_type = response.headers.get("Content-Type", "")
+        downloaded = StoredResponse(
+            url, html, content_hash(html), content_type, etag, last_modified, lastmod,
+            stored.ingested_hash if stored is not None else None,
+        )
+        self.store.put(downloaded)
+        return self._page(downloaded, "downloaded", document)
+
+    async def _sitemap(
+        self, sitemap_url, filter_urls, restrict_to_same_domain, max_depth
+    ) -> AsyncIterator[CrawledPage]:
+        self.stats.started_at = time.perf_counter()
+        entries = await self._sitemap_entries(
+            sitemap_url, filter_urls, restrict_to_same_domain, max_depth, 0
+        )
+
+        async def fetch(entry: Dict[str, str]) -> Optional[CrawledPage]:
+            page = await self.fetch(entry["loc"].strip(), entry.get("lastmod"))
+            if page is not None:
+                page.sitemap = entry
+            return page
+
+        tasks = [asyncio.ensure_future(fetch(entry)) for entry in entries]
+        try:
+            for next_page in asyncio.as_completed(tasks):
+                page = await next_page
+                if page is not None:
+                    yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.stats.finished_at = time.perf_counter()
+
+    async def _sitemap_entries(
+        self, sitemap_url, filter_urls, restrict_to_same_domain, max_depth, depth
+    ) -> List[Dict[str, str]]:
+        if depth >= max_depth:
+            return []
+        # The sitemap itself is revalidated too; a 304 is parsed from the store.
+        page = await self.fetch(sitemap_url, document=False)
+        if page is None:
+            return []
+        root = etree.fromstring(
+            page.html.encode("utf-8"), etree.XMLParser(recover=True, huge_tree=True)
+        )
+        if root is None:
+            return []
+        domain = _scheme_and_domain(sitemap_url)
+        entries = []
+        for url in root.iter("{*}url"):
+            found = {name: url.find(f".//{{*}}{name}") for name in SITEMAP_FIELDS}
+            if found["loc"] is None:
+                continue
+            entry = {name: "".join(el.itertext()) for name, el in found.items() if el is not None}
+            loc = entry["loc"].strip()
+            if restrict_to_same_domain and _scheme_and_domain(loc) != domain:
+                continue
+            if filter_urls and not any(re.match(pattern, loc) for pattern in filter_urls):
+                continue
+            entries.append(entry)
+        for sitemap in root.iter("{*}sitemap"):
+            loc = sitemap.find(".//{*}loc")
+            if loc is not None:
+                entries.extend(
+                    await self._sitemap_entries(
+                        "".join(loc.itertext()).strip(), filter_urls,
+                        restrict_to_same_domain, max_depth, depth + 1,
+                    )
+                )
+        return entries
+
+    async def _lastmods(self, url: str) -> Dict[str, str]:
+        """``lastmod`` by URL from the sitemaps robots.txt lists for ``url``'s host."""
+        robots = await self.client.robots(url) if self.client.respect_robots else None
+        lastmods: Dict[str, str] = {}
+        for sitemap_url in (robots.site_maps() if robots is not None else None) or []:
+            for entry in await self._sitemap_entries(sitemap_url, None, True, 10, 0):
+                if "lastmod" in entry:
+                    lastmods[entry["loc"].strip()] = entry["lastmod"]
+        return lastmods
+
+    async def _recursive(
+        self, url, max_depth, link_regex, prevent_outside, exclude_dirs, use_sitemaps
+    ) -> AsyncIterator[CrawledPage]:
+        self.stats.started_at = time.perf_counter()
+        lastmods = await self._lastmods(url) if use_sitemaps else {}
+
+        async def fetch(link: str, depth: int) -> Tuple[Optional[CrawledPage], int]:
+            return await self.fetch(link, lastmods.get(link)), depth
+
+        visited: Set[str] = {url}
+        pending = {asyncio.ensure_future(fetch(url, 0))} if max_depth > 0 else set()
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    page, depth = task.result()
+                    if page is None:
+                        continue
+                    if depth < max_depth - 1:
+                        for link in extract_sub_links(
+                            page.html,
+                            page.url,
+                            base_url=url,
+                            pattern=link_regex,
+                            prevent_outside=prevent_outside,
+                            exclude_prefixes=exclude_dirs,
+                            continue_on_failure=True,
+                        ):
+                            if link not in visited:
+                                visited.add(link)
+                                pending.add(asyncio.ensure_future(fetch(link, depth + 1)))
+                    yield page
+        finally:
+            for task in pending:
+                task.cancel()
+            self.stats.finished_at = time.perf_counter()
+
+
+def _scheme_and_domain(url: str) -> Tuple[str, str]:
+    parsed = urlparse(url)
+    return parsed.scheme, parsed.netloc
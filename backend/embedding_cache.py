@@ -0,0 +1,218 @@
+"""Content-addressed cache in front of an embeddings model.
+
+Vectors are keyed on a SHA-256 of the text and namespaced by model name and
+dimension, so re-embedding text that has not changed never leaves the process.
+Lookups go memory (LRU) -> SQLite -> provider, and only the misses of a batch are
+sent upstream in a single call.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from stage_metrics import stage_timer
+
+
+def embedding_namespace(embeddings: Embeddings) -> str:
+    """Build a cache namespace such as ``embedding-3:1024`` for a model."""
+    model = getattr(embeddings, "model", None) or getattr(
+        embeddings, "model_name", None
+    )
+    dimensions = getattr(embeddings, "dimensions", None)
+    return f"{model or type(embeddings).__name__}:{dimensions or 'default'}"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """SQLite tier of the cache, shared by every namespace in one file."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.commit()
+
+    def get_many(self, namespace: str, keys: Sequence[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        # SQLite caps the number of bound parameters per statement.
+        for start in range(0, len(keys), 500):
+            chunk = list(keys[start : start + 500])
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings "
+                    f"WHERE namespace = ? AND key IN ({placeholders})",
+                    [namespace, *chunk],
+                ).fetchall()
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, namespace: str, items: Dict[str, List[float]]) -> None:
+        rows = [
+            (namespace, key, np.asarray(vector, dtype=np.float32).tobytes())
+            for key, vector in items.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (namespace, key, vector) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """Wrap any ``Embeddings`` with an in-memory LRU and an optional disk tier.
+
+    Documents and queries are cached under separate keys because some providers
+    embed them differently.
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        store: Optional[EmbeddingStore] = None,
+        namespace: Optional[str] = None,
+        max_memory_items: int = 10_000,
+    ):
+        self.underlying = underlying
+        self.store = store
+        self.namespace = namespace or embedding_namespace(underlying)
+        self.max_memory_items = max_memory_items
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    def cache_info(self) -> dict:
+        return {
+            "namespace": self.namespace,
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_size": len(self._memory),
+        }
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _lookup(self, keys: Sequence[str], namespace: str) -> Dict[str, List[float]]:
+        """Resolve as many keys as possible from memory, then from disk."""
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+            self.memory_hits += len(found)
+
+        remaining = [key for key in dict.fromkeys(keys) if key not in found]
+        if remaining and self.store is not None:
+            from_disk = self.store.get_many(namespace, remaining)
+            for key, vector in from_disk.items():
+                self._remember(key, vector)
+            found.update(from_disk)
+            with self._lock:
+                self.disk_hits += len(from_disk)
+        return found
+
+    def _save(self, namespace: str, items: Dict[str, List[float]]) -> None:
+        for key, vector in items.items():
+            self._remember(key, vector)
+        if self.store is not None and items:
+            self.store.put_many(namespace, items)
+
+    def _plan(self, texts: Sequence[str], namespace: str):
+        keys = [f"{namespace}/{text_hash(text)}" for text in texts]
+        found = self._lookup(keys, namespace)
+        # Identical texts within one batch are only sent upstream once.
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        with self._lock:
+            self.misses += len(missing)
+        return keys, found, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        namespace = self.namespace
+        keys, found, missing = self._plan(texts, namespace)
+        if missing:
+            with stage_timer("embed"):
+                vectors = self.underlying.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._save(namespace, computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        namespace = f"{self.namespace}:query"
+        keys, found, missing = self._plan([text], namespace)
+        if missing:
+            with stage_timer("embed"):
+                vector = self.underlying.embed_query(text)
+            self._save(namespace, {keys[0]: vector})
+            return vector
+        return found[keys[0]]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed_many(texts, self.namespace)
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Query vectors of many texts, the misses embedded in one batched call.
+
+        Only for models that embed queries and documents alike, as embedding-3
+        does. The vectors go to the query cache, so ``aembed_query`` hits them.
+        """
+        return await self._aembed_many(texts, f"{self.namespace}:query")
+
+    async def _aembed_many(self, texts: List[str], namespace: str) -> List[List[float]]:
+        keys, found, missing = self._plan(texts, namespace)
+        if missing:
+            with stage_timer("embed"):
+                vectors = await self.underlying.aembed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._save(namespace, computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        namespace = f"{self.namespace}:query"
+        keys, found, missing = self._plan([text], namespace)
+        if missing:
+            with stage_timer("embed"):
+                vector = await self.underlying.aembed_query(text)
+            self._save(namespace, {keys[0]: vector})
+            return vector
+        return found[keys[0]]
@@ -0,0 +1,398 @@
+"""Parallel, cached Markdown extraction of documentation pages.
+
+Produces the same text as ``parser.langchain_docs_extractor`` and the same
+title, description and language as ``ingest.metadata_extractor`` without
+building a BeautifulSoup tree: pages are parsed into lxml elements (the parser
+BeautifulSoup itself delegates to) and walked directly, in a process pool.
+
+To stay byte-identical, the walk reproduces what BeautifulSoup does on top of
+lxml: strings made only of ASCII whitespace collapse to one space or newline
+outside ``pre``/``textarea``, ``get_text`` leaves out comments and strings
+inside ``rt``, ``rp`` and ``template``, and nothing outside ``<html>`` is kept
+(the ``SoupStrainer`` in ``ingest.load_langchain_docs``).
+
+Results are cached in SQLite by URL and a SHA-256 of the page (or its ETag), so
+an unchanged page is never parsed twice. Bump ``EXTRACTOR_VERSION`` whenever
+the output changes.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from lxml import etree
+
+EXTRACTOR_VERSION = 1
+
+# Removed with their contents before extraction, as in langchain_docs_extractor.
+SKIP_TAGS = frozenset(("nav", "footer", "aside", "script", "style"))
+HEADINGS = {f"h{level}": "#" * level for level in range(1, 7)}
+# BeautifulSoup keeps whitespace as is inside these ...
+_PRESERVE_WHITESPACE = frozenset(("pre", "textarea"))
+# ... and gives strings inside these a type get_text() skips.
+_STRING_CONTAINERS = frozenset(("rt", "rp", "template", "script", "style"))
+# Tags the SoupStrainer of ingest.load_langchain_docs keeps at the top level.
+STRAINER_TAGS = frozenset(("article", "title", "html", "lang", "content"))
+_ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+_LANGUAGE = re.compile(r"language-\w+")
+_BLANK_LINES = re.compile(r"\n\n+")
+
+Page = Tuple[str, str, Optional[str]]  # url, html, etag
+
+
+def parse_html(markup: str) -> Optional[etree._Element]:
+    """The <html> element of ``markup`` as BeautifulSoup's lxml builder sees it."""
+    if markup[:1] == "\N{BYTE ORDER MARK}":
+        markup = markup[1:]
+    try:
+        parser = etree.HTMLParser(recover=True)
+        parser.feed(markup)
+        return parser.close()
+    except (UnicodeDecodeError, LookupError, etree.ParserError):
+        # BeautifulSoup's second attempt for markup lxml rejects as str.
+        parser = etree.HTMLParser(recover=True, encoding="utf8")
+        parser.feed(markup.encode("utf8"))
+        return parser.close()
+
+
+def _string(text: str, preserve: bool) -> str:
+    if not preserve and not text.strip(_ASCII_SPACES):
+        return "\n" if "\n" in text else " "
+    return text
+
+
+def _context(el: etree._Element) -> Tuple[bool, bool]:
+    """Whether strings in ``el`` keep their whitespace, and are not main content."""
+    preserve = special = False
+    while el is not None:
+        preserve = preserve or el.tag in _PRESERVE_WHITESPACE
+        special = special or el.tag in _STRING_CONTAINERS
+        el = el.getparent()
+    return preserve, special
+
+
+def _strings(el: etree._Element, preserve: bool, special: bool, out: List[str]) -> None:
+    if not special and el.text is not None:
+        out.append(_string(el.text, preserve))
+    for child in el:
+        tag = child.tag
+        if isinstance(tag, str) and tag not in SKIP_TAGS:
+            _strings(
+                child,
+                preserve or tag in _PRESERVE_WHITESPACE,
+                special or tag in _STRING_CONTAINERS,
+                out,
+            )
+        if not special and child.tail is not None:
+            out.append(_string(child.tail, preserve))
+
+
+def get_text(el: etree._Element, strip: bool = False, context=None) -> str:
+    """``Tag.get_text`` of BeautifulSoup for an lxml element."""
+    out: List[str] = []
+    _strings(el, *(context or _context(el)), out)
+    if strip:
+        return "".join(text for text in (s.strip() for s in out) if text)
+    return "".join(out)
+
+
+def _classes(el: etree._Element) -> List[str]:
+    return (el.get("class") or "").split()
+
+
+def _descendants(el: etree._Element, tag: str) -> Iterator[etree._Element]:
+    return (found for found in el.iter(tag) if found is not el)
+
+
+def _markdown(el: etree._Element, preserve: bool, special: bool, out: List[str]) -> None:
+    if el.text is not None:
+        out.append(_string(el.text, preserve))
+    for child in el:
+        tag = child.tag
+        if not isinstance(tag, str):
+            if tag is etree.Comment:
+                out.append(_string(child.text or "", preserve))
+            elif tag is etree.PI:
+                out.append(_string(f"{child.target} {child.text or ''}", preserve))
+        elif tag not in SKIP_TAGS and tag != "button":
+            context = (
+                preserve or tag in _PRESERVE_WHITESPACE,
+                special or tag in _STRING_CONTAINERS,
+            )
+            _element(child, tag, context, out)
+        if child.tail is not None:
+            out.append(_string(child.tail, preserve))
+
+
+def _element(child: etree._Element, tag: str, context, out: List[str]) -> None:
+    if tag in HEADINGS:
+        out.append(f"{HEADINGS[tag]} {get_text(child, context=context)}\n\n")
+    elif tag == "a":
+        out.append(f"[{get_text(child, context=context)}]({child.get('href')})")
+    elif tag == "img":
+        out.append(f"![{child.get('alt', '')}]({child.get('src')})")
+    elif tag in ("strong", "b"):
+        out.append(f"**{get_text(child, context=context)}**")
+    elif tag in ("em", "i"):
+        out.append(f"_{get_text(child, context=context)}_")
+    elif tag == "br":
+        out.append("\n")
+    elif tag == "code":
+        parent = child.getparent()
+        if parent is not None and parent.tag == "pre":
+            language = next(
+                (name for name in _classes(parent) if _LANGUAGE.match(name)), None
+            )
+            language = "" if language is None else language.split("-")[1]
+            lines = [
+                "".join(get_text(token) for token in _descendants(span, "span"))
+                for span in child.iter("span")
+                if "token-line" in _classes(span)
+            ]
+            code_content = "\n".join(lines)
+            out.append(f"```{language}\n{code_content}\n```\n\n")
+        else:
+            out.append(f"`{get_text(child, context=context)}`")
+    elif tag == "p":
+        _markdown(child, *context, out)
+        out.append("\n\n")
+    elif tag in ("ul", "ol"):
+        items = [li for li in child if li.tag == "li"]
+        for i, li in enumerate(items):
+            out.append("- " if tag == "ul" else f"{i + 1}. ")
+            _markdown(li, *context, out)
+            out.append("\n\n")
+    elif tag == "div" and "tabs-container" in (_classes(child) or [""]):
+        tabs = [li for li in child.iter("li") if li.get("role") == "tab"]
+        panels = [div for div in _descendants(child, "div") if div.get("role") == "tabpanel"]
+        for tab, panel in zip(tabs, panels):
+            out.append(f"{get_text(tab, strip=True)}\n")
+            _markdown(panel, *_context(panel), out)
+    elif tag == "table":
+        thead = next(child.iter("thead"), None)
+        if thead is not None:
+            headers = list(thead.iter("th"))
+            if headers:
+                out.append("| ")
+                out.append(" | ".join(get_text(header) for header in headers))
+                out.append(" |\n")
+                out.append("| ")
+                out.append(" | ".join("----" for _ in headers))
+                out.append(" |\n")
+        tbody = next(child.iter("tbody"), None)
+        if tbody is not None:
+            for row in tbody.iter("tr"):
+                out.append("| ")
+                out.append(" | ".join(get_text(cell, strip=True) for cell in row.iter("td")))
+                out.append(" |\n")
+        out.append("\n\n")
+    else:
+        _markdown(child, *context, out)
+
+
+def top_level(root: Optional[etree._Element]) -> List[etree._Element]:
+    """The elements BeautifulSoup keeps at the top of the document.
+
+    libxml2 opens a second <html> for content after </html>; the strainer keeps
+    every <html> and drops strings and comments outside them.
+    """
+    elements: List[etree._Element] = []
+
+    def visit(el: etree._Element) -> None:
+        if not isinstance(el.tag, str):
+            return
+        if el.tag in STRAINER_TAGS:
+            elements.append(el)
+        else:
+            for child in el:
+                visit(child)
+
+    if root is not None:
+        for el in (root, *root.itersiblings()):
+            visit(el)
+    return elements
+
+
+def extract_markdown(elements: Sequence[etree._Element]) -> str:
+    """``langchain_docs_extractor`` for the ``top_level`` elements of a page."""
+    out: List[str] = []
+    for el in elements:
+        _element(el, el.tag, _context(el), out)
+    return _BLANK_LINES.sub("\n\n", "".join(out)).strip()
+
+
+def _find(elements: Sequence[etree._Element], tag: str) -> Iterator[etree._Element]:
+    for el in elements:
+        yield from el.iter(tag)
+
+
+def extract_metadata(elements: Sequence[etree._Element]) -> Dict[str, str]:
+    """Title, description and language, as ``ingest.metadata_extractor`` reads them."""
+    title = next(_find(elements, "title"), None)
+    description = next(
+        (meta for meta in _find(elements, "meta") if meta.get("name") == "description"),
+        None,
+    )
+    html = next(_find(elements, "html"), None)
+    return {
+        "title": get_text(title) if title is not None else "",
+        "description": description.get("content", "") if description is not None else "",
+        "language": html.get("lang", "") if html is not None else "",
+    }
+
+
+def drop_skipped(elements: Sequence[etree._Element]) -> None:
+    """Empty the SKIP_TAGS elements, keeping the text that follows them."""
+    for el in list(_find(elements, SKIP_TAGS)):
+        el.clear(keep_tail=True)
+
+
+def extract_page(markup: str) -> Tuple[str, Dict[str, str]]:
+    """Markdown text and metadata of one page. Runs in the worker processes."""
+    elements = top_level(parse_html(markup))
+    drop_skipped(elements)
+    return extract_markdown(elements), extract_metadata(elements)
+
+
+def content_hash(markup: str) -> str:
+    return hashlib.sha256(markup.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class ExtractionCache:
+    """Extracted pages by URL, valid while the page's hash or ETag is unchanged."""
+
+    def __init__(self, path: str, version: int = EXTRACTOR_VERSION):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.version = version
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " url TEXT PRIMARY KEY,"
+            " content_hash TEXT NOT NULL,"
+            " etag TEXT,"
+            " version INTEGER NOT NULL,"
+            " text TEXT NOT NULL,"
+            " metadata TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(
+        self, url: str, content_hash: Optional[str] = None, etag: Optional[str] = None
+    ) -> Optional[Tuple[str, Dict[str, str]]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content_hash, etag, version, text, metadata FROM pages WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None or row[2] != self.version:
+            return None
+        if (content_hash is not None and row[0] == content_hash) or (
+            etag is not None and row[1] == etag
+        ):
+            return row[3], json.loads(row[4])
+        return None
+
+    def put_many(
+        self, items: Sequence[Tuple[str, str, Optional[str], str, Dict[str, str]]]
+    ) -> None:
+        """Store (url, content_hash, etag, text, metadata) tuples."""
+        if not items:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO pages"
+                " (url, content_hash, etag, version, text, metadata)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (url, digest, etag, self.version, text, json.dumps(metadata))
+                    for url, digest, etag, text, metadata in items
+                ],
+            )
+
+
+def extract_pages(
+    pages: Iterable[Page],
+    cache: Optional[ExtractionCache] = None,
+    max_workers: Optional[int] = None,
+    window: Optional[int] = None,
+) -> Iterator[Tuple[str, str, Dict[str, str]]]:
+    """Yield (url, text, metadata) for each (url, html, etag) in input order.
+
+    Cache hits are served without parsing; the rest are extracted in a pool of
+    ``max_workers`` processes (in this process if it is 1), with at most
+    ``window`` pages in flight so ``pages`` can be a stream.
+    """
+    workers = max_workers or os.cpu_count() or 1
+    window = window or workers * 4
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    pending: deque = deque()
+    writes: list = []
+
+    def finish(item) -> Tuple[str, str, Dict[str, str]]:
+        url, digest, etag, result = item
+        if not isinstance(result, tuple):
+            result = result.result()
+            writes.append((url, digest, etag, *result))
+        return url, result[0], result[1]
+
+    try:
+        for url, html, etag in pages:
+            digest = content_hash(html)
+            result = cache.get(url, digest, etag) if cache is not None else None
+            if result is None:
+                if executor is None:
+                    result = extract_page(html)
+                    writes.append((url, digest, etag, *result))
+                else:
+                    result = executor.submit(extract_page, html)
+            pending.append((url, digest, etag, result))
+            while len(pending) > window or (pending and isinstance(pending[0][3], tuple)):
+                yield finish(pending.popleft())
+            if cache is not None and len(writes) >= 64:
+                cache.put_many(writes)
+                writes.clear()
+        while pending:
+            yield finish(pending.popleft())
+    finally:
+        if cache is not None:
+            cache.put_many(writes)
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def extract_documents(
+    pages: Iterable,
+    cache: Optional[ExtractionCache] = None,
+    max_workers: Optional[int] = None,
+) -> Iterator[Document]:
+    """Documents of crawled sitemap pages (``crawler.CrawledPage``).
+
+    Text and metadata are what ``SitemapLoader`` gives with
+    ``langchain_docs_extractor`` and ``ingest.metadata_extractor``. ``pages``
+    is consumed lazily, so a crawl that streams its pages is parsed while it
+    is still fetching.
+    """
+    queued = deque()
+
+    def items():
+        for page in pages:
+            queued.append(page)
+            yield page.url, page.html, page.etag
+
+    for _, text, metadata in extract_pages(items(), cache, max_workers):
+        page = queued.popleft()
+        yield Document(
+            page_content=text,
+            metadata={"source": page.sitemap.get("loc", page.url), **metadata, **page.sitemap},
+        )
@@ -0,0 +1,74 @@
+"""Dense vector search and BM25 keyword search, fused by reciprocal rank."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Tuple
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from keyword_index import KeywordIndex
+
+_keyword_pool = ThreadPoolExecutor(4, thread_name_prefix="keyword-search")
+
+
+def _doc_key(doc: Document) -> Tuple[str, str]:
+    # Both searches return the chunk's record id; documents without one are
+    # recognised by content.
+    if doc.id:
+        return "id", doc.id
+    return doc.metadata.get("source", ""), doc.page_content
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[Document]], k: int, rrf_k: int = 60
+) -> List[Document]:
+    """Top ``k`` documents by sum of ``1 / (rrf_k + rank)`` over the rankings."""
+    scores: Dict[Tuple[str, str], float] = {}
+    docs: Dict[Tuple[str, str], Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, 1):
+            key = _doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in best]
+
+
+class HybridRetriever(BaseRetriever):
+    """Runs ``dense`` and a BM25 search concurrently and fuses their rankings.
+
+    ``dense`` should return ``fetch_k`` documents; the keyword search does too.
+    """
+
+    dense: BaseRetriever
+    keywords: KeywordIndex
+    k: int = 6
+    fetch_k: int = 20
+    rrf_k: int = 60
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    def _keyword_search(self, query: str) -> List[Document]:
+        return [doc for doc, _ in self.keywords.search(query, self.fetch_k)]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        keyword = _keyword_pool.submit(self._keyword_search, query)
+        dense = self.dense.invoke(query, config={"callbacks": run_manager.get_child()})
+        return reciprocal_rank_fusion([dense, keyword.result()], self.k, self.rrf_k)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        dense, keyword = await asyncio.gather(
+            self.dense.ainvoke(query, config={"callbacks": run_manager.get_child()}),
+            asyncio.get_running_loop().run_in_executor(
+                _keyword_pool, self._keyword_search, query
+            ),
+        )
+        return reciprocal_rank_fusion([dense, keyword], self.k, self.rrf_k)
@@ -0,0 +1,169 @@
+"""Incremental re-ingest driven by per-source content fingerprints.
+
+Each source (the ``source`` metadata of the loaded documents) gets a fingerprint of
+its documents, stored in a sibling record-manager namespace. Sources whose
+fingerprint is already recorded, and whose chunks are still indexed, are skipped
+before splitting or embedding. Changed and new sources are split and handed to
+``index_documents`` with incremental cleanup, which only embeds chunks it has not
+seen and deletes the stale chunks of those sources. Work therefore scales with the
+size of the change, not the index.
+
+Sources missing from a run are left alone; use a ``cleanup="full"`` run to drop
+them.
+"""
+from dataclasses import asdict, dataclass, field
+from itertools import groupby
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from langchain.indexes import SQLRecordManager
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from indexing import document_uid, hash_to_uuid, index_documents
+from ingest_pipeline import prefetch
+
+Transform = Callable[[Iterable[Document]], Iterable[Document]]
+
+
+@dataclass
+class IngestReport:
+    """What an incremental ingest would do (or did) to the index."""
+
+    sources_unchanged: int = 0
+    sources_added: List[str] = field(default_factory=list)
+    sources_updated: List[str] = field(default_factory=list)
+    chunks_to_add: int = 0
+    chunks_to_delete: int = 0
+    chunks_unchanged: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def get_source_record_manager(record_manager: SQLRecordManager) -> SQLRecordManager:
+    """Record manager holding one fingerprint per source, next to the chunks."""
+    source_records = SQLRecordManager(
+        f"{record_manager.namespace}/sources", engine=record_manager.engine
+    )
+    source_records.create_schema()
+    return source_records
+
+
+def forget_sources(record_manager: SQLRecordManager, source_ids: List[str]) -> None:
+    """Drop the fingerprints of ``source_ids``; the next run splits them again."""
+    source_records = get_source_record_manager(record_manager)
+    source_records.delete_keys(source_records.list_keys(group_ids=source_ids))
+
+
+def source_fingerprint(source_id: str, docs: List[Document]) -> str:
+    return hash_to_uuid(source_id + "".join(document_uid(doc) for doc in docs))
+
+
+def _changed_sources(
+    docs: Iterable[Document],
+    record_manager: SQLRecordManager,
+    source_records: SQLRecordManager,
+    source_id_key: str,
+    report: IngestReport,
+) -> Iterator[Tuple[str, str, List[Document]]]:
+    """Yield ``(source_id, fingerprint, docs)`` for sources that changed.
+
+    Loaders emit the documents of a source contiguously, so grouping consecutive
+    documents keeps memory bounded by the largest source.
+    """
+    for source_id, group in groupby(docs, key=lambda d: d.metadata.get(source_id_key)):
+        if source_id is None:
+            raise ValueError(f"Every document needs a '{source_id_key}' metadata key.")
+        source_docs = list(group)
+        fingerprint = source_fingerprint(source_id, source_docs)
+        # A recorded fingerprint only counts while the source still has chunks in
+        # the index; a full cleanup or clear_index.py leaves the fingerprints.
+        indexed = bool(record_manager.list_keys(group_ids=[source_id], limit=1))
+        if indexed and source_records.exists([fingerprint])[0]:
+            report.sources_unchanged += 1
+            continue
+        if indexed:
+            report.sources_updated.append(source_id)
+        else:
+            report.sources_added.append(source_id)
+        yield source_id, fingerprint, source_docs
+
+
+def plan_incremental_ingest(
+    docs: Iterable[Document],
+    transform: Transform,
+    record_manager: SQLRecordManager,
+    source_id_key: str = "source",
+) -> IngestReport:
+    """Dry run: report the adds, updates and deletes without writing anything."""
+    report = IngestReport()
+    source_records = get_source_record_manager(record_manager)
+    for source_id, _, source_docs in _changed_sources(
+        docs, record_manager, source_records, source_id_key, report
+    ):
+        new_uids = {document_uid(chunk) for chunk in transform(source_docs)}
+        old_uids = set(record_manager.list_keys(group_ids=[source_id]))
+        report.chunks_to_add += len(new_uids - old_uids)
+        report.chunks_to_delete += len(old_uids - new_uids)
+        report.chunks_unchanged += len(new_uids & old_uids)
+    return report
+
+
+def incremental_ingest(
+    docs: Iterable[Document],
+    transform: Transform,
+    record_manager: SQLRecordManager,
+    vectorstore: VectorStore,
+    source_id_key: str = "source",
+    prefetch_window: int = 0,
+    **index_kwargs,
+) -> dict:
+    """Embed, upsert and delete only what changed for the sources in ``docs``.
+
+    With ``prefetch_window`` set, fingerprinting and splitting run in a background
+    thread ahead of indexing. Returns the ``index_documents`` stats plus the number
+    of unchanged, added and updated sources.
+    """
+    report = IngestReport()
+    source_records = get_source_record_manager(record_manager)
+    fingerprints: List[Tuple[str, str]] = []
+    changed_source_ids: List[str] = []
+
+    def changed_chunks() -> Iterator[Document]:
+        for source_id, fingerprint, source_docs in _changed_sources(
+            docs, record_manager, source_records, source_id_key, report
+        ):
+            fingerprints.append((fingerprint, source_id))
+            changed_source_ids.append(source_id)
+            yield from transform(source_docs)
+
+    chunks = changed_chunks()
+    if prefetch_window:
+        chunks = prefetch(chunks, prefetch_window)
+    stats = index_documents(
+        chunks,
+        record_manager,
+        vectorstore,
+        cleanup="incremental",
+        source_id_key=source_id_key,
+        # A changed source whose chunks are all filtered out or dropped as
+        # near-duplicates still needs its old chunks deleted.
+        cleanup_sources=changed_source_ids,
+        **index_kwargs,
+    )
+
+    # Record the new fingerprints only once their chunks are indexed, then drop
+    # the fingerprints of the previous versions of those sources.
+    if fingerprints:
+        update_start = source_records.get_time()
+        keys, source_ids = zip(*fingerprints)
+        source_records.update(list(keys), group_ids=list(source_ids))
+        stale = source_records.list_keys(
+            group_ids=list(source_ids), before=update_start
+        )
+        source_records.delete_keys(stale)
+
+    stats["sources_unchanged"] = report.sources_unchanged
+    stats["sources_added"] = len(report.sources_added)
+    stats["sources_updated"] = len(report.sources_updated)
+    return stats
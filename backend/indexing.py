@@ -0,0 +1,289 @@
+"""Concurrent indexing engine, a drop-in for ``langchain.indexes.index``.
+
+Embedding requests for several batches are in flight at once, bounded by
+``embed_concurrency`` and an optional requests-per-second limit so provider quotas
+are respected. A single writer thread imports the embedded batches into the vector
+store in order while later batches are still being embedded. Every embedding call
+and every write is retried with exponential backoff before the run is aborted.
+
+Record ids are computed exactly like ``index()`` does, so indexes built by either
+can be maintained by the other.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, List, Literal, Optional, Sequence, Set, TypeVar
+
+from langchain_community.vectorstores import Weaviate
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.indexing import RecordManager
+from langchain_core.vectorstores import VectorStore
+from weaviate.batch import Batch
+
+from ingest_pipeline import batched
+from keyword_index import KeywordIndex
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+NAMESPACE_UUID = uuid.UUID(int=1984)
+
+# Provider quota knobs: concurrent embedding requests and requests per second.
+EMBED_CONCURRENCY = int(os.environ.get("EMBED_CONCURRENCY", "4"))
+EMBED_REQUESTS_PER_SECOND = float(os.environ.get("EMBED_REQUESTS_PER_SECOND", "0"))
+
+
+def hash_to_uuid(text: str) -> str:
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(NAMESPACE_UUID, digest))
+
+
+def document_uid(doc: Document) -> str:
+    """The record id ``index()`` assigns to a document: content + metadata hash."""
+    content_hash = hash_to_uuid(doc.page_content)
+    metadata_hash = hash_to_uuid(json.dumps(doc.metadata or {}, sort_keys=True))
+    return hash_to_uuid(content_hash + metadata_hash)
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls ``1 / requests_per_second`` apart."""
+
+    def __init__(self, requests_per_second: Optional[float]):
+        self._interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def with_retries(
+    func: Callable[[], T], max_retries: int, backoff: float, what: str
+) -> T:
+    """Call ``func``, retrying with exponential backoff and jitter on failure."""
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * (2**attempt) * (0.5 + random.random())
+            logger.warning(
+                f"{what} failed ({e}), retry {attempt + 1}/{max_retries} in {delay:.1f}s"
+            )
+            time.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+def write_embeddings(
+    vectorstore: VectorStore,
+    docs: Sequence[Document],
+    vectors: Sequence[List[float]],
+    ids: Sequence[str],
+) -> None:
+    """Write pre-computed vectors without embedding the texts again."""
+    if hasattr(vectorstore, "add_embeddings"):
+        vectorstore.add_embeddings(
+            [(doc.page_content, vector) for doc, vector in zip(docs, vectors)],
+            metadatas=[doc.metadata for doc in docs],
+            ids=list(ids),
+        )
+    elif isinstance(vectorstore, Weaviate):
+        # Same objects Weaviate.add_texts would create, with our vectors attached.
+        # A batch of our own rather than the client's: ingestion jobs for other
+        # indexes share the client and would share its buffer and flushes.
+        with Batch(vectorstore._client._connection) as batch:
+            for doc, vector, _id in zip(docs, vectors, ids):
+                batch.add_data_object(
+                    data_object={vectorstore._text_key: doc.page_content, **doc.metadata},
+                    class_name=vectorstore._index_name,
+                    uuid=_id,
+                    vector=vector,
+                )
+    else:
+        vectorstore.add_documents(list(docs), ids=list(ids))
+
+
+def index_documents(
+    docs: Iterable[Document],
+    record_manager: RecordManager,
+    vectorstore: VectorStore,
+    *,
+    batch_size: int = 64,
+    cleanup: Optional[Literal["incremental", "full"]] = None,
+    source_id_key: Optional[str] = None,
+    force_update: bool = False,
+    embeddings: Optional[Embeddings] = None,
+    embed_concurrency: int = EMBED_CONCURRENCY,
+    requests_per_second: Optional[float] = EMBED_REQUESTS_PER_SECOND,
+    max_retries: int = 3,
+    retry_backoff: float = 1.0,
+    cleanup_batch_size: int = 1000,
+    keyword_index: Optional[KeywordIndex] = None,
+    cleanup_sources: Optional[Iterable[str]] = None,
+) -> dict:
+    """Index ``docs`` like ``index()``, embedding batches concurrently.
+
+    Returns the usual ``num_added``/``num_updated``/``num_skipped``/``num_deleted``
+    stats plus ``num_chunks``, ``elapsed_seconds`` and ``chunks_per_second``.
+
+    Unlike ``index()``, incremental cleanup runs once at the end for every source
+    seen, so chunks of one source spread over several batches are never deleted
+    and re-added mid-run. ``cleanup_sources`` adds sources to that cleanup even
+    if they yield no chunks (all filtered out); it is read only once ``docs`` is
+    consumed, so it may be filled while they are produced.
+
+    ``keyword_index`` is kept in step with the vector store: written chunks are
+    added, deleted ones removed, and unchanged chunks it is missing are added
+    without being embedded again.
+    """
+    if cleanup not in (None, "incremental", "full"):
+        raise ValueError("cleanup should be one of 'incremental', 'full' or None.")
+    if cleanup == "incremental" and source_id_key is None:
+        raise ValueError("Source id key is required when cleanup mode is incremental.")
+    embeddings = embeddings or vectorstore.embeddings
+    if embeddings is None:
+        raise ValueError("An embeddings model is required to index documents.")
+
+    started = time.monotonic()
+    index_start_dt = record_manager.get_time()
+    stats = {"num_added": 0, "num_updated": 0, "num_skipped": 0, "num_deleted": 0}
+    num_chunks = 0
+    touched_sources: Set[str] = set()
+
+    rate_limiter = RateLimiter(requests_per_second)
+    # Bounds the number of batches between "read from docs" and "written".
+    in_flight = threading.BoundedSemaphore(embed_concurrency * 2)
+    failed = threading.Event()
+    embed_pool = ThreadPoolExecutor(embed_concurrency, thread_name_prefix="embed")
+    write_pool = ThreadPoolExecutor(1, thread_name_prefix="write")
+    writes: List[Future] = []
+
+    def embed(texts: List[str]) -> List[List[float]]:
+        def call():
+            rate_limiter.acquire()
+            return embeddings.embed_documents(texts)
+
+        return with_retries(call, max_retries, retry_backoff, "Embedding batch")
+
+    def write(
+        embedded: Future, docs_to_index, uids, all_uids, source_ids, backfill
+    ) -> None:
+        try:
+            if failed.is_set():
+                return
+            if docs_to_index:
+                vectors = embedded.result()
+                with_retries(
+                    lambda: write_embeddings(vectorstore, docs_to_index, vectors, uids),
+                    max_retries,
+                    retry_backoff,
+                    "Vector store write",
+                )
+            if keyword_index is not None:
+                keyword_index.add(
+                    uids + [uid for uid, _ in backfill],
+                    docs_to_index + [doc for _, doc in backfill],
+                )
+            # Only record documents once they are safely in the vector store.
+            record_manager.update(
+                all_uids, group_ids=source_ids, time_at_least=index_start_dt
+            )
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            in_flight.release()
+
+    try:
+        for doc_batch in batched(docs, batch_size):
+            if failed.is_set():
+                break
+            num_chunks += len(doc_batch)
+            unique = {}
+            for doc in doc_batch:
+                unique.setdefault(document_uid(doc), doc)
+            stats["num_skipped"] += len(doc_batch) - len(unique)
+            all_uids = list(unique)
+            source_ids = [
+                doc.metadata.get(source_id_key) if source_id_key else None
+                for doc in unique.values()
+            ]
+            if cleanup == "incremental":
+                if any(source_id is None for source_id in source_ids):
+                    raise ValueError(
+                        "Source ids are required when cleanup mode is incremental."
+                    )
+                touched_sources.update(source_ids)
+
+            uids, docs_to_index, uids_to_refresh = [], [], []
+            for uid, exists in zip(all_uids, record_manager.exists(all_uids)):
+                if exists and not force_update:
+                    uids_to_refresh.append(uid)
+                    continue
+                stats["num_updated" if exists else "num_added"] += 1
+                uids.append(uid)
+                docs_to_index.append(unique[uid])
+            if uids_to_refresh:
+                record_manager.update(uids_to_refresh, time_at_least=index_start_dt)
+                stats["num_skipped"] += len(uids_to_refresh)
+            backfill = [
+                (uid, unique[uid])
+                for uid in uids_to_refresh
+                if keyword_index is not None and uid not in keyword_index
+            ]
+
+            in_flight.acquire()
+            if docs_to_index:
+                embedded = embed_pool.submit(
+                    embed, [doc.page_content for doc in docs_to_index]
+                )
+            else:
+                embedded = Future()
+                embedded.set_result([])
+            writes.append(
+                write_pool.submit(
+                    write, embedded, docs_to_index, uids, all_uids, source_ids, backfill
+                )
+            )
+            writes = [w for w in writes if not w.done() or w.exception() is not None]
+        for w in writes:
+            w.result()
+    finally:
+        embed_pool.shutdown(wait=True, cancel_futures=True)
+        write_pool.shutdown(wait=True, cancel_futures=True)
+
+    if cleanup is not None:
+        if cleanup_sources is not None:
+            touched_sources.update(cleanup_sources)
+        group_ids = list(touched_sources) if cleanup == "incremental" else None
+        if cleanup == "full" or group_ids:
+            while uids_to_delete := record_manager.list_keys(
+                group_ids=group_ids, before=index_start_dt, limit=cleanup_batch_size
+            ):
+                vectorstore.delete(uids_to_delete)
+                if keyword_index is not None:
+                    keyword_index.delete(uids_to_delete)
+                record_manager.delete_keys(uids_to_delete)
+                stats["num_deleted"] += len(uids_to_delete)
+
+    elapsed = time.monotonic() - started
+    stats["num_chunks"] = num_chunks
+    stats["elapsed_seconds"] = round(elapsed, 3)
+    stats["chunks_per_second"] = round(num_chunks / elapsed, 1) if elapsed else 0.0
+    return stats
@@ -3,30 +3,48 @@ import logging
 import os
 import re
 from pathlib import Path
+from typing import Optional
 
 from regex import B
 from vector_store_manage import VectorStoreManager
-from parser import langchain_docs_extractor
+from crawler import Crawler, ResponseStore
+from html_extract import ExtractionCache, extract_documents
+from indexing import index_documents
+from ingest_pipeline import prefetch, transform_documents
+from markdown_splitter import get_text_splitter
+from near_dedup import get_near_duplicate_filter
+from incremental_ingest import incremental_ingest, plan_incremental_ingest
 from beir import util
 
 
-from bs4 import BeautifulSoup, SoupStrainer
+from bs4 import BeautifulSoup
 from constants import WEAVIATE_DOCS_INDEX_NAME, WEAVIATE_WANG_DEATH_BOOK, WEAVIATE_SCIFACT_INDEX_NAME
-from langchain.indexes import SQLRecordManager, index
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.indexes import SQLRecordManager
 from langchain.utils.html import PREFIXES_TO_IGNORE_REGEX, SUFFIXES_TO_IGNORE_REGEX
 # from langchain_openai import OpenAIEmbeddings
 from langchain.document_loaders import (
-    RecursiveUrlLoader,
-    SitemapLoader,
     TextLoader,
     JSONLoader,
 )
+from langchain_core.documents import Document
 
 root_dir = Path(__file__).parent.parent
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 BATCH_SIZE = 64
+# Number of batches that loading/splitting may run ahead of embedding/writing.
+INGEST_WINDOW = int(os.environ.get("INGEST_WINDOW", "4"))
+# Processes extracting Markdown from doc pages; extracted pages are cached by
+# URL and content hash.
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+EXTRACT_CACHE_PATH = os.environ.get(
+    "EXTRACT_CACHE_PATH", str(root_dir / ".cache" / "html_extract.sqlite")
+)
+# Responses of previous crawls, revalidated with conditional GETs.
+CRAWL_STORE_PATH = os.environ.get("CRAWL_STORE_PATH", str(root_dir / ".cache" / "crawl.sqlite"))
+# Pages in flight per crawl; per-host limits, retries and robots.txt are set by
+# the CRAWL_* variables read in crawler.get_crawl_client.
+CRAWL_CONCURRENCY = int(os.environ.get("CRAWL_CONCURRENCY", "16"))
 vector_store_manager = VectorStoreManager()
 
 
@@ -43,38 +61,63 @@ def metadata_extractor(meta: dict, soup: BeautifulSoup) -> dict:
     }
 
 
-def load_langchain_docs():
-    langchain_docs = SitemapLoader(
+def get_crawler() -> Crawler:
+    return Crawler(ResponseStore(CRAWL_STORE_PATH), concurrency=CRAWL_CONCURRENCY)
+
+
+def _loader_crawler(changed_only: bool, crawler: Optional[Crawler]) -> Crawler:
+    if crawler is not None:
+        return crawler
+    if changed_only:
+        # Nobody could acknowledge its pages: they would be "changed" forever.
+        raise ValueError("changed_only needs a crawler, acknowledged once the docs are ingested")
+    return get_crawler()
+
+
+# The loaders below crawl through the response store: pages whose sitemap
+# lastmod is unchanged are not requested, the rest are revalidated with
+# conditional GETs. Pages are extracted as they arrive, while the crawl goes on.
+# With ``changed_only`` they return the documents of new and changed pages only,
+# for an incremental ingest (a full-cleanup ingest would delete the others).
+# "Changed" is relative to the last ingest acknowledged, so ``changed_only``
+# needs a ``crawler`` on which to call ``crawler.acknowledge()`` once
+# index_documents() has returned; pages of a failed ingest are handed over again
+# by the next run.
+
+
+def load_langchain_docs(changed_only: bool = False, crawler: Optional[Crawler] = None):
+    # Same documents as SitemapLoader(parsing_function=langchain_docs_extractor,
+    # meta_function=metadata_extractor), extracted in parallel with lxml.
+    crawler = _loader_crawler(changed_only, crawler)
+    pages = crawler.sitemap(
         "https://python.langchain.com/sitemap.xml",
         filter_urls=["https://python.langchain.com/"],
-        parsing_function=langchain_docs_extractor,
-        default_parser="lxml",
-        bs_kwargs={
-            "parse_only": SoupStrainer(
-                name=("article", "title", "html", "lang", "content")
-            ),
-        },
-        meta_function=metadata_extractor,
-    ).load()
+    )
+    langchain_docs = list(
+        extract_documents(
+            (page for page in pages if page.changed or not changed_only),
+            cache=ExtractionCache(EXTRACT_CACHE_PATH),
+            max_workers=EXTRACT_WORKERS,
+        )
+    )
+    logger.info(f"Crawled python.langchain.com: {crawler.stats.to_dict()}")
     return langchain_docs
 
 
-def load_langsmith_docs():
-    langsmith_docs = RecursiveUrlLoader(
-        url="https://docs.smith.langchain.com/",
+def load_langsmith_docs(changed_only: bool = False, crawler: Optional[Crawler] = None):
+    crawler = _loader_crawler(changed_only, crawler)
+    pages = crawler.recursive(
+        "https://docs.smith.langchain.com/",
         max_depth=2,
-        extractor=simple_extractor,
-        prevent_outside=True,
-        use_async=True,
-        timeout=600,
         # Drop trailing / to avoid duplicate pages.
         link_regex=(
             f"href=[\"']{PREFIXES_TO_IGNORE_REGEX}((?:{SUFFIXES_TO_IGNORE_REGEX}.)*?)"
             r"(?:[\#'\"]|\/[\#'\"])"
         ),
-        check_response_status=True,
-    ).load()
-    return langsmith_docs
+    )
+    docs = crawled_documents(pages, changed_only)
+    logger.info(f"Crawled docs.smith.langchain.com: {crawler.stats.to_dict()}")
+    return docs
 
 
 def simple_extractor(html: str) -> str:
@@ -82,26 +125,53 @@ def simple_extractor(html: str) -> str:
     return re.sub(r"\n\n+", "\n\n", soup.text).strip()
 
 
-def load_api_docs():
-    api_docs = RecursiveUrlLoader(
-        url="https://api.python.langchain.com/en/latest/",
+def url_metadata_extractor(raw_html: str, url: str, content_type: str) -> dict:
+    # The metadata RecursiveUrlLoader gives its documents by default.
+    metadata = {"source": url, "content_type": content_type}
+    soup = BeautifulSoup(raw_html, "html.parser")
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", None)
+    if html := soup.find("html"):
+        metadata["language"] = html.get("lang", None)
+    return metadata
+
+
+def crawled_documents(pages, changed_only: bool = False):
+    docs = []
+    for page in pages:
+        if changed_only and not page.changed:
+            continue
+        content = simple_extractor(page.html)
+        if content:
+            docs.append(
+                Document(
+                    page_content=content,
+                    metadata=url_metadata_extractor(page.html, page.url, page.content_type),
+                )
+            )
+    return docs
+
+
+def load_api_docs(changed_only: bool = False, crawler: Optional[Crawler] = None):
+    crawler = _loader_crawler(changed_only, crawler)
+    pages = crawler.recursive(
+        "https://api.python.langchain.com/en/latest/",
         max_depth=2,
-        extractor=simple_extractor,
-        prevent_outside=True,
-        use_async=True,
-        timeout=600,
         # Drop trailing / to avoid duplicate pages.
         link_regex=(
             f"href=[\"']{PREFIXES_TO_IGNORE_REGEX}((?:{SUFFIXES_TO_IGNORE_REGEX}.)*?)"
             r"(?:[\#'\"]|\/[\#'\"])"
         ),
-        check_response_status=True,
         exclude_dirs=(
             "https://api.python.langchain.com/en/latest/_sources",
             "https://api.python.langchain.com/en/latest/_modules",
         ),
-    ).load()
-    return api_docs
+    )
+    docs = crawled_documents(pages, changed_only)
+    logger.info(f"Crawled api.python.langchain.com: {crawler.stats.to_dict()}")
+    return docs
 
 def load_docs_from_book(path: str) -> dict:
     base = Path(path)
@@ -200,8 +270,10 @@ def load_docs_from_book(path: str) -> dict:
 
 def load_json_docs(path: str):
     def metadata_func(json_obj, default_metadata):
+        # One source per corpus entry (and no seq_num), so incremental ingests can
+        # fingerprint and diff entries individually.
         return {
-            **default_metadata,
+            "source": f"{default_metadata['source']}#{json_obj['_id']}",
             "corpus_id": json_obj["_id"],
             "title": json_obj["title"],
         }
@@ -213,19 +285,27 @@ def load_json_docs(path: str):
         metadata_func=metadata_func,
         json_lines=True
     )
-    docs = loader.load()
+    # Stream one line at a time instead of materializing the whole corpus.
+    return loader.lazy_load()
 
-    return docs
+def ingest_docs(index_name: str, incremental: bool = False, dry_run: bool = False):
+    """Index the corpus into ``index_name``.
 
-def ingest_docs(index_name: str):
+    By default the index is fully reconciled with the corpus (cleanup="full").
+    With ``incremental`` only sources whose content fingerprint changed are split,
+    embedded and upserted, and their stale chunks deleted; ``dry_run`` only logs
+    the adds/updates/deletes an incremental ingest would make.
+    """
     # 使用统一的连接管理
     RECORD_MANAGER_DB_URL = os.environ["RECORD_MANAGER_DB_URL"]
 
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=4000, chunk_overlap=200)
+    text_splitter = get_text_splitter()
     
     # 使用单例连接创建vector store
     vectorstore = vector_store_manager.get_vector_store(index_name)
     # vectorstore = get_vectorstore(index_name)
+    # BM25 index for hybrid search, updated together with the vector store
+    keyword_index = vector_store_manager.get_keyword_index(index_name)
 
     record_manager = SQLRecordManager(
         # f"weaviate/{WEAVIATE_DOCS_INDEX_NAME}", db_url=RECORD_MANAGER_DB_URL
@@ -255,31 +335,59 @@ def ingest_docs(index_name: str):
     # docs_transformed = [doc for doc in book_docs_transformed if len(doc.page_content) > 10]
     path = "/home/yani/projects/chat-llm/datasets/scifact/corpus.jsonl"
     beir_docs = load_json_docs(path)
-    logger.info(f"Loaded {len(beir_docs)} docs from beir")
-    docs_transformed = text_splitter.split_documents(beir_docs)
-    docs_transformed = [doc for doc in docs_transformed if len(doc.page_content) > 10]
-
-    # We try to return 'source' and 'title' metadata when querying vector store and
-    # Weaviate will error at query time if one of the attributes is missing from a
-    # retrieved document.
-    for doc in docs_transformed:
-        if "source" not in doc.metadata:
-            doc.metadata["source"] = ""
-        if "title" not in doc.metadata:
-            doc.metadata["title"] = ""
-
-    indexing_stats = index(
-        docs_transformed,
-        record_manager,
-        vectorstore,
-        batch_size=BATCH_SIZE,
-        cleanup="full",
-        source_id_key="source",
-        force_update=(os.environ.get("FORCE_UPDATE") or "false").lower() == "true",
-    )
+    logger.info(f"Streaming docs from beir corpus {path}")
+
+    # Near-duplicate chunks are dropped before embedding: within the run, and in
+    # an incremental ingest also against the chunks already indexed. Sources whose
+    # dropped chunks duplicated a chunk deleted since are re-split by the next run.
+    dedup = get_near_duplicate_filter(record_manager, record=not dry_run)
+    if dedup is not None and not (incremental or dry_run):
+        dedup.reset()
+
+    def transform(docs):
+        return transform_documents(docs, text_splitter, dedup.filter if dedup else None)
+
+    if dry_run:
+        report = plan_incremental_ingest(beir_docs, transform, record_manager)
+        logger.info(f"Dry run, nothing written: {report.to_dict()}")
+        if dedup is not None:
+            logger.info(f"Near-duplicate chunks: {dedup.stats}")
+        return report
+
+    if incremental:
+        indexing_stats = incremental_ingest(
+            beir_docs,
+            transform,
+            record_manager,
+            vectorstore,
+            prefetch_window=INGEST_WINDOW * BATCH_SIZE,
+            batch_size=BATCH_SIZE,
+            keyword_index=keyword_index,
+        )
+    else:
+        # load -> split -> metadata-fill -> filter runs in a background thread, at
+        # most INGEST_WINDOW batches ahead of index_documents(), which batches,
+        # embeds and writes.
+        docs_transformed = prefetch(
+            transform(beir_docs), window=INGEST_WINDOW * BATCH_SIZE
+        )
+        indexing_stats = index_documents(
+            docs_transformed,
+            record_manager,
+            vectorstore,
+            batch_size=BATCH_SIZE,
+            cleanup="full",
+            source_id_key="source",
+            force_update=(os.environ.get("FORCE_UPDATE") or "false").lower() == "true",
+            keyword_index=keyword_index,
+        )
 
     logger.info(f"Indexing stats: {indexing_stats}")
-    num_vecs = vectorstore.client.query.aggregate(index_name).with_meta_count().do()
+    if dedup is not None:
+        dedup.invalidate_dependents()
+        logger.info(f"Near-duplicate chunks: {dedup.stats}")
+    logger.info(f"Embedding cache: {vectorstore.embeddings.cache_info()}")
+    num_vecs = vector_store_manager.count(index_name)
     logger.info(
         f"LangChain now has this many vectors: {num_vecs}",
     )
@@ -296,7 +404,11 @@ if __name__ == "__main__":
 
     # print(f"{Path(__file__).parent.parent}")
 
-    ingest_docs(index_name=WEAVIATE_SCIFACT_INDEX_NAME)
+    ingest_docs(
+        index_name=WEAVIATE_SCIFACT_INDEX_NAME,
+        incremental=(os.environ.get("INCREMENTAL") or "false").lower() == "true",
+        dry_run=(os.environ.get("DRY_RUN") or "false").lower() == "true",
+    )
 
     print(1)
 
@@ -0,0 +1,135 @@
+"""Background ingestion jobs for knowledge uploads.
+
+Uploads are queued and run on a dedicated, bounded thread pool so that loading,
+embedding and LLM calls never block the event loop serving /chat streams. Jobs for
+the same index are limited to ``max_jobs_per_index`` at a time; the rest wait in a
+per-index queue without holding a worker.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the number of unfinished jobs reaches the queue depth."""
+
+
+@dataclass
+class IngestionJob:
+    url: str
+    index_name: str
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    # queued -> loading -> splitting -> indexing -> generating_questions -> done
+    # Any stage may end in "failed".
+    stage: str = "queued"
+    num_docs: int = 0
+    num_chunks: int = 0
+    indexing_stats: Optional[dict] = None
+    title: Optional[str] = None
+    example_questions: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in ("done", "failed")
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class IngestionJobQueue:
+    def __init__(
+        self,
+        handler: Callable[[IngestionJob], None],
+        max_workers: int = 2,
+        max_queue_depth: int = 32,
+        max_jobs_per_index: int = 1,
+        max_finished_jobs: int = 1000,
+    ):
+        self._handler = handler
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ingest"
+        )
+        self.max_queue_depth = max_queue_depth
+        self.max_jobs_per_index = max_jobs_per_index
+        self.max_finished_jobs = max_finished_jobs
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._waiting: Dict[str, Deque[IngestionJob]] = {}
+        self._running: Dict[str, int] = {}
+        self._unfinished = 0
+
+    def submit(self, url: str, index_name: str) -> IngestionJob:
+        job = IngestionJob(url=url, index_name=index_name)
+        with self._lock:
+            if self._unfinished >= self.max_queue_depth:
+                raise QueueFullError(
+                    f"{self._unfinished} ingestion jobs are already pending"
+                )
+            self._unfinished += 1
+            self._jobs[job.job_id] = job
+            self._forget_finished_jobs()
+            if self._running.get(index_name, 0) < self.max_jobs_per_index:
+                self._start(job)
+            else:
+                self._waiting.setdefault(index_name, deque()).append(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "unfinished": self._unfinished,
+                "running": sum(self._running.values()),
+                "waiting": sum(len(jobs) for jobs in self._waiting.values()),
+            }
+
+    def _start(self, job: IngestionJob) -> None:
+        # Called with the lock held.
+        self._running[job.index_name] = self._running.get(job.index_name, 0) + 1
+        self._executor.submit(self._run, job)
+
+    def _run(self, job: IngestionJob) -> None:
+        job.started_at = time.time()
+        try:
+            self._handler(job)
+            job.stage = "done"
+        except Exception as e:
+            logger.exception(f"Ingestion job {job.job_id} for {job.url} failed")
+            job.error = str(e)
+            job.stage = "failed"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._unfinished -= 1
+                self._running[job.index_name] -= 1
+                waiting = self._waiting.get(job.index_name)
+                if waiting:
+                    self._start(waiting.popleft())
+                    if not waiting:
+                        del self._waiting[job.index_name]
+                elif not self._running[job.index_name]:
+                    del self._running[job.index_name]
+
+    def _forget_finished_jobs(self) -> None:
+        # Called with the lock held. Keeps status lookups for recent jobs only.
+        excess = len(self._jobs) - self._unfinished - self.max_finished_jobs
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished][
+            :excess
+        ]:
+            del self._jobs[job_id]
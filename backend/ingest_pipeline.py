@@ -0,0 +1,107 @@
+"""Streaming stages for the ingest pipeline.
+
+load -> split -> metadata-fill -> filter -> dedup -> batch -> embed -> write
+
+Every stage is a generator, so only the documents currently in flight are held in
+memory no matter how large the corpus is. ``prefetch`` runs the upstream stages in
+a background thread, so loading and splitting batch N+1 overlaps with embedding and
+writing batch N.
+"""
+import queue
+import threading
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, TypeVar
+
+from langchain_core.documents import Document
+from langchain.text_splitter import TextSplitter
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+def split_documents(
+    docs: Iterable[Document], text_splitter: TextSplitter
+) -> Iterator[Document]:
+    """Split documents one at a time instead of materializing every chunk."""
+    for doc in docs:
+        yield from text_splitter.split_documents([doc])
+
+
+def fill_metadata(docs: Iterable[Document]) -> Iterator[Document]:
+    # We try to return 'source' and 'title' metadata when querying vector store and
+    # Weaviate will error at query time if one of the attributes is missing from a
+    # retrieved document.
+    for doc in docs:
+        if "source" not in doc.metadata:
+            doc.metadata["source"] = ""
+        if "title" not in doc.metadata:
+            doc.metadata["title"] = ""
+        yield doc
+
+
+def filter_short(docs: Iterable[Document], min_length: int = 10) -> Iterator[Document]:
+    for doc in docs:
+        if len(doc.page_content) > min_length:
+            yield doc
+
+
+def batched(items: Iterable[T], batch_size: int) -> Iterator[List[T]]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def prefetch(items: Iterable[T], window: int) -> Iterator[T]:
+    """Produce ``items`` in a background thread, at most ``window`` ahead.
+
+    Exceptions raised by the producer are re-raised in the consumer. If the consumer
+    stops early, the producer is released and exits at its next item.
+    """
+    buffer: "queue.Queue" = queue.Queue(maxsize=max(window, 1))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, name="ingest-prefetch", daemon=True)
+    producer.start()
+    try:
+        while (item := buffer.get()) is not _DONE:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def transform_documents(
+    docs: Iterable[Document],
+    text_splitter: TextSplitter,
+    dedup: Optional[Callable[[Iterable[Document]], Iterator[Document]]] = None,
+    min_length: Optional[int] = 10,
+) -> Iterator[Document]:
+    """The split -> metadata-fill -> filter -> dedup part of the pipeline.
+
+    ``dedup`` is a stage such as ``near_dedup.NearDuplicateFilter.filter``.
+    ``min_length=None`` keeps short chunks.
+    """
+    docs = fill_metadata(split_documents(docs, text_splitter))
+    if min_length is not None:
+        docs = filter_short(docs, min_length)
+    return dedup(docs) if dedup is not None else docs
@@ -0,0 +1,435 @@
+"""BM25 inverted index over chunk text, kept next to each vector index.
+
+Every chunk gets an increasing integer doc number. Each write adds one immutable
+segment file holding, for every term of the batch, its 64-bit hash (in a sorted
+array searched with ``np.searchsorted``), the doc numbers containing it
+(delta-encoded varints, mostly one byte each) and the term frequencies (uint8).
+Segment files are memory-mapped, and encoding, decoding and merging work on whole
+arrays rather than term by term. Segments are merged log-structured (eight
+segments of the same size tier become one), and merging drops deleted documents.
+Text, ids and metadata live in SQLite, next to the registry of segments.
+
+Tokens are lowercased words and dotted identifiers, so API symbols such as
+``langchain.text_splitter`` or claim ids match as typed, plus unigrams and bigrams
+of CJK characters.
+"""
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Merge when a size tier (number of documents, in powers of MERGE_FACTOR) holds
+# this many segments.
+MERGE_FACTOR = 8
+
+_TOKEN = re.compile(r"[0-9a-z_]+(?:\.[0-9a-z_]+)*|[\u4e00-\u9fff]+")
+_HEADER_FIELDS = 3
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for match in _TOKEN.findall(text.lower()):
+        if match[0] >= "\u4e00":
+            tokens.extend(match)
+            tokens.extend(match[i : i + 2] for i in range(len(match) - 1))
+        else:
+            tokens.append(match)
+            if "." in match:
+                tokens.extend(match.split("."))
+    return tokens
+
+
+@functools.lru_cache(maxsize=1 << 18)
+def term_hash(term: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def varint_encode(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """LEB128 bytes of non-negative ``values``, and the offset of each value."""
+    values = values.astype(np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        sizes += values >= np.uint64(1 << shift)
+    offsets = np.cumsum(sizes) - sizes
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    for k in range(int(sizes.max()) if len(values) else 0):
+        selected = np.flatnonzero(sizes > k)
+        low = (values[selected] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (sizes[selected] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[offsets[selected] + k] = low | more
+    return out, offsets
+
+
+def varint_decode(data: np.ndarray) -> np.ndarray:
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.int64)
+    last = data < 0x80
+    if last.all():
+        # Frequent terms, whose doc numbers are close together.
+        return data.astype(np.int64)
+    ends = np.flatnonzero(last) + 1
+    starts = np.concatenate([[0], ends[:-1]])
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts)
+    parts = (data & 0x7F).astype(np.int64) << (7 * position)
+    return np.add.reduceat(parts, starts)
+
+
+def run_cumsum(deltas: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Cumulative sums of ``deltas`` restarting at every run of ``lengths``."""
+    if not len(deltas):
+        return deltas
+    lengths = lengths[lengths > 0]
+    starts = np.cumsum(lengths) - lengths
+    totals = np.cumsum(deltas)
+    return totals - np.repeat(totals[starts] - deltas[starts], lengths)
+
+
+class Segment:
+    """One memory-mapped segment file.
+
+    Layout: the number of terms, entries and doc bytes (int64), the sorted term
+    hashes, each term's first doc byte and first entry, the uint8 term frequencies
+    and the varint doc numbers.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        header = data[: 8 * _HEADER_FIELDS].view(np.int64)
+        num_terms, num_entries, doc_bytes = (int(v) for v in header)
+        position = 8 * _HEADER_FIELDS
+
+        def take(count: int, dtype) -> np.ndarray:
+            nonlocal position
+            size = count * np.dtype(dtype).itemsize
+            array = data[position : position + size].view(dtype)
+            position += size
+            return array
+
+        self.hashes = take(num_terms, np.uint64)
+        self.doc_offsets = take(num_terms + 1, np.int64)
+        self.entry_offsets = take(num_terms + 1, np.int64)
+        self.tfs = take(num_entries, np.uint8)
+        self.docs = take(doc_bytes, np.uint8)
+
+    @staticmethod
+    def write(path: str, hashes: np.ndarray, docs: np.ndarray, tfs: np.ndarray) -> None:
+        """Write (term hash, doc, tf) entries, in any order, as a segment file."""
+        order = np.lexsort((docs, hashes))
+        hashes, docs, tfs = hashes[order], docs[order], tfs[order]
+        starts = np.flatnonzero(np.concatenate([[True], hashes[1:] != hashes[:-1]]))
+        starts = starts[: len(hashes)]
+        deltas = np.diff(docs, prepend=0)
+        deltas[starts] = docs[starts]
+        encoded, byte_offsets = varint_encode(deltas)
+        header = np.array([len(starts), len(docs), len(encoded)], dtype=np.int64)
+        with open(path + ".tmp", "wb") as f:
+            for array in (
+                header,
+                hashes[starts].astype(np.uint64),
+                np.append(byte_offsets[starts], len(encoded)).astype(np.int64),
+                np.append(starts, len(docs)).astype(np.int64),
+                np.minimum(tfs, 255).astype(np.uint8),
+                encoded,
+            ):
+                f.write(array.tobytes())
+        os.replace(path + ".tmp", path)
+
+    def lookup(self, hashes: np.ndarray) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+        """(query term position, docs, tfs) of each of ``hashes`` in the segment."""
+        found = []
+        if not len(self.hashes):
+            return found
+        positions = np.searchsorted(self.hashes, hashes)
+        for i, position in enumerate(positions.tolist()):
+            if position < len(self.hashes) and self.hashes[position] == hashes[i]:
+                docs = self.docs[self.doc_offsets[position] : self.doc_offsets[position + 1]]
+                tfs = self.tfs[self.entry_offsets[position] : self.entry_offsets[position + 1]]
+                found.append((i, np.cumsum(varint_decode(docs)), tfs))
+        return found
+
+    def entries(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Every (term hash, doc, tf) entry of the segment."""
+        lengths = np.diff(self.entry_offsets)
+        docs = run_cumsum(varint_decode(self.docs), lengths)
+        return np.repeat(self.hashes, lengths), docs, np.asarray(self.tfs)
+
+
+class KeywordIndex:
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        """Open (or create) the index stored in directory ``path``."""
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(path, "docs.sqlite"), check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            " num INTEGER PRIMARY KEY,"
+            " id TEXT NOT NULL UNIQUE,"
+            " length INTEGER NOT NULL,"
+            " text BLOB NOT NULL,"
+            " metadata TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            " segment INTEGER PRIMARY KEY, num_docs INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+
+        rows = self._conn.execute("SELECT num, id, length FROM docs").fetchall()
+        # Deleted documents may still have postings in unmerged segments, so doc
+        # numbers are never reused: the next one is persisted rather than derived.
+        stored = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'next_num'"
+        ).fetchone()
+        self._next_num = int(stored[0]) if stored else 0
+        self._lengths = np.zeros(self._next_num, dtype=np.float32)
+        self._live = np.zeros(self._next_num, dtype=bool)
+        self._id_to_num: Dict[str, int] = {}
+        for num, _id, length in rows:
+            self._lengths[num] = length
+            self._live[num] = True
+            self._id_to_num[_id] = num
+        self._total_length = float(self._lengths.sum())
+
+        self._segment_docs: Dict[int, int] = dict(
+            self._conn.execute("SELECT segment, num_docs FROM segments").fetchall()
+        )
+        for name in os.listdir(path):
+            if name.startswith("segment.") and self._segment_id(name) not in self._segment_docs:
+                # Left by a write or merge that did not commit, or merged away.
+                os.remove(os.path.join(path, name))
+        self._segments: Dict[int, Segment] = {
+            segment: Segment(self._segment_path(segment)) for segment in self._segment_docs
+        }
+        self._next_segment = max(self._segment_docs, default=0) + 1
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"segment.{segment}.bin")
+
+    @staticmethod
+    def _segment_id(name: str) -> int:
+        parts = name.split(".")
+        return int(parts[1]) if len(parts) == 3 and parts[1].isdigit() else -1
+
+    def __len__(self) -> int:
+        return len(self._id_to_num)
+
+    def __contains__(self, _id: str) -> bool:
+        return _id in self._id_to_num
+
+    # -- writes ---------------------------------------------------------------
+
+    def add(self, ids: Sequence[str], docs: Sequence[Document]) -> None:
+        """Index documents under their vector store ids; known ids are replaced."""
+        if not ids:
+            return
+        self.delete([_id for _id in ids if _id in self._id_to_num])
+        with self._lock:
+            start = self._next_num
+            self._next_num += len(ids)
+            segment = self._next_segment
+            self._next_segment += 1
+
+        entry_hashes: List[int] = []
+        entry_tfs: List[int] = []
+        terms_per_doc: List[int] = []
+        records = []
+        for num, (_id, doc) in enumerate(zip(ids, docs), start):
+            counts = Counter(tokenize(doc.page_content))
+            entry_hashes.extend(map(term_hash, counts))
+            entry_tfs.extend(counts.values())
+            terms_per_doc.append(len(counts))
+            records.append(
+                (
+                    num,
+                    _id,
+                    sum(counts.values()),
+                    zlib.compress(doc.page_content.encode("utf-8")),
+                    json.dumps(doc.metadata, ensure_ascii=False),
+                )
+            )
+        # The file is in place before the registry row that makes it visible.
+        Segment.write(
+            self._segment_path(segment),
+            np.asarray(entry_hashes, dtype=np.uint64),
+            np.repeat(np.arange(start, start + len(ids)), terms_per_doc),
+            np.asarray(entry_tfs, dtype=np.int64),
+        )
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO docs (num, id, length, text, metadata) VALUES (?, ?, ?, ?, ?)",
+                records,
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('next_num', ?)",
+                (str(self._next_num),),
+            )
+            self._conn.execute(
+                "INSERT INTO segments (segment, num_docs) VALUES (?, ?)", (segment, len(ids))
+            )
+            self._conn.commit()
+
+            # Searches hold on to the previous arrays, so replace rather than mutate.
+            size = max(self._next_num, len(self._live))
+            lengths = np.zeros(size, dtype=np.float32)
+            lengths[: len(self._lengths)] = self._lengths
+            live = np.zeros(size, dtype=bool)
+            live[: len(self._live)] = self._live
+            for num, _id, length, _, _ in records:
+                lengths[num] = length
+                live[num] = True
+                self._id_to_num[_id] = num
+                self._total_length += length
+            self._lengths, self._live = lengths, live
+            self._segments = {**self._segments, segment: Segment(self._segment_path(segment))}
+            self._segment_docs[segment] = len(ids)
+        self._maybe_merge()
+
+    def delete(self, ids: Iterable[str]) -> None:
+        with self._lock:
+            nums = [self._id_to_num.pop(_id) for _id in ids if _id in self._id_to_num]
+            if not nums:
+                return
+            self._conn.executemany("DELETE FROM docs WHERE num = ?", [(n,) for n in nums])
+            self._conn.commit()
+            live = self._live.copy()
+            live[nums] = False
+            self._live = live
+            self._total_length -= float(self._lengths[nums].sum())
+
+    def _maybe_merge(self) -> None:
+        if not self._merge_lock.acquire(blocking=False):
+            # Another writer is merging and re-checks the tiers when done.
+            return
+        try:
+            while True:
+                with self._lock:
+                    tiers: Dict[int, List[int]] = defaultdict(list)
+                    for segment, num_docs in sorted(self._segment_docs.items()):
+                        tier = int(np.log(max(num_docs, 1)) / np.log(MERGE_FACTOR))
+                        tiers[tier].append(segment)
+                full = [segments for segments in tiers.values() if len(segments) >= MERGE_FACTOR]
+                if not full:
+                    return
+                self._merge(full[0])
+        finally:
+            self._merge_lock.release()
+
+    def _merge(self, segments: List[int]) -> None:
+        """Replace ``segments`` by one, dropping entries of deleted documents."""
+        with self._lock:
+            live = self._live
+            merging = [self._segments[segment] for segment in segments]
+            merged = self._next_segment
+            self._next_segment += 1
+        hashes, docs, tfs = (
+            np.concatenate(parts) for parts in zip(*(s.entries() for s in merging))
+        )
+        keep = live[docs]
+        hashes, docs, tfs = hashes[keep], docs[keep], tfs[keep]
+        Segment.write(self._segment_path(merged), hashes, docs, tfs)
+        num_docs = len(np.unique(docs))
+
+        placeholders = ",".join("?" * len(segments))
+        with self._lock:
+            # Documents deleted meanwhile are still filtered by the live mask.
+            self._conn.execute(
+                f"DELETE FROM segments WHERE segment IN ({placeholders})", segments
+            )
+            self._conn.execute(
+                "INSERT INTO segments (segment, num_docs) VALUES (?, ?)", (merged, num_docs)
+            )
+            self._conn.commit()
+            remaining = {k: v for k, v in self._segments.items() if k not in segments}
+            remaining[merged] = Segment(self._segment_path(merged))
+            self._segments = remaining
+            for segment in segments:
+                del self._segment_docs[segment]
+            self._segment_docs[merged] = num_docs
+        for segment in merging:
+            # Searches still reading the old segments keep their mappings open.
+            os.remove(segment.path)
+
+    # -- search ---------------------------------------------------------------
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[Document, float]]:
+        """Top ``k`` documents by BM25 score, best first."""
+        terms = sorted(set(tokenize(query)))
+        if not terms or k <= 0:
+            return []
+        with self._lock:
+            live, lengths, segments = self._live, self._lengths, self._segments
+            num_docs = len(self._id_to_num)
+            avg_length = self._total_length / num_docs if num_docs else 0.0
+        if not num_docs:
+            return []
+
+        hashes = np.asarray([term_hash(term) for term in terms], dtype=np.uint64)
+        found = [hit for segment in segments.values() for hit in segment.lookup(hashes)]
+        if not found:
+            return []
+        docs = np.concatenate([d for _, d, _ in found])
+        tfs = np.concatenate([t for _, _, t in found]).astype(np.float32)
+        entry_terms = np.repeat([i for i, _, _ in found], [len(d) for _, d, _ in found])
+        keep = live[docs]
+        docs, tfs, entry_terms = docs[keep], tfs[keep], entry_terms[keep]
+        if not len(docs):
+            return []
+        df = np.bincount(entry_terms, minlength=len(terms))
+        idf = np.log1p((num_docs - df + 0.5) / (df + 0.5))[entry_terms]
+        norm = self.k1 * (1 - self.b + self.b * lengths[docs] / avg_length)
+        # Summing straight into doc numbers avoids sorting the matched entries.
+        scores = np.bincount(docs, weights=idf * tfs * (self.k1 + 1) / (tfs + norm))
+        matched = np.count_nonzero(scores)
+        k = min(k, matched)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return self._fetch(top.tolist(), scores[top].tolist())
+
+    def _fetch(self, nums: List[int], scores: List[float]) -> List[Tuple[Document, float]]:
+        placeholders = ",".join("?" * len(nums))
+        with self._lock:
+            records = {
+                num: (_id, text, metadata)
+                for num, _id, text, metadata in self._conn.execute(
+                    f"SELECT num, id, text, metadata FROM docs WHERE num IN ({placeholders})",
+                    nums,
+                )
+            }
+        results = []
+        for num, score in zip(nums, scores):
+            if num not in records:
+                # Deleted after the search read the live mask.
+                continue
+            _id, text, metadata = records[num]
+            doc = Document(
+                id=_id,
+                page_content=zlib.decompress(text).decode("utf-8"),
+                metadata=json.loads(metadata),
+            )
+            results.append((doc, score))
+        return results
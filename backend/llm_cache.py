@@ -0,0 +1,411 @@
+"""Exact-match response cache and request coalescing in front of a chat model.
+
+Responses are keyed on a SHA-256 of the model's identifying parameters (model
+name, temperature, max tokens, ...), the call options and the full serialized
+prompt. Lookups go memory (LRU) -> SQLite -> provider, and cached responses are
+replayed as a stream of small pieces.
+
+Identical prompts that arrive while one is already in flight do not call the
+provider again: they follow the first caller's stream chunk by chunk ("single
+flight"), sync and async callers alike. If every caller of a flight goes away,
+the upstream request is cancelled; while any caller remains, it runs to the end.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManager,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.chat_models import (
+    BaseChatModel,
+    agenerate_from_stream,
+    generate_from_stream,
+)
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableConfig
+from pydantic import PrivateAttr
+
+from answer_cache import answer_pieces
+
+
+class LLMResponseStore:
+    """SQLite tier of the cache, shared by every model in one file."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, response: dict) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)",
+                (key, json.dumps(response, ensure_ascii=False)),
+            )
+            self._conn.commit()
+
+
+class _Flight:
+    """Chunks of one upstream response, shared by every caller of the prompt."""
+
+    def __init__(self):
+        self.chunks: List[ChatGenerationChunk] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.callers = 1
+        self.task: Optional[asyncio.Future] = None
+        self._cond = threading.Condition()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def _notify(self) -> None:
+        self._cond.notify_all()
+        for loop, event in self._waiters:
+            loop.call_soon_threadsafe(event.set)
+        self._waiters = []
+
+    def publish(self, chunk: ChatGenerationChunk) -> None:
+        with self._cond:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._notify()
+
+    def follow(self) -> Iterator[ChatGenerationChunk]:
+        seen = 0
+        while True:
+            with self._cond:
+                while seen == len(self.chunks) and not self.done:
+                    self._cond.wait()
+                new, done, error = self.chunks[seen:], self.done, self.error
+            yield from new
+            seen += len(new)
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+    async def afollow(self) -> AsyncIterator[ChatGenerationChunk]:
+        seen = 0
+        while True:
+            event = None
+            with self._cond:
+                new, done, error = self.chunks[seen:], self.done, self.error
+                if not new and not done:
+                    event = asyncio.Event()
+                    self._waiters.append((asyncio.get_running_loop(), event))
+            for chunk in new:
+                yield chunk
+            seen += len(new)
+            if done:
+                if error is not None:
+                    raise error
+                return
+            if event is not None:
+                await event.wait()
+
+
+def child_config(
+    run_manager: Union[CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun, None]
+) -> Optional[RunnableConfig]:
+    """Config that runs a wrapped model as a child of the wrapper's run.
+
+    Calling the model's public ``stream``/``invoke`` with it, rather than its
+    ``_stream``/``_generate``, keeps the model's own callbacks (tracing, token
+    events) and rate limiter. LLM run managers have no ``get_child``, so the
+    manager is built the way a chain run's would be.
+    """
+    if run_manager is None:
+        return None
+    manager = CallbackManager(handlers=[], parent_run_id=run_manager.run_id)
+    manager.set_handlers(run_manager.inheritable_handlers)
+    manager.add_tags(run_manager.inheritable_tags)
+    manager.add_metadata(run_manager.inheritable_metadata)
+    return {"callbacks": manager}
+
+
+def _chunk(message: AIMessage) -> ChatGenerationChunk:
+    return ChatGenerationChunk(
+        message=AIMessageChunk(
+            content=message.content,
+            additional_kwargs=message.additional_kwargs,
+            response_metadata=message.response_metadata,
+        )
+    )
+
+
+class CachedChatModel(BaseChatModel):
+    """Wrap a chat model with an in-memory LRU, an optional disk tier and
+    coalescing of concurrent identical prompts."""
+
+    underlying: BaseChatModel
+    store: Optional[LLMResponseStore] = None
+    max_memory_items: int = 1000
+    # The wrapper is the cache; never consult a global LangChain cache as well.
+    cache: Optional[bool] = False
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    _memory: "OrderedDict[str, dict]" = PrivateAttr(default_factory=OrderedDict)
+    _flights: Dict[str, _Flight] = PrivateAttr(default_factory=dict)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _stats: Dict[str, int] = PrivateAttr(
+        default_factory=lambda: dict(memory_hits=0, disk_hits=0, misses=0, coalesced=0)
+    )
+
+    @property
+    def _llm_type(self) -> str:
+        return f"cached-{self.underlying._llm_type}"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return self.underlying._identifying_params
+
+    def cache_info(self) -> dict:
+        return {**self._stats, "memory_size": len(self._memory), "in_flight": len(self._flights)}
+
+    def _key(self, messages: List[BaseMessage], stop: Optional[List[str]], **kwargs) -> str:
+        llm_string = self.underlying._get_llm_string(stop=stop, **kwargs)
+        return hashlib.sha256(f"{llm_string}\x00{dumps(messages)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, response: dict) -> None:
+        with self._lock:
+            self._memory[key] = response
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _lookup(self, key: str) -> Optional[AIMessage]:
+        with self._lock:
+            response = self._memory.get(key)
+            if response is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+        if response is None and self.store is not None:
+            response = self.store.get(key)
+            if response is not None:
+                self._remember(key, response)
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+        return AIMessage(**response) if response is not None else None
+
+    def _join(self, key: str) -> Tuple[Optional[AIMessage], Optional[_Flight], bool]:
+        """The cached response, or the flight to follow and whether to lead it."""
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached, None, False
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.callers += 1
+                self._stats["coalesced"] += 1
+                return None, flight, False
+            flight = self._flights[key] = _Flight()
+            self._stats["misses"] += 1
+            return None, flight, True
+
+    def _leave(self, key: str, flight: _Flight) -> bool:
+        """Drop a caller; True when it was the last one of an unfinished flight."""
+        with self._lock:
+            flight.callers -= 1
+            if flight.callers or flight.done:
+                return False
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            return True
+
+    def _land(self, key: str, flight: _Flight, error: Optional[BaseException]) -> None:
+        if error is None:
+            generation = generate_from_stream(iter(flight.chunks)).generations[0]
+            message = generation.message
+            response = {
+                "content": message.content,
+                "additional_kwargs": message.additional_kwargs,
+                "response_metadata": message.response_metadata,
+            }
+            self._remember(key, response)
+            if self.store is not None:
+                self.store.put(key, response)
+        # Later callers find the cache (or retry after an error), not this flight.
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(error)
+
+    @staticmethod
+    def _replay(message: AIMessage) -> Iterator[ChatGenerationChunk]:
+        # Marked, so latency measurements (llm_router) can tell replays apart.
+        for piece in answer_pieces(message.content):
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(content=piece, response_metadata={"cached": True})
+            )
+
+    # -- upstream -------------------------------------------------------------
+
+    def _upstream(
+        self, messages, stop, stream: bool, run_manager=None, **kwargs
+    ) -> Iterator[ChatGenerationChunk]:
+        config = child_config(run_manager)
+        if stream:
+            for chunk in self.underlying.stream(messages, config, stop=stop, **kwargs):
+                yield ChatGenerationChunk(message=chunk)
+        else:
+            yield _chunk(self.underlying.invoke(messages, config, stop=stop, **kwargs))
+
+    async def _aupstream(
+        self, messages, stop, stream: bool, run_manager=None, **kwargs
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        config = child_config(run_manager)
+        if stream:
+            async for chunk in self.underlying.astream(messages, config, stop=stop, **kwargs):
+                yield ChatGenerationChunk(message=chunk)
+        else:
+            yield _chunk(await self.underlying.ainvoke(messages, config, stop=stop, **kwargs))
+
+    def _run(
+        self, messages, stop, stream: bool, run_manager=None, **kwargs
+    ) -> Iterator[ChatGenerationChunk]:
+        key = self._key(messages, stop, **kwargs)
+        cached, flight, lead = self._join(key)
+        if cached is not None:
+            yield from self._replay(cached)
+            return
+        if not lead:
+            try:
+                yield from flight.follow()
+            finally:
+                self._leave(key, flight)
+            return
+
+        upstream = self._upstream(messages, stop, stream, run_manager, **kwargs)
+        try:
+            for chunk in upstream:
+                flight.publish(chunk)
+                yield chunk
+        except GeneratorExit:
+            # Our caller stopped reading; finish the response for any followers.
+            if not self._leave(key, flight):
+                try:
+                    for chunk in upstream:
+                        flight.publish(chunk)
+                except Exception as e:
+                    self._land(key, flight, e)
+                else:
+                    self._land(key, flight, None)
+            else:
+                upstream.close()
+                flight.finish(RuntimeError("LLM request abandoned by its callers"))
+            raise
+        except BaseException as e:
+            self._land(key, flight, e)
+            self._leave(key, flight)
+            raise
+        self._land(key, flight, None)
+        self._leave(key, flight)
+
+    async def _produce(
+        self, key: str, flight: _Flight, messages, stop, stream: bool, run_manager, **kwargs
+    ):
+        try:
+            async for chunk in self._aupstream(messages, stop, stream, run_manager, **kwargs):
+                flight.publish(chunk)
+        except BaseException as e:
+            self._land(key, flight, e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            self._land(key, flight, None)
+
+    async def _arun(
+        self, messages, stop, stream: bool, run_manager=None, **kwargs
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        key = self._key(messages, stop, **kwargs)
+        cached, flight, lead = self._join(key)
+        if cached is not None:
+            for chunk in self._replay(cached):
+                yield chunk
+            return
+        if lead:
+            # The upstream call runs as its own task, so it survives the caller
+            # that started it as long as someone else is following.
+            flight.task = asyncio.ensure_future(
+                self._produce(key, flight, messages, stop, stream, run_manager, **kwargs)
+            )
+        try:
+            async for chunk in flight.afollow():
+                yield chunk
+        finally:
+            if self._leave(key, flight) and flight.task is not None:
+                flight.task.cancel()
+
+    # -- BaseChatModel --------------------------------------------------------
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return generate_from_stream(self._run(messages, stop, False, run_manager, **kwargs))
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        # BaseChatModel.stream reports every chunk to the run manager itself.
+        yield from self._run(messages, stop, True, run_manager, **kwargs)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(
+            self._arun(messages, stop, False, run_manager, **kwargs)
+        )
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in self._arun(messages, stop, True, run_manager, **kwargs):
+            yield chunk
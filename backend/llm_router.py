@@ -0,0 +1,332 @@
+"""Route each LLM call to the fastest healthy provider, and hedge slow ones.
+
+For every provider the router keeps a rolling window of time-to-first-token
+(TTFT) samples and call outcomes. A provider whose recent error rate reaches
+``max_error_rate`` is unhealthy until ``cooldown_seconds`` after its last error,
+when it gets a call again as a probe. Each call tries providers in order:
+
+1. the provider the request asked for (the ``llm`` configurable), if healthy;
+2. the other healthy providers, lowest median TTFT first (providers without
+   enough samples first, so they get measured);
+3. the unhealthy ones, as a last resort.
+
+Providers are called through their public ``stream``/``astream`` as child runs
+of the router's. Responses replayed from a provider's cache
+(``llm_cache.CachedChatModel``) count as served but add no TTFT sample.
+
+A provider that fails before its first token is followed by the next one. With
+``hedge`` on, async calls also start the next provider once the current one has
+not produced a token within its p95 TTFT; whichever answers first is used and
+the other is cancelled. Its wait so far is a lower bound of its TTFT, recorded
+as at least its current median TTFT. Sync calls only fail over.
+
+Per-provider counters (calls, served, errors, hedges, hedge wins) and latency
+quantiles are available from ``LatencyRouter.metrics()``.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.chat_models import (
+    BaseChatModel,
+    agenerate_from_stream,
+    generate_from_stream,
+)
+from langchain_core.messages import BaseMessage, BaseMessageChunk
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from llm_cache import child_config
+
+
+class ProviderStats:
+    def __init__(self, window: int = 200):
+        self.ttft = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.last_error_at = 0.0
+        self.counters = dict(calls=0, served=0, errors=0, hedges=0, hedge_wins=0)
+
+    def quantile(self, q: float, min_samples: int) -> Optional[float]:
+        if len(self.ttft) < min_samples:
+            return None
+        return float(np.quantile(np.fromiter(self.ttft, dtype=np.float64), q))
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1.0 - sum(self.outcomes) / len(self.outcomes)
+
+
+class RouterStats:
+    """Rolling statistics of every provider, shared by the router's copies."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._lock = threading.Lock()
+        self._providers: Dict[str, ProviderStats] = {}
+
+    def _get(self, name: str) -> ProviderStats:
+        stats = self._providers.get(name)
+        if stats is None:
+            stats = self._providers[name] = ProviderStats(self.window)
+        return stats
+
+    def started(self, name: str, hedge: bool = False) -> None:
+        with self._lock:
+            stats = self._get(name)
+            stats.counters["calls"] += 1
+            if hedge:
+                stats.counters["hedges"] += 1
+
+    def first_token(self, name: str, seconds: Optional[float], hedge: bool = False) -> None:
+        """``name`` served a call; ``seconds`` is None for a cache hit, which says
+        nothing about the provider's latency."""
+        with self._lock:
+            stats = self._get(name)
+            if seconds is not None:
+                stats.ttft.append(seconds)
+            stats.outcomes.append(True)
+            stats.counters["served"] += 1
+            if hedge:
+                stats.counters["hedge_wins"] += 1
+
+    def outrun(self, name: str, seconds: float) -> None:
+        """A hedge won before ``name``'s first token: its TTFT is at least ``seconds``.
+
+        The sample is right-censored: it counts as the larger of ``seconds`` and
+        the current median, so cancelled calls never pull the median down.
+        """
+        with self._lock:
+            stats = self._get(name)
+            median = stats.quantile(0.5, 1)
+            stats.ttft.append(seconds if median is None else max(median, seconds))
+
+    def failed(self, name: str) -> None:
+        with self._lock:
+            stats = self._get(name)
+            stats.outcomes.append(False)
+            stats.counters["errors"] += 1
+            stats.last_error_at = time.monotonic()
+
+    def snapshot(self, name: str) -> ProviderStats:
+        with self._lock:
+            return self._get(name)
+
+
+class LatencyRouter(BaseChatModel):
+    providers: Dict[str, BaseChatModel]
+    stats: RouterStats
+    preferred: Optional[str] = None
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    # Used until a provider has ``min_samples`` TTFT samples.
+    default_hedge_delay: float = 2.0
+    min_hedge_delay: float = 0.2
+    max_hedge_delay: float = 10.0
+    min_samples: int = 20
+    max_error_rate: float = 0.5
+    cooldown_seconds: float = 30.0
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self) -> str:
+        return "latency-router"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"providers": list(self.providers), "preferred": self.preferred}
+
+    def healthy(self, name: str) -> bool:
+        stats = self.stats.snapshot(name)
+        if stats.error_rate() < self.max_error_rate:
+            return True
+        return time.monotonic() - stats.last_error_at >= self.cooldown_seconds
+
+    def ranking(self) -> List[str]:
+        """Providers in the order this call should try them."""
+
+        def latency(name: str) -> float:
+            median = self.stats.snapshot(name).quantile(0.5, self.min_samples)
+            return -1.0 if median is None else median
+
+        healthy = [name for name in self.providers if self.healthy(name)]
+        unhealthy = [name for name in self.providers if name not in healthy]
+        ranked = sorted(healthy, key=latency)
+        if self.preferred in healthy:
+            ranked.remove(self.preferred)
+            ranked.insert(0, self.preferred)
+        return ranked + unhealthy
+
+    def hedge_delay(self, name: str) -> float:
+        delay = self.stats.snapshot(name).quantile(self.hedge_quantile, self.min_samples)
+        if delay is None:
+            return self.default_hedge_delay
+        return min(max(delay, self.min_hedge_delay), self.max_hedge_delay)
+
+    def metrics(self) -> Dict[str, dict]:
+        metrics = {}
+        for name in self.providers:
+            stats = self.stats.snapshot(name)
+            metrics[name] = {
+                **stats.counters,
+                "healthy": self.healthy(name),
+                "error_rate": round(stats.error_rate(), 4),
+                "ttft_p50_seconds": stats.quantile(0.5, 1),
+                "ttft_p95_seconds": stats.quantile(0.95, 1),
+            }
+        return metrics
+
+    @staticmethod
+    def _ttft(first: Optional[BaseMessageChunk], seconds: float) -> Optional[float]:
+        if first is not None and first.response_metadata.get("cached"):
+            return None
+        return seconds
+
+    # -- sync: fail over in ranking order -------------------------------------
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        error: Optional[BaseException] = None
+        for name in self.ranking():
+            self.stats.started(name)
+            start = time.monotonic()
+            stream = self.providers[name].stream(
+                messages, child_config(run_manager), stop=stop, **kwargs
+            )
+            try:
+                first = next(stream)
+            except StopIteration:
+                first = None
+            except Exception as e:
+                self.stats.failed(name)
+                error = e
+                continue
+            self.stats.first_token(name, self._ttft(first, time.monotonic() - start))
+            if first is not None:
+                yield ChatGenerationChunk(message=first)
+            try:
+                for chunk in stream:
+                    yield ChatGenerationChunk(message=chunk)
+            except Exception:
+                self.stats.failed(name)
+                raise
+            return
+        raise error
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    # -- async: fail over, and hedge ------------------------------------------
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        queue = self.ranking()
+        # Provider name -> (stream, pending first chunk, start time, is hedge).
+        racing: Dict[str, tuple] = {}
+        error: Optional[BaseException] = None
+
+        def launch(hedge: bool) -> str:
+            name = queue.pop(0)
+            self.stats.started(name, hedge)
+            stream = self.providers[name].astream(
+                messages, child_config(run_manager), stop=stop, **kwargs
+            )
+            first = asyncio.ensure_future(stream.__anext__())
+            racing[name] = (stream, first, time.monotonic(), hedge)
+            return name
+
+        current = launch(hedge=False)
+        winner = None
+        try:
+            while winner is None:
+                if not racing:
+                    if not queue:
+                        raise error
+                    current = launch(hedge=False)
+                # Hedge timing follows the provider started last.
+                current = next(reversed(racing))
+                timeout = None
+                if self.hedge and queue:
+                    elapsed = time.monotonic() - racing[current][2]
+                    timeout = max(self.hedge_delay(current) - elapsed, 0)
+                pending = {entry[1]: name for name, entry in racing.items()}
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    current = launch(hedge=True)
+                    continue
+                for task in done:
+                    name = pending[task]
+                    stream, _, start, hedge = racing[name]
+                    if task.exception() is None or isinstance(
+                        task.exception(), StopAsyncIteration
+                    ):
+                        if winner is None:
+                            winner = name
+                            first = None if task.exception() else task.result()
+                            self.stats.first_token(
+                                name, self._ttft(first, time.monotonic() - start), hedge
+                            )
+                        continue
+                    del racing[name]
+                    self.stats.failed(name)
+                    error = task.exception()
+        finally:
+            for name, (stream, first, start, _) in racing.items():
+                if name != winner:
+                    if winner is not None:
+                        self.stats.outrun(name, time.monotonic() - start)
+                    await self._cancel(stream, first)
+
+        stream, first, _, _ = racing[winner]
+        if first.exception() is not None:
+            return
+        try:
+            yield ChatGenerationChunk(message=first.result())
+            async for chunk in stream:
+                yield ChatGenerationChunk(message=chunk)
+        except Exception:
+            self.stats.failed(winner)
+            raise
+        finally:
+            await stream.aclose()
+
+    @staticmethod
+    async def _cancel(stream: AsyncIterator, first: asyncio.Future) -> None:
+        first.cancel()
+        # The generator can only be closed once the cancelled step has unwound.
+        await asyncio.gather(first, return_exceptions=True)
+        await stream.aclose()
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
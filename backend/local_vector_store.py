@@ -0,0 +1,513 @@
+"""Embedded vector store kept next to the API process.
+
+Each index is a directory holding:
+
+- ``vectors.<generation>.f32``: normalized float32 rows, appended on write and
+  memory-mapped for search, so the matrix is paged in by the OS instead of being
+  loaded into the Python heap;
+- ``records.sqlite``: the side-table mapping each row to its id, text and
+  metadata, plus a ``deleted`` flag.
+
+Search is one matrix-vector product and an ``argpartition`` over the live rows.
+Once an index holds ``ann_min_rows`` rows, an IVF index (see ``ann_index``) is
+trained on it and a search only scores the rows of the ``nprobe`` closest lists;
+``exact=True`` still scans everything. Upserts and deletes only flag old rows;
+``compact()`` rewrites the matrix without them into the next generation file,
+and runs by itself once more than half of a large index is dead. Everything
+survives a restart: rows past the last committed record (an interrupted write)
+are truncated when the index is opened.
+
+An index belongs to one process at a time: opening it takes an exclusive lock on
+its ``lock`` file (recording the owner's pid), and another process opening it
+gets a ``RuntimeError``. Stores of the same process share the lock. With the
+local backend, run a single API worker, and stop it before running ``ingest.py``
+on its indexes.
+"""
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import uuid
+import weakref
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from ann_index import IVFIndex, default_nlist, nearest_centroids, train_centroids
+
+# Compact once more than half the rows are dead, but not for tiny indexes.
+COMPACT_MIN_DEAD_ROWS = 1000
+# Retrain the IVF centroids once the index has grown this much since training.
+RETRAIN_GROWTH = 4
+# k-means sample size per list.
+TRAIN_ROWS_PER_LIST = 64
+
+# Index directory -> [lock file descriptor, stores of this process using it].
+_locked_directories: Dict[str, list] = {}
+_locked_directories_lock = threading.Lock()
+
+
+def _lock_directory(path: str) -> str:
+    """Take the cross-process lock of an index directory, or raise RuntimeError."""
+    key = os.path.realpath(path)
+    with _locked_directories_lock:
+        entry = _locked_directories.get(key)
+        if entry is None:
+            fd = os.open(os.path.join(key, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                owner = os.pread(fd, 32, 0).decode("ascii", "replace").strip() or "?"
+                os.close(fd)
+                raise RuntimeError(
+                    f"Index {path} is open in another process (pid {owner}); a local"
+                    " index can only be used by one process at a time"
+                ) from None
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, str(os.getpid()).encode("ascii"), 0)
+            entry = _locked_directories[key] = [fd, 0]
+        entry[1] += 1
+    return key
+
+
+def _unlock_directory(key: str) -> None:
+    with _locked_directories_lock:
+        entry = _locked_directories[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del _locked_directories[key]
+            os.close(entry[0])
+
+
+class LocalVectorStore(VectorStore):
+    def __init__(
+        self,
+        path: str,
+        embedding: Embeddings,
+        attributes: Optional[Sequence[str]] = None,
+        ann_min_rows: int = 20000,
+        nprobe: int = 16,
+        nlist: Optional[int] = None,
+    ):
+        """Open (or create) the index stored in directory ``path``.
+
+        ``attributes`` limits the metadata returned with search results, like the
+        Weaviate store's ``attributes``; all metadata is stored either way.
+        ``ann_min_rows`` is the size from which searches go through the IVF index,
+        probing ``nprobe`` of its ``nlist`` lists (default: 4 * sqrt(rows)).
+        Raises RuntimeError if another process has the index open.
+        """
+        os.makedirs(path, exist_ok=True)
+        # Released once this store is garbage collected.
+        weakref.finalize(self, _unlock_directory, _lock_directory(path))
+        self.path = path
+        self._embedding = embedding
+        self.attributes = list(attributes) if attributes is not None else None
+        self.ann_min_rows = ann_min_rows
+        self.nprobe = nprobe
+        self.nlist = nlist
+        self._lock = threading.Lock()
+        self._training = False
+        self._conn = sqlite3.connect(
+            os.path.join(path, "records.sqlite"), check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " row INTEGER PRIMARY KEY,"
+            " id TEXT NOT NULL,"
+            " text TEXT NOT NULL,"
+            " metadata TEXT NOT NULL,"
+            " deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS records_live_id ON records (id) WHERE deleted = 0"
+        )
+        self._conn.commit()
+        self._load()
+
+    # -- storage ------------------------------------------------------------
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _vectors_path(self, generation: int) -> str:
+        return os.path.join(self.path, f"vectors.{generation}.f32")
+
+    def _load(self) -> None:
+        dim = self._meta("dim")
+        self.dim: Optional[int] = int(dim) if dim else None
+        self._generation = int(self._meta("generation") or 0)
+        current = {
+            f"vectors.{self._generation}.f32",
+            os.path.basename(IVFIndex.assignments_path(self.path, self._generation)),
+        }
+        for name in os.listdir(self.path):
+            if name.startswith(("vectors.", "ivf.assign.")) and name not in current:
+                # Left over from a compaction interrupted before or after its commit.
+                os.remove(os.path.join(self.path, name))
+
+        rows = self._conn.execute("SELECT row, id, deleted FROM records ORDER BY row").fetchall()
+        self._ids: List[str] = [_id for _, _id, _ in rows]
+        self._live = np.array([not deleted for _, _, deleted in rows], dtype=bool)
+        self._id_to_row = {
+            _id: row for row, _id, deleted in rows if not deleted
+        }
+
+        vectors_path = self._vectors_path(self._generation)
+        if self.dim is not None:
+            row_bytes = self.dim * 4
+            size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+            if size > len(rows) * row_bytes:
+                # Vectors are appended before their records are committed.
+                with open(vectors_path, "r+b") as f:
+                    f.truncate(len(rows) * row_bytes)
+        self._remap()
+        self._ivf = IVFIndex.load(self.path, self._generation, self._matrix)
+
+    def _remap(self) -> None:
+        count = len(self._ids)
+        if not count:
+            self._matrix = np.empty((0, self.dim or 0), dtype=np.float32)
+        else:
+            self._matrix = np.memmap(
+                self._vectors_path(self._generation),
+                dtype=np.float32,
+                mode="r",
+                shape=(count, self.dim),
+            )
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def __len__(self) -> int:
+        return len(self._id_to_row)
+
+    # -- VectorStore --------------------------------------------------------
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        vectors = self._embedding.embed_documents(texts)
+        return self.add_embeddings(list(zip(texts, vectors)), metadatas, ids)
+
+    def add_embeddings(
+        self,
+        text_embeddings: Sequence[Tuple[str, List[float]]],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """Upsert pre-computed vectors; an existing id has its old row replaced."""
+        if not text_embeddings:
+            return []
+        ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in text_embeddings]
+        metadatas = metadatas or [{} for _ in text_embeddings]
+        if len(set(ids)) < len(ids):
+            # A batch repeating an id keeps only its last occurrence.
+            last = {_id: i for i, _id in enumerate(ids)}
+            keep = sorted(last.values())
+            ids = [ids[i] for i in keep]
+            text_embeddings = [text_embeddings[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+        vectors = self._normalize(
+            np.asarray([vector for _, vector in text_embeddings], dtype=np.float32)
+        )
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('dim', ?)",
+                    (str(self.dim),),
+                )
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(
+                    f"Vectors of dimension {vectors.shape[1]} don't fit index "
+                    f"{self.path} of dimension {self.dim}"
+                )
+            with open(self._vectors_path(self._generation), "ab") as f:
+                f.write(vectors.tobytes())
+                f.flush()
+
+            start = len(self._ids)
+            replaced = [self._id_to_row[_id] for _id in ids if _id in self._id_to_row]
+            self._conn.executemany(
+                "UPDATE records SET deleted = 1 WHERE row = ?", [(r,) for r in replaced]
+            )
+            self._conn.executemany(
+                "INSERT INTO records (row, id, text, metadata) VALUES (?, ?, ?, ?)",
+                [
+                    (start + i, _id, text, json.dumps(metadata, ensure_ascii=False))
+                    for i, (_id, (text, _), metadata) in enumerate(
+                        zip(ids, text_embeddings, metadatas)
+                    )
+                ],
+            )
+            self._conn.commit()
+
+            for i, _id in enumerate(ids):
+                self._id_to_row[_id] = start + i
+            self._live[replaced] = False
+            self._live = np.concatenate([self._live, np.ones(len(ids), dtype=bool)])
+            self._ids.extend(ids)
+            self._remap()
+            self._ivf = self._ivf.add(vectors)
+            self._ivf.append_assignments(self.path, self._generation, len(ids))
+        self._maybe_train()
+        return ids
+
+    def _maybe_train(self, force: bool = False) -> None:
+        """(Re)train the IVF centroids when the index got big enough.
+
+        The k-means and the assignment of existing rows run without the lock, so
+        searches and writes continue meanwhile; rows written during training are
+        assigned when the new index is swapped in.
+        """
+        with self._lock:
+            rows = len(self._ids)
+            if self._training or not rows:
+                return
+            if not force:
+                if rows < self.ann_min_rows:
+                    return
+                if self._ivf.trained and rows < RETRAIN_GROWTH * self._ivf.trained_rows:
+                    return
+            self._training = True
+            matrix, live, generation = self._matrix, self._live, self._generation
+        try:
+            live_rows = np.flatnonzero(live)
+            nlist = self.nlist or default_nlist(len(live_rows))
+            rng = np.random.default_rng(0)
+            sample_size = min(len(live_rows), nlist * TRAIN_ROWS_PER_LIST)
+            sample = np.sort(rng.choice(live_rows, sample_size, replace=False))
+            centroids = train_centroids(np.asarray(matrix[sample]), nlist)
+            assignments = nearest_centroids(matrix, centroids)
+            with self._lock:
+                if self._generation != generation:
+                    # Compacted meanwhile; the next write trains again.
+                    return
+                written = self._matrix[len(assignments) :]
+                assignments = np.concatenate(
+                    [assignments, nearest_centroids(written, centroids)]
+                )
+                ivf = IVFIndex(centroids, assignments, self._ivf.version + 1, len(live_rows))
+                ivf.save(self.path, generation)
+                self._ivf = ivf
+        finally:
+            with self._lock:
+                self._training = False
+
+    def build_ann_index(self) -> None:
+        """Train the IVF index now, whatever the size of the index."""
+        self._maybe_train(force=True)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return None
+        with self._lock:
+            rows = [self._id_to_row.pop(_id) for _id in ids if _id in self._id_to_row]
+            self._conn.executemany(
+                "UPDATE records SET deleted = 1 WHERE row = ?", [(r,) for r in rows]
+            )
+            self._conn.commit()
+            self._live[rows] = False
+            dead = len(self._ids) - len(self._id_to_row)
+        if dead >= COMPACT_MIN_DEAD_ROWS and dead * 2 > len(self._ids):
+            self.compact()
+        return True
+
+    def compact(self) -> None:
+        """Rewrite the index without deleted rows."""
+        with self._lock:
+            keep = np.flatnonzero(self._live)
+            generation = self._generation + 1
+            with open(self._vectors_path(generation), "wb") as f:
+                f.write(np.ascontiguousarray(self._matrix[keep]).tobytes())
+            self._ivf.remapped(keep).save_assignments(self.path, generation)
+            # New row numbers are assigned in old row order; the generation switch
+            # commits together with them.
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep (old INTEGER, new INTEGER)")
+            self._conn.execute("DELETE FROM keep")
+            self._conn.executemany(
+                "INSERT INTO keep (old, new) VALUES (?, ?)",
+                [(int(old), new) for new, old in enumerate(keep)],
+            )
+            self._conn.execute("DELETE FROM records WHERE deleted = 1")
+            self._conn.execute(
+                "UPDATE records SET row = -1 - (SELECT new FROM keep WHERE old = records.row)"
+            )
+            self._conn.execute("UPDATE records SET row = -1 - row")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)",
+                (str(generation),),
+            )
+            self._conn.commit()
+            os.remove(self._vectors_path(self._generation))
+            self._load()
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        with self._lock:
+            rows = [self._id_to_row[_id] for _id in ids if _id in self._id_to_row]
+            generation = self._generation
+        results = self._fetch(rows, [0.0] * len(rows), generation)
+        if results is None:
+            # Compacted in between: look the ids up again.
+            return self.get_by_ids(ids)
+        return [doc for doc, _ in results]
+
+    def get_vectors(self, ids: Sequence[str]) -> Dict[str, np.ndarray]:
+        """Stored (normalized) vectors of the live ``ids``, without embedding anything."""
+        with self._lock:
+            found = [(_id, self._id_to_row[_id]) for _id in ids if _id in self._id_to_row]
+            matrix = self._matrix
+            return {_id: np.array(matrix[row]) for _id, row in found}
+
+    def _fetch(
+        self, rows: Sequence[int], scores: Sequence[float], generation: int
+    ) -> Optional[List[Tuple[Document, float]]]:
+        """Documents of ``rows``, numbered as in ``generation``; None if a
+        ``compact()`` has renumbered the rows since."""
+        placeholders = ",".join("?" * len(rows))
+        with self._lock:
+            if self._generation != generation:
+                return None
+            if not rows:
+                return []
+            records = {
+                row: (_id, text, metadata)
+                for row, _id, text, metadata in self._conn.execute(
+                    f"SELECT row, id, text, metadata FROM records WHERE row IN ({placeholders})",
+                    [int(r) for r in rows],
+                )
+            }
+        results = []
+        for row, score in zip(rows, scores):
+            _id, text, metadata = records[int(row)]
+            metadata = json.loads(metadata)
+            if self.attributes is not None:
+                metadata = {key: metadata.get(key) for key in self.attributes}
+            results.append((Document(id=_id, page_content=text, metadata=metadata), float(score)))
+        return results
+
+    def search_rows(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        nprobe: Optional[int] = None,
+        exact: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Row numbers and cosine similarities of the top ``k`` live rows, best first."""
+        rows, scores, _ = self._search(embedding, k, nprobe, exact)
+        return rows, scores
+
+    def _search(
+        self,
+        embedding: List[float],
+        k: int,
+        nprobe: Optional[int],
+        exact: bool,
+    ) -> Tuple[np.ndarray, np.ndarray, int]:
+        """``search_rows`` plus the generation the row numbers belong to."""
+        with self._lock:
+            matrix, live, ivf, generation = self._matrix, self._live, self._ivf, self._generation
+        query = self._normalize(np.asarray(embedding, dtype=np.float32))
+        if not exact and ivf.trained and len(matrix) >= self.ann_min_rows:
+            rows = ivf.candidates(query, nprobe or self.nprobe)
+            rows = np.sort(rows[live[rows]])
+            if len(rows) >= k:
+                return (*self._top_k(rows, matrix[rows] @ query, k), generation)
+        scores = matrix @ query
+        scores[~live] = -np.inf
+        return (
+            *self._top_k(np.arange(len(matrix)), scores, min(k, int(live.sum()))),
+            generation,
+        )
+
+    @staticmethod
+    def _top_k(rows: np.ndarray, scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if k <= 0:
+            return rows[:0], scores[:0]
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return rows[top], scores[top]
+
+    def search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        nprobe: Optional[int] = None,
+        exact: bool = False,
+    ) -> List[Tuple[Document, float]]:
+        """Top ``k`` live documents by cosine similarity, best first."""
+        while True:
+            rows, scores, generation = self._search(embedding, k, nprobe, exact)
+            results = self._fetch(rows.tolist(), scores.tolist(), generation)
+            # A compact() between scoring and fetching renumbers the rows: score
+            # the new matrix again.
+            if results is not None:
+                return results
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.search_by_vector(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.search_by_vector(embedding, k, **kwargs)]
+
+    async def asimilarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        # Only the embedding call waits on the network; the search itself is a
+        # short NumPy call and runs inline on the event loop.
+        return self.search_by_vector(await self._embedding.aembed_query(query), k, **kwargs)
+
+    async def asimilarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in await self.asimilarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # Scores are already cosine similarities.
+        return lambda score: score
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        path: Optional[str] = None,
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        if path is None:
+            raise ValueError("LocalVectorStore.from_texts needs a path")
+        store = cls(path, embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids)
+        return store
@@ -1,6 +1,9 @@
 """Main entrypoint for the app."""
 from ast import Dict, Str
 import asyncio
+import logging
+import os
+import threading
 from operator import index
 from tokenize import String
 from typing import Optional, Union
@@ -11,8 +14,22 @@ import langsmith
 from regex import P
 from sklearn.calibration import StrOptions
 from vector_store_manage import VectorStoreManager
-from chain import ChatRequest, answer_chain
+from chain import (
+    ChatRequest,
+    answer_cache,
+    answer_chain,
+    llm_providers,
+    llm_router,
+    question_condenser,
+    stage_metrics,
+)
+from ingest_jobs import IngestionJob, IngestionJobQueue, QueueFullError
+from incremental_ingest import incremental_ingest
+from ingest_pipeline import transform_documents
+from stage_metrics import format_metric
+from utils import cache_chat_model, get_embeddings_model
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from constants import WEAVIATE_DOCS_INDEX_NAME
 from langserve import add_routes
@@ -23,10 +40,16 @@ from pydantic import BaseModel
 class ResponseCode:
     SUCCESS = 200
     BAD_REQUEST = 400
+    NOT_FOUND = 404
+    TOO_MANY_REQUESTS = 429
     INTERNAL_ERROR = 500
 
+logger = logging.getLogger(__name__)
 client = Client()
 vector_store_manager = VectorStoreManager()
+# 生成示例问题的模型，所有上传共用一个（与 chain.py 一样只建一次）：同一URL内容重新上传时
+# 直接复用缓存的问题，并发的相同请求只调用一次LLM
+example_questions_llm = cache_chat_model(ChatDeepSeek(model="deepseek-chat", temperature=0.7))
 
 app = FastAPI()
 app.add_middleware(
@@ -39,11 +62,7 @@ app.add_middleware(
 )
 
 
-# Dynamic chain selection based on index_name
-# def get_chain_with_index(request: ChatRequest):
-#     """Get chain with specified index name."""
-#     return get_answer_chain(request.index_name or "wang_death_book")
-
+# answer_chain routes each request to the chain for its ChatRequest.index_name.
 add_routes(
     app,
     answer_chain,
@@ -142,33 +161,131 @@ class FetchUrlBody(BaseModel):
 @app.post("/knowledge/url")
 async def get_knowledge_from_url(body: FetchUrlBody):
     url = body.url
-    """处理知识库中数据源(形式为URL)的上传"""
+    """处理知识库中数据源(形式为URL)的上传
+
+    只做校验并提交后台任务，立即返回 job_id，进度通过 /knowledge/jobs/{job_id} 查询。
+    """
     # 1. 验证URL是否合格
     if not is_valid_url(url):
         return {"error": "Invalid URL format", "code": ResponseCode.BAD_REQUEST}
-    
+
+    # 2. 生成或获取index name
+    # index_name = generate_index_name(url)
+    index_name = WEAVIATE_DOCS_INDEX_NAME
+
+    # 3. 提交后台任务，队列满时拒绝，保护 /chat 的延迟
     try:
-        # 2. 加载URL内容
-        docs = load_url_content(url)
-        if not docs:
-            return {"error": "Failed to load content from URL", "code": ResponseCode.BAD_REQUEST}
-        
-        # 3. 生成或获取index name
-        # index_name = generate_index_name(url)
-        index_name = WEAVIATE_DOCS_INDEX_NAME
-        
-        # 4. 嵌入内容并存入数据库
-        embed_and_store_content(docs, index_name)
-        
-        # 5. 生成示例问题
-        example_questions = generate_example_questions(docs)
+        job = ingestion_jobs.submit(url, index_name)
+    except QueueFullError:
+        return {
+            "error": "Too many uploads in progress, please retry later",
+            "code": ResponseCode.TOO_MANY_REQUESTS,
+        }
+    return {
+        "job_id": job.job_id,
+        "index_name": index_name,
+        "stage": job.stage,
+        "code": ResponseCode.SUCCESS,
+    }
+
+
+@app.get("/llm/providers")
+async def get_llm_providers():
+    """各LLM供应商的调用/服务/错误/对冲次数与首token延迟，用于容量规划"""
+    return {"providers": llm_router.metrics(), "code": ResponseCode.SUCCESS}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus 文本格式的指标：各阶段耗时直方图、LLM供应商统计和各缓存命中情况"""
+    providers = llm_router.metrics()
+    lines = []
+    for counter in ("calls", "served", "errors", "hedges", "hedge_wins"):
+        lines += format_metric(
+            f"llm_provider_{counter}_total",
+            "counter",
+            f"LLM provider {counter.replace('_', ' ')}.",
+            [({"provider": name}, stats[counter]) for name, stats in providers.items()],
+        )
+    for quantile in ("p50", "p95"):
+        lines += format_metric(
+            f"llm_provider_ttft_{quantile}_seconds",
+            "gauge",
+            f"Rolling {quantile} time to first token of the LLM provider.",
+            [
+                ({"provider": name}, stats[f"ttft_{quantile}_seconds"])
+                for name, stats in providers.items()
+                if stats[f"ttft_{quantile}_seconds"] is not None
+            ],
+        )
+
+    # 缓存统计：只导出数值字段，如 hits/misses/size
+    caches = {
+        "embedding": get_embeddings_model(),
+        "condense": question_condenser,
+        "answer": answer_cache,
+        **{f"llm_{name}": model for name, model in llm_providers.items()},
+    }
+    samples = []
+    for cache_name, cache in caches.items():
+        if cache is None or not hasattr(cache, "cache_info"):
+            continue
+        for field, value in cache.cache_info().items():
+            if isinstance(value, (int, float)):
+                samples.append(({"cache": cache_name, "field": field}, value))
+    lines += format_metric("chat_cache_info", "gauge", "Cache counters and sizes.", samples)
+    return PlainTextResponse(
+        stage_metrics.render() + "\n".join(lines) + "\n",
+        media_type="text/plain; version=0.0.4",
+    )
 
-        # 6. 返回标题
-        title = extract_title_from_docs(docs)
-        return {"title": title, "index_name": index_name, "code": ResponseCode.SUCCESS, "example_questions": example_questions}
-        
-    except Exception as e:
-        return {"error": f"Failed to process URL: {str(e)}", "code": ResponseCode.INTERNAL_ERROR}
+
+@app.get("/knowledge/jobs/{job_id}")
+async def get_knowledge_job(job_id: str):
+    """查询URL上传任务的状态：阶段、文档/分块数量、索引统计"""
+    job = ingestion_jobs.get(job_id)
+    if job is None:
+        return {"error": "Job not found", "code": ResponseCode.NOT_FOUND}
+    return {**job.to_dict(), "code": ResponseCode.SUCCESS}
+
+
+def run_ingestion_job(job: IngestionJob):
+    """在后台线程中执行上传任务：加载 -> 分割/嵌入入库 -> 生成示例问题"""
+    # 1. 加载URL内容
+    job.stage = "loading"
+    from crawler import Crawler
+    crawler = Crawler(get_crawl_store(), continue_on_failure=False)
+    docs = load_url_content(job.url, crawler)
+    if not docs:
+        raise ValueError("Failed to load content from URL")
+    job.num_docs = len(docs)
+    job.title = extract_title_from_docs(docs)
+
+    # 2. 分割、嵌入内容并存入数据库（只处理内容有变化的部分）
+    job.stage = "indexing"
+    # 入库期间持有该索引，避免对话链被淘汰后同一目录被打开第二个存储实例
+    with vector_store_manager.use_index(job.index_name):
+        job.indexing_stats = embed_and_store_content(docs, job.index_name)
+    # 入库成功后才把页面记为已入库，失败时下次抓取仍视为有变化
+    crawler.acknowledge()
+    job.num_chunks = job.indexing_stats["num_chunks"]
+    # 索引内容变化后，之前缓存的答案可能已过时
+    if answer_cache is not None and (
+        job.indexing_stats["num_added"] or job.indexing_stats["num_deleted"]
+    ):
+        answer_cache.invalidate(job.index_name)
+
+    # 3. 生成示例问题
+    job.stage = "generating_questions"
+    job.example_questions = generate_example_questions(docs)
+
+
+ingestion_jobs = IngestionJobQueue(
+    run_ingestion_job,
+    max_workers=int(os.environ.get("INGEST_WORKERS", "2")),
+    max_queue_depth=int(os.environ.get("INGEST_MAX_QUEUE_DEPTH", "32")),
+    max_jobs_per_index=int(os.environ.get("INGEST_MAX_JOBS_PER_INDEX", "1")),
+)
 
 
 def is_valid_url(url: str) -> bool:
@@ -184,15 +301,53 @@ def is_valid_url(url: str) -> bool:
     return url_pattern.match(url) is not None
 
 
-def load_url_content(url: str):
-    """加载URL内容"""
-    from langchain.document_loaders import WebBaseLoader
+# 所有上传共用一个响应存储（一个 SQLite 连接），首次抓取时创建
+_crawl_store = None
+_crawl_store_lock = threading.Lock()
+
+
+def get_crawl_store():
+    """进程内共享的 ResponseStore，路径由 CRAWL_STORE_PATH 指定"""
+    global _crawl_store
+    from crawler import ResponseStore
+    from utils import CACHE_DIR
+    with _crawl_store_lock:
+        if _crawl_store is None:
+            _crawl_store = ResponseStore(
+                os.environ.get("CRAWL_STORE_PATH", str(CACHE_DIR / "crawl.sqlite"))
+            )
+    return _crawl_store
+
+
+def load_url_content(url: str, crawler=None):
+    """加载URL内容
+
+    通过共享的爬虫客户端抓取（连接池、按主机限流、robots.txt、重试），
+    文本和元数据与 WebBaseLoader 一致。内容入库后调用 ``crawler.acknowledge()``。
+    """
+    from bs4 import BeautifulSoup
+    from langchain_core.documents import Document
+    from crawler import Crawler
     try:
-        loader = WebBaseLoader(url)
-        docs = loader.load()
-        return docs
-    except Exception as e:
-        print(f"Error loading URL content: {e}")
+        crawler = crawler or Crawler(get_crawl_store(), continue_on_failure=False)
+        page = crawler.fetch_one(url)
+        logger.info(f"Crawled {url}: {crawler.stats.to_dict()}")
+        if page is None:
+            return None
+        soup = BeautifulSoup(page.html, "html.parser")
+        metadata = {"source": url}
+        if title := soup.find("title"):
+            metadata["title"] = title.get_text()
+        description = soup.find("meta", attrs={"name": "description"})
+        metadata["description"] = (
+            description.get("content", "No description found.")
+            if description else "No description found."
+        )
+        html = soup.find("html")
+        metadata["language"] = html.get("lang", "No language found.") if html else "No language found."
+        return [Document(page_content=soup.get_text(), metadata=metadata)]
+    except Exception:
+        logger.exception(f"Error loading URL content from {url}")
         return None
 
 
@@ -221,49 +376,53 @@ def generate_index_name(url:str) -> str:
     return index_name[:50]  # 限制长度
 
 
+def split_content(docs, dedup=None):
+    """分割文档，并确保metadata包含必要字段；传入 dedup 时去掉近似重复的分块"""
+    from markdown_splitter import get_text_splitter
+
+    # 与原来一样保留很短的分块，不做长度过滤
+    return list(transform_documents(docs, get_text_splitter(), dedup, min_length=None))
+
+
 def embed_and_store_content(docs, index_name: str):
-    """将内容嵌入并存入数据库"""
-    # 使用现有的embedding模型和数据库连接
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
-    # from backend.vector_database import get_vectorstore
-    import os
-    
-    # 分割文档
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=4000, chunk_overlap=200)
-    docs_transformed = text_splitter.split_documents(docs)
-    
-    # 确保metadata包含必要字段
-    for doc in docs_transformed:
-        if "source" not in doc.metadata:
-            doc.metadata["source"] = ""
-        if "title" not in doc.metadata:
-            doc.metadata["title"] = ""
-    
+    """将内容嵌入并存入数据库
+
+    增量索引：只对内容指纹有变化的 source 做分割和嵌入，并只删除这些 source 的旧分块，
+    不会影响共享索引中其他 URL 的内容。
+    """
     # 使用单例连接创建vector store
     vectorstore = vector_store_manager.get_vector_store(index_name)
-    # vectorstore = get_vectorstore(index_name)
-    
+
     # 使用record manager进行去重
-    from langchain.indexes import SQLRecordManager, index
+    from langchain.indexes import SQLRecordManager
     record_manager = SQLRecordManager(
         f"weaviate/{index_name}",
         db_url=os.environ["RECORD_MANAGER_DB_URL"],
     )
     record_manager.create_schema()
-    
+
+    # 近似重复的分块（与本次或索引中已有的分块）在嵌入前丢弃
+    from near_dedup import get_near_duplicate_filter
+    dedup = get_near_duplicate_filter(record_manager)
+
     # 索引文档
-    indexing_stats = index(
-        docs_transformed,
+    indexing_stats = incremental_ingest(
+        docs,
+        lambda source_docs: split_content(source_docs, dedup.filter if dedup else None),
         record_manager,
         vectorstore,
         batch_size=64,
-        cleanup="full",
-        source_id_key="source",
+        keyword_index=vector_store_manager.get_keyword_index(index_name),
     )
+    if dedup is not None:
+        indexing_stats["num_near_duplicates"] = dedup.stats["dropped"]
+        # 被丢弃的分块所依赖的分块已删除时，让对应来源下次重新切分
+        dedup.invalidate_dependents()
     # TODO: 这里考虑将 index 记录写入 log
 
     return indexing_stats
 
+
 def generate_example_questions(docs):
     """基于刚加入的知识生成4个示例问题"""
     # TODO： 考虑 RAPTOR 优化这个过程
@@ -293,10 +452,9 @@ def generate_example_questions(docs):
         请生成4个示例问题（每行一个问题）：
         """
     
-    llm = ChatDeepSeek(model="deepseek-chat", temperature=0.7)
     prompt = PromptTemplate.from_template(prompt_template)
     
-    chain = prompt | llm | StrOutputParser()
+    chain = prompt | example_questions_llm | StrOutputParser()
     
     try:
         questions_text = chain.invoke({'content': content})
@@ -0,0 +1,273 @@
+"""Structure-aware, token-sized chunking of Markdown documents.
+
+``MarkdownTokenSplitter`` replaces ``RecursiveCharacterTextSplitter(4000, 200)``.
+It reads the Markdown that ``parser.langchain_docs_extractor`` (and
+``html_extract``) produce in one pass over the lines, as blocks: headings,
+fenced code blocks and paragraphs (lists and tables are blank-line separated
+paragraphs there too). Blocks are packed into chunks of at most ``chunk_size``
+embedding-model tokens, counted once per block, so
+
+- a heading starts a new chunk, unless the chunk so far is shorter than
+  ``min_section_tokens`` (a title followed by its first section stays whole),
+- a code block is never cut through its fences: if it is too long on its own,
+  it is split between lines and every part is fenced again,
+- only a block longer than a chunk is split further, between lines, then
+  sentences, then clauses (Chinese and Western punctuation), then at the token
+  limit,
+- ``chunk_overlap`` tokens of whole trailing blocks are repeated when a section
+  continues in the next chunk, never across sections.
+
+Each chunk gets the headings it sits under as a ``headings`` breadcrumb in its
+metadata ("Page > Section > Subsection").
+
+Token counts default to cl100k_base (``utils.token_length``), a proxy for the
+embedding model's own tokenizer; block counts are added up, so a chunk can be a
+few tokens off its exact encoded length.
+"""
+import copy
+import os
+import re
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from langchain.text_splitter import TextSplitter
+from langchain_core.documents import Document
+
+from utils import token_length
+
+# Chunk size and overlap in embedding-model tokens.
+CHUNK_TOKENS = int(os.environ.get("CHUNK_TOKENS", "512"))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", "32"))
+
+_HEADING = re.compile(r"(#{1,6})[ \t]+(.*?)[ \t#]*$")
+_FENCE = re.compile(r"[ \t]*(`{3,}|~{3,})")
+_SENTENCE = re.compile(r".*?(?:[。！？；]+[”’」』）)]*|[.!?;]+[\"')\]]*(?:\s+|$)|$)", re.S)
+_CLAUSE = re.compile(r".*?(?:[，、：]+|[,:]+(?:\s+|$)|$)", re.S)
+
+# (text, tokens, separator joining it to the previous block of its chunk)
+Block = Tuple[str, int, str]
+
+
+def _blocks(text: str) -> Iterator[Tuple[str, object, str]]:
+    """("heading", (level, title), line), ("code", None, text) and ("text", None, text)."""
+    paragraph: List[str] = []
+    fence: Optional[str] = None
+    code: List[str] = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if fence is not None:
+            code.append(line)
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                yield "code", None, "\n".join(code)
+                fence, code = None, []
+            continue
+        # Only lines starting with a fence or "#" are worth a regex.
+        opening = _FENCE.match(line) if stripped[:1] in ("`", "~") else None
+        heading = _HEADING.match(line) if line[:1] == "#" else None
+        if opening or heading or not stripped:
+            if paragraph:
+                yield "text", None, "\n".join(paragraph)
+                paragraph = []
+        if opening:
+            fence, code = opening.group(1), [line]
+        elif heading:
+            yield "heading", (len(heading.group(1)), heading.group(2)), line
+        elif stripped:
+            paragraph.append(line)
+    if paragraph:
+        yield "text", None, "\n".join(paragraph)
+    if code:
+        yield "code", None, "\n".join(code)
+
+
+def _common_prefix(a: List[str], b: List[str]) -> List[str]:
+    n = 0
+    while n < len(a) and n < len(b) and a[n] == b[n]:
+        n += 1
+    return a[:n]
+
+
+class MarkdownTokenSplitter(TextSplitter):
+    """Split Markdown on its structure into chunks of at most ``chunk_size`` tokens."""
+
+    def __init__(
+        self,
+        chunk_size: int = CHUNK_TOKENS,
+        chunk_overlap: int = CHUNK_OVERLAP_TOKENS,
+        min_section_tokens: int = 64,
+        length_function: Callable[[str], int] = token_length,
+        headings_key: str = "headings",
+        **kwargs,
+    ):
+        super().__init__(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=length_function,
+            **kwargs,
+        )
+        self._min_section_tokens = min_section_tokens
+        self._headings_key = headings_key
+        self._separator_tokens = {sep: length_function(sep) for sep in ("\n\n", "\n", "")}
+
+    def split_text(self, text: str) -> List[str]:
+        return [chunk for _, chunk in self.split_sections(text)]
+
+    def create_documents(
+        self, texts: List[str], metadatas: Optional[List[dict]] = None
+    ) -> List[Document]:
+        documents = []
+        for i, text in enumerate(texts):
+            metadata = metadatas[i] if metadatas else {}
+            for headings, chunk in self.split_sections(text):
+                chunk_metadata = copy.deepcopy(metadata)
+                if headings:
+                    chunk_metadata[self._headings_key] = " > ".join(headings)
+                documents.append(Document(page_content=chunk, metadata=chunk_metadata))
+        return documents
+
+    def split_sections(self, text: str) -> Iterator[Tuple[List[str], str]]:
+        """Yield ``(headings, chunk)`` for the chunks of ``text``, in order."""
+        size = self._chunk_size
+        separator_tokens = self._separator_tokens
+        path: List[Tuple[int, str]] = []
+        chunk: List[Block] = []
+        chunk_tokens = 0
+        chunk_path: List[str] = []
+        # Headings wait for the first block of their section, so a chunk never
+        # ends on a heading.
+        headings: List[Block] = []
+
+        def cost(blocks: List[Block]) -> int:
+            return sum(tokens + separator_tokens[sep] for _, tokens, sep in blocks)
+
+        def emit(overlap: bool) -> Iterator[Tuple[List[str], str]]:
+            nonlocal chunk, chunk_tokens
+            content = "".join((sep if i else "") + text for i, (text, _, sep) in enumerate(chunk))
+            content = content.strip()
+            if content:
+                yield list(chunk_path), content
+            carried: List[Block] = []
+            if overlap:
+                for block in reversed(chunk):
+                    if cost([block, *carried]) > self._chunk_overlap:
+                        break
+                    carried.insert(0, block)
+            chunk, chunk_tokens = carried, cost(carried)
+
+        def add(blocks: List[Block], new_section: bool) -> Iterator[Tuple[List[str], str]]:
+            nonlocal chunk_tokens, chunk_path
+            needed = cost(blocks)
+            current = [title for _, title in path]
+            if chunk and (
+                chunk_tokens + needed > size
+                or (new_section and chunk_tokens >= self._min_section_tokens)
+            ):
+                yield from emit(overlap=not new_section)
+                # Drop the overlap if it leaves no room for the blocks.
+                while chunk and chunk_tokens + needed > size:
+                    chunk_tokens -= cost([chunk.pop(0)])
+                chunk_path = current
+            elif not chunk:
+                chunk_path = current
+            elif new_section:
+                # A short section joined to the next one: keep the shared headings.
+                chunk_path = _common_prefix(chunk_path, current)
+            chunk.extend(blocks)
+            chunk_tokens += needed
+
+        for kind, heading, block_text in _blocks(text):
+            tokens = self._length_function(block_text)
+            if kind == "heading":
+                level, title = heading
+                while path and path[-1][0] >= level:
+                    path.pop()
+                path.append((level, title))
+                headings.append((block_text, tokens, "\n\n"))
+                continue
+            # Leave room for the headings in the first piece of an oversize block.
+            limit = max(size - cost(headings), size // 2)
+            if tokens <= limit:
+                pieces: Iterable[Block] = [(block_text, tokens, "\n\n")]
+            elif kind == "code":
+                pieces = self._split_code(block_text, limit)
+            else:
+                pieces = self._split_long(block_text, 0, limit)
+            for i, (piece, piece_tokens, sep) in enumerate(pieces):
+                block = (piece, piece_tokens, "\n\n" if i == 0 else sep)
+                yield from add([*headings, block], new_section=bool(headings))
+                headings = []
+        if headings:
+            yield from add(headings, new_section=True)
+        yield from emit(overlap=False)
+
+    def _split_long(self, text: str, level: int, limit: int) -> Iterator[Block]:
+        """Pieces of ``text`` of at most ``limit`` tokens: lines, then sentences,
+        then clauses, then cuts at the token limit. Only pieces that are still too
+        long go a level down."""
+        if level == 0:
+            parts, sep = text.split("\n"), "\n"
+        elif level < 3:
+            pattern = _SENTENCE if level == 1 else _CLAUSE
+            parts, sep = [m.group() for m in pattern.finditer(text) if m.group()], ""
+        else:
+            yield from self._cut(text, limit)
+            return
+        for part in parts:
+            tokens = self._length_function(part)
+            if tokens <= limit:
+                yield part, tokens, sep
+            else:
+                pieces = self._split_long(part, level + 1, limit)
+                for i, (piece, piece_tokens, piece_sep) in enumerate(pieces):
+                    yield piece, piece_tokens, sep if i == 0 else piece_sep
+
+    def _cut(self, text: str, limit: int) -> Iterator[Block]:
+        """Cut text without line, sentence or clause breaks at the token limit,
+        preferring whitespace near the cut."""
+        start = 0
+        while start < len(text):
+            rest = text[start:]
+            tokens = self._length_function(rest)
+            if tokens <= limit:
+                yield rest, tokens, ""
+                return
+            end = max(1, len(rest) * limit // tokens)
+            while True:
+                space = rest.rfind(" ", end // 2, end)
+                cut = space + 1 if space > 0 else end
+                tokens = self._length_function(rest[:cut])
+                if tokens <= limit or end == 1:
+                    break
+                end = max(1, end * 9 // 10)
+            yield rest[:cut], tokens, ""
+            start += cut
+
+    def _split_code(self, text: str, limit: int) -> Iterator[Block]:
+        """Parts of a fenced code block, each fenced again, split between lines."""
+        lines = text.split("\n")
+        opening = lines[0]
+        closing = _FENCE.match(opening).group(1)
+        has_closing = len(lines) > 1 and lines[-1].strip().startswith(closing)
+        body = lines[1:-1] if has_closing else lines[1:]
+        newline = self._separator_tokens["\n"]
+        fence_tokens = self._length_function(opening) + self._length_function(closing) + newline
+        budget = max(limit - fence_tokens, 1)
+        part: List[str] = []
+        part_tokens = 0
+        for line in body:
+            tokens = self._length_function(line) + newline
+            if part and part_tokens + tokens > budget:
+                yield "\n".join([opening, *part, closing]), part_tokens + fence_tokens, "\n\n"
+                part, part_tokens = [], 0
+            if tokens > budget:
+                for piece, piece_tokens, _ in self._split_long(line, 1, budget - newline):
+                    yield "\n".join([opening, piece, closing]), piece_tokens + fence_tokens + newline, "\n\n"
+                continue
+            part.append(line)
+            part_tokens += tokens
+        if part:
+            yield "\n".join([opening, *part, closing]), part_tokens + fence_tokens, "\n\n"
+
+
+def get_text_splitter() -> MarkdownTokenSplitter:
+    """The splitter used for every index, sized by CHUNK_TOKENS/CHUNK_OVERLAP_TOKENS."""
+    return MarkdownTokenSplitter()
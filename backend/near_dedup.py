@@ -0,0 +1,334 @@
+"""Near-duplicate chunk removal before embedding, with MinHash and LSH.
+
+The doc loaders overlap heavily (the same snippets on many pages), so many
+chunks are near-copies of each other. Every chunk gets a MinHash signature of
+its word 5-gram shingles (CJK characters count as words), ``num_perm`` 32-bit
+values computed with numpy. Signatures are bucketed by LSH in ``bands`` bands;
+a chunk sharing a bucket with an earlier one whose estimated Jaccard
+similarity is at least ``threshold`` is dropped, and the earlier one is kept.
+
+Signatures of the kept chunks are stored in SQLite per index namespace, so an
+incremental ingest also drops chunks that duplicate what the index already
+holds. A stored chunk only counts if the record manager still has it, and the
+chunks of the source being re-ingested are ignored, as they are about to be
+replaced. A full ingest starts the namespace's signatures over, as its cleanup
+deletes whatever it does not see.
+
+A dropped chunk leaves its content in the index only through the chunk it
+duplicates, which belongs to another source once incremental ingests are in
+play. Each such drop is recorded as a dependency of the source on the kept
+chunk. After an ingest, ``invalidate_dependents`` finds the kept chunks that are
+no longer indexed (their source changed or went away) and forgets the
+fingerprints of the sources that depended on them, so the next incremental
+ingest splits those sources again.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from incremental_ingest import forget_sources
+from indexing import document_uid
+
+logger = logging.getLogger(__name__)
+
+# Estimated Jaccard similarity from which a chunk is a near-duplicate; 0 turns
+# deduplication off.
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", "0.85"))
+DEDUP_SIGNATURES_PATH = os.environ.get(
+    "DEDUP_SIGNATURES_PATH", str(Path(__file__).parent.parent / ".cache" / "signatures.sqlite")
+)
+
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_CJK_CHAR = re.compile(f"[{_CJK}]")
+# CJK and full-width punctuation is left out.
+_CJK_TOKEN = re.compile(rf"[{_CJK}]|[^\s{_CJK}\u3000-\u303f\uff00-\uffef]+")
+
+
+def _tokens(text: str) -> List[str]:
+    text = text.lower()
+    if _CJK_CHAR.search(text):
+        return _CJK_TOKEN.findall(text)
+    return text.split()
+
+
+class MinHasher:
+    """MinHash signatures of word shingles, identical across processes.
+
+    Words are split on whitespace, and every CJK character is a word of its own.
+    Shingles are hashed from the CRC32 of their words, and the ``num_perm``
+    permutations are multiply-shift hashes, all in wrapping uint64 arithmetic.
+    """
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        max_value = np.iinfo(np.uint64).max
+        self._a = rng.randint(0, max_value, size=num_perm, dtype=np.uint64)[:, None] | np.uint64(1)
+        self._b = rng.randint(0, max_value, size=num_perm, dtype=np.uint64)[:, None]
+        self._powers = np.uint64(1_000_003) ** np.arange(shingle_size, dtype=np.uint64)[::-1]
+        self._token_hashes: Dict[str, int] = {}
+
+    def _shingles(self, text: str) -> np.ndarray:
+        tokens = _tokens(text) or [""]
+        cache = self._token_hashes
+        if len(cache) > 1_000_000:
+            cache.clear()
+        for token in tokens:
+            if token not in cache:
+                cache[token] = zlib.crc32(token.encode("utf-8"))
+        hashes = np.fromiter(map(cache.__getitem__, tokens), dtype=np.uint64, count=len(tokens))
+        # Polynomial hash of every window of k word hashes.
+        k = min(self.shingle_size, len(hashes))
+        powers = self._powers[-k:]
+        n = len(hashes) - k + 1
+        shingles = hashes[:n] * powers[0]
+        for i in range(1, k):
+            shingles += hashes[i : n + i] * powers[i]
+        return np.unique(shingles)
+
+    def signature(self, text: str) -> np.ndarray:
+        shingles = self._shingles(text)[None, :]
+        permuted = (self._a * shingles + self._b) >> np.uint64(32)
+        return permuted.min(axis=1).astype(np.uint32)
+
+
+class SignatureStore:
+    """Signatures of indexed chunks, by namespace and record id."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS signatures ("
+            " namespace TEXT NOT NULL,"
+            " uid TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " signature BLOB NOT NULL,"
+            " PRIMARY KEY (namespace, uid))"
+        )
+        # Sources with chunks dropped as near-duplicates of the chunk ``uid``.
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dependents ("
+            " namespace TEXT NOT NULL,"
+            " uid TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " PRIMARY KEY (namespace, uid, source))"
+        )
+        self._conn.commit()
+
+    def load(self, namespace: str) -> List[Tuple[str, str, np.ndarray]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT uid, source, signature FROM signatures WHERE namespace = ?",
+                (namespace,),
+            ).fetchall()
+        return [(uid, source, np.frombuffer(blob, dtype=np.uint32)) for uid, source, blob in rows]
+
+    def put_many(self, namespace: str, rows: Sequence[Tuple[str, str, np.ndarray]]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO signatures (namespace, uid, source, signature)"
+                " VALUES (?, ?, ?, ?)",
+                [(namespace, uid, source, signature.tobytes()) for uid, source, signature in rows],
+            )
+            self._conn.commit()
+
+    def add_dependents(self, namespace: str, rows: Sequence[Tuple[str, str]]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO dependents (namespace, uid, source) VALUES (?, ?, ?)",
+                [(namespace, uid, source) for uid, source in rows],
+            )
+            self._conn.commit()
+
+    def load_dependents(self, namespace: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT uid, source FROM dependents WHERE namespace = ?", (namespace,)
+            ).fetchall()
+
+    def forget_dependents(self, namespace: str, uids: Sequence[str]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM dependents WHERE namespace = ? AND uid = ?",
+                [(namespace, uid) for uid in uids],
+            )
+            self._conn.commit()
+
+    def clear(self, namespace: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM signatures WHERE namespace = ?", (namespace,))
+            self._conn.execute("DELETE FROM dependents WHERE namespace = ?", (namespace,))
+            self._conn.commit()
+
+
+class NearDuplicateFilter:
+    """Pipeline stage dropping chunks that nearly duplicate an earlier one.
+
+    ``exists`` (``RecordManager.exists``) tells which stored chunks are still
+    indexed. ``invalidate`` (``incremental_ingest.forget_sources``) makes sources
+    be split again by the next incremental ingest. With ``record=False`` nothing
+    is written to the store (dry runs).
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        store: Optional[SignatureStore] = None,
+        exists: Optional[Callable[[List[str]], List[bool]]] = None,
+        invalidate: Optional[Callable[[List[str]], None]] = None,
+        threshold: float = 0.85,
+        bands: int = 8,
+        hasher: Optional[MinHasher] = None,
+        source_id_key: str = "source",
+        record: bool = True,
+    ):
+        self.namespace = namespace
+        self.store = store
+        self.exists = exists
+        self.invalidate = invalidate
+        self.threshold = threshold
+        self.hasher = hasher or MinHasher()
+        if self.hasher.num_perm % bands:
+            raise ValueError(f"num_perm {self.hasher.num_perm} is not a multiple of bands {bands}")
+        self.bands = bands
+        self.rows = self.hasher.num_perm // bands
+        self.source_id_key = source_id_key
+        self.record = record
+        self.stats = {"kept": 0, "dropped": 0, "dropped_against_index": 0}
+        # Entries: (uid, source, signature, stored before this run).
+        self._entries: List[Tuple[str, str, np.ndarray, bool]] = []
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self._pending: List[Tuple[str, str, np.ndarray]] = []
+        # (kept uid, source of a chunk dropped as its near-duplicate).
+        self._pending_dependents: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def reset(self) -> None:
+        """Forget the stored signatures (before a full re-ingest)."""
+        if self.store is not None and self.record:
+            self.store.clear(self.namespace)
+        self._loaded = True
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if self.store is None:
+            return
+        stored = self.store.load(self.namespace)
+        for uid, source, signature in stored:
+            self._add(uid, source, signature, stored=True)
+        logger.info(f"Loaded {len(stored)} chunk signatures for {self.namespace}")
+
+    def _keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows : (i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def _add(self, uid: str, source: str, signature: np.ndarray, stored: bool) -> None:
+        entry = len(self._entries)
+        self._entries.append((uid, source, signature, stored))
+        for band, key in zip(self._buckets, self._keys(signature)):
+            band.setdefault(key, []).append(entry)
+
+    def _duplicate_of(self, source: str, signature: np.ndarray) -> Optional[Tuple[str, str, np.ndarray, bool]]:
+        candidates = set()
+        for band, key in zip(self._buckets, self._keys(signature)):
+            candidates.update(band.get(key, ()))
+        for entry in sorted(candidates):
+            uid, entry_source, entry_signature, stored = self._entries[entry]
+            # The re-ingested source's stored chunks are about to be replaced.
+            if stored and entry_source == source:
+                continue
+            if np.count_nonzero(entry_signature == signature) < self.threshold * len(signature):
+                continue
+            if stored and self.exists is not None and not self.exists([uid])[0]:
+                continue
+            return self._entries[entry]
+        return None
+
+    def filter(self, docs: Iterable[Document]) -> Iterator[Document]:
+        """Yield the documents that are not near-duplicates of earlier ones."""
+        try:
+            for doc in docs:
+                signature = self.hasher.signature(doc.page_content)
+                source = str(doc.metadata.get(self.source_id_key, ""))
+                with self._lock:
+                    self._load()
+                    duplicate = self._duplicate_of(source, signature)
+                    if duplicate is None:
+                        uid = document_uid(doc)
+                        self._add(uid, source, signature, stored=False)
+                        self._pending.append((uid, source, signature))
+                        self.stats["kept"] += 1
+                    else:
+                        self.stats["dropped"] += 1
+                        self.stats["dropped_against_index"] += duplicate[3]
+                        if duplicate[1] != source:
+                            self._pending_dependents.append((duplicate[0], source))
+                if duplicate is None:
+                    if len(self._pending) >= 256:
+                        self.flush()
+                    yield doc
+        finally:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+            dependents, self._pending_dependents = self._pending_dependents, []
+        if self.store is None or not self.record:
+            return
+        if pending:
+            self.store.put_many(self.namespace, pending)
+        if dependents:
+            self.store.add_dependents(self.namespace, dependents)
+
+    def invalidate_dependents(self, batch_size: int = 1000) -> List[str]:
+        """Invalidate the sources that depend on chunks no longer indexed.
+
+        Call it once an ingest has returned. Returns the invalidated sources.
+        """
+        if self.store is None or self.exists is None or self.invalidate is None or not self.record:
+            return []
+        dependents = self.store.load_dependents(self.namespace)
+        uids = sorted({uid for uid, _ in dependents})
+        gone = set()
+        for i in range(0, len(uids), batch_size):
+            batch = uids[i : i + batch_size]
+            gone.update(uid for uid, indexed in zip(batch, self.exists(batch)) if not indexed)
+        sources = sorted({source for uid, source in dependents if uid in gone})
+        if sources:
+            self.invalidate(sources)
+            logger.info(f"{len(sources)} sources depended on deleted chunks; they will be re-split")
+        # Only once the sources are invalidated, or a failure would lose them.
+        self.store.forget_dependents(self.namespace, sorted(gone))
+        return sources
+
+
+def get_near_duplicate_filter(record_manager, record: bool = True) -> Optional[NearDuplicateFilter]:
+    """The dedup stage for the index behind ``record_manager``, or None if it is off."""
+    if not DEDUP_THRESHOLD:
+        return None
+    return NearDuplicateFilter(
+        record_manager.namespace,
+        SignatureStore(DEDUP_SIGNATURES_PATH),
+        exists=record_manager.exists,
+        invalidate=lambda source_ids: forget_sources(record_manager, source_ids),
+        threshold=DEDUP_THRESHOLD,
+        record=record,
+    )
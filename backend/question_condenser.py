@@ -0,0 +1,143 @@
+"""Decide locally whether a follow-up question needs the condense LLM call.
+
+Most follow-up questions are self-contained and can go straight to retrieval. A
+question is only rephrased when it looks like it leans on the conversation:
+
+1. it contains a pronoun/demonstrative or starts like an ellipsis ("what about",
+   "还有", a trailing "呢"), or
+2. it is short and its embedding is close to one of the recent human turns.
+
+Rephrased questions are cached on (history hash, question), so regenerating or
+re-asking in the same conversation never pays for the LLM call twice.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage, HumanMessage
+
+_ANAPHORA = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|theirs|he|him|his|she|her|"
+    r"one|ones|former|latter|above|same|previous|aforementioned)\b"
+    # 其他/其它 mean "other".
+    r"|(?<!其)[它他她]|[这那][个些种样]|上述|前面|刚才|上面"
+    # 其/该 only as determiners: 其中, 该项, or opening a clause (其原理, 该方法),
+    # not inside words (应该, 其实) or as "should" (该怎么).
+    r"|其中|其余|该[个种项类款条篇部]"
+    r"|(?:^|[，,。；;：:\s])(?:其(?![他它实次])|该(?![怎如不是死]))",
+    re.IGNORECASE,
+)
+_ELLIPSIS_START = re.compile(
+    r"^\s*(and|or|but|also|so|then|what about|how about|why not|same for|"
+    r"what if|in that case|还有|然后|如果是|换成|另外|再"
+    # 那/那么 as "then", not 那不勒斯 or 那么多.
+    r"|那么(?![多少大小快慢好])|那(?=[，,\s])|那如果)",
+    re.IGNORECASE,
+)
+_ELLIPSIS_END = re.compile(r"呢\s*[?？]?\s*$")
+_WORD = re.compile(r"[\u4e00-\u9fff]|\w+")
+
+
+def looks_dependent(question: str) -> bool:
+    """Pronoun/ellipsis heuristics for questions that refer back to the chat."""
+    return bool(
+        _ANAPHORA.search(question)
+        or _ELLIPSIS_START.match(question)
+        or _ELLIPSIS_END.search(question)
+    )
+
+
+def history_key(chat_history: Sequence[BaseMessage], question: str) -> str:
+    digest = hashlib.sha256()
+    for message in chat_history:
+        digest.update(f"{message.type}\x00{message.content}\x01".encode("utf-8"))
+    digest.update(question.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class QuestionCondenser:
+    def __init__(
+        self,
+        embeddings: Optional[Embeddings] = None,
+        similarity_threshold: float = 0.8,
+        short_question_words: int = 8,
+        recent_turns: int = 2,
+        cache_size: int = 10_000,
+    ):
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.short_question_words = short_question_words
+        self.recent_turns = recent_turns
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.skipped = 0
+        self.rephrased = 0
+        self.cache_hits = 0
+
+    def cache_info(self) -> dict:
+        return {
+            "skipped": self.skipped,
+            "rephrased": self.rephrased,
+            "cache_hits": self.cache_hits,
+            "size": len(self._cache),
+        }
+
+    def _recent_questions(self, chat_history: Sequence[BaseMessage]) -> List[str]:
+        questions = [m.content for m in chat_history if isinstance(m, HumanMessage)]
+        return questions[-self.recent_turns :]
+
+    def _is_short(self, question: str) -> bool:
+        return len(_WORD.findall(question)) <= self.short_question_words
+
+    def _close_to_history(self, vectors: List[List[float]]) -> bool:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+        return bool((matrix[1:] @ matrix[0]).max() >= self.similarity_threshold)
+
+    def needs_rephrase(self, question: str, chat_history: Sequence[BaseMessage]) -> bool:
+        if not chat_history:
+            return False
+        if looks_dependent(question):
+            return True
+        recent = self._recent_questions(chat_history)
+        if self.embeddings is None or not recent or not self._is_short(question):
+            return False
+        return self._close_to_history(self.embeddings.embed_documents([question, *recent]))
+
+    async def aneeds_rephrase(
+        self, question: str, chat_history: Sequence[BaseMessage]
+    ) -> bool:
+        if not chat_history:
+            return False
+        if looks_dependent(question):
+            return True
+        recent = self._recent_questions(chat_history)
+        if self.embeddings is None or not recent or not self._is_short(question):
+            return False
+        vectors = await self.embeddings.aembed_documents([question, *recent])
+        return self._close_to_history(vectors)
+
+    def cached(self, key: str) -> Optional[str]:
+        with self._lock:
+            condensed = self._cache.get(key)
+            if condensed is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            return condensed
+
+    def remember(self, key: str, condensed: str) -> None:
+        with self._lock:
+            self.rephrased += 1
+            self._cache[key] = condensed
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def skip(self) -> None:
+        with self._lock:
+            self.skipped += 1
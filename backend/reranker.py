@@ -0,0 +1,173 @@
+"""Rerank over-fetched chunks and keep only the ones worth their prompt tokens.
+
+The base retriever returns ``fetch_k`` candidates. They are scored against the
+question in one batched call, then taken best first until ``k`` chunks are kept,
+a score falls below ``min_score`` or the next chunk would overflow
+``max_tokens``. Fewer, better chunks mean a shorter prompt and an earlier first
+token.
+
+With ``rrf_k`` set, "best" fuses the scorer's ranking with the base retriever's
+own (the hybrid retriever's BM25 + dense fusion) by reciprocal rank, so the
+rerank refines that order instead of replacing it.
+
+Two scorers:
+
+- ``EmbeddingScorer``: cosine similarity with the vectors the index already
+  holds for the candidates (``StoredVectors``), so scoring embeds nothing but
+  the question, which the dense search has just embedded (a cache hit). This is
+  the dense search's own score, so it only changes the order under hybrid
+  search, where BM25 brought in candidates; over a dense-only retriever it
+  reproduces the retrieval order and just applies ``k``, ``min_score`` and the
+  token budget.
+- ``CrossEncoderScorer``: a small sentence-transformers cross-encoder on CPU.
+  More accurate, at the cost of a forward pass over all candidates.
+"""
+import asyncio
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+DEFAULT_CROSS_ENCODER = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+
+def _cosine(
+    query: Sequence[float], docs: List[Document], vectors: Dict[str, Sequence[float]]
+) -> np.ndarray:
+    """Cosine similarity of each document's stored vector; NaN where there is none."""
+    scores = np.full(len(docs), np.nan, dtype=np.float32)
+    found = [i for i, doc in enumerate(docs) if doc.id in vectors]
+    if not found:
+        return scores
+    matrix = np.asarray([vectors[docs[i].id] for i in found], dtype=np.float32)
+    vector = np.asarray(query, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    scores[found] = matrix @ vector / np.where(norms == 0, 1, norms)
+    return scores
+
+
+class EmbeddingScorer:
+    """Cosine similarity with the stored vectors of the candidates.
+
+    ``vectors`` is the index's ``vector_store_manage.StoredVectors``. Candidates
+    without an id or a stored vector score NaN and keep their base rank.
+    """
+
+    def __init__(self, embeddings: Embeddings, vectors):
+        self.embeddings = embeddings
+        self.vectors = vectors
+
+    def score(self, query: str, docs: List[Document]) -> np.ndarray:
+        ids = [doc.id for doc in docs if doc.id]
+        return _cosine(self.embeddings.embed_query(query), docs, self.vectors.get(ids))
+
+    async def ascore(self, query: str, docs: List[Document]) -> np.ndarray:
+        ids = [doc.id for doc in docs if doc.id]
+        query_vector, vectors = await asyncio.gather(
+            self.embeddings.aembed_query(query), self.vectors.aget(ids)
+        )
+        return _cosine(query_vector, docs, vectors)
+
+
+class CrossEncoderScorer:
+    def __init__(self, model_name: str = DEFAULT_CROSS_ENCODER, max_length: int = 512):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError(
+                "RERANKER=cross-encoder needs sentence-transformers: "
+                "pip install sentence-transformers"
+            ) from e
+        self.model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+
+    def score(self, query: str, docs: List[Document]) -> np.ndarray:
+        # Single-label models output a sigmoid relevance in [0, 1].
+        return np.asarray(
+            self.model.predict(
+                [(query, doc.page_content) for doc in docs],
+                batch_size=max(len(docs), 1),
+                show_progress_bar=False,
+            ),
+            dtype=np.float32,
+        )
+
+    async def ascore(self, query: str, docs: List[Document]) -> np.ndarray:
+        # CPU-bound: keep it off the event loop.
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.score, query, docs
+        )
+
+
+class RerankingRetriever(BaseRetriever):
+    """Reranks the documents of ``base`` and keeps those that fit the budget.
+
+    ``base`` should return more candidates than ``k``, best first. With
+    ``rrf_k`` the documents are ordered by ``1 / (rrf_k + rank)`` summed over the
+    base and the scorer rankings; without it by score alone. The best document is
+    kept even when it alone exceeds ``max_tokens``, unless it scores below
+    ``min_score``.
+    """
+
+    base: BaseRetriever
+    scorer: object
+    count_tokens: Callable[[str], int]
+    k: int = 6
+    min_score: Optional[float] = None
+    max_tokens: Optional[int] = None
+    rrf_k: Optional[int] = 60
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    def order(self, scores: np.ndarray) -> np.ndarray:
+        """Document positions, best first. NaN scores sort last, or keep their
+        base rank when fusing."""
+        by_score = np.argsort(np.where(np.isnan(scores), np.inf, -scores), kind="stable")
+        if self.rrf_k is None:
+            return by_score
+        base_ranks = np.arange(1, len(scores) + 1)
+        score_ranks = np.empty(len(scores))
+        score_ranks[by_score] = base_ranks
+        score_ranks = np.where(np.isnan(scores), base_ranks, score_ranks)
+        fused = 1.0 / (self.rrf_k + base_ranks) + 1.0 / (self.rrf_k + score_ranks)
+        return np.argsort(-fused, kind="stable")
+
+    def select(self, docs: List[Document], scores: np.ndarray) -> List[Document]:
+        kept: List[Document] = []
+        used = 0
+        for i in self.order(scores)[: self.k]:
+            if self.min_score is not None and scores[i] < self.min_score:
+                if self.rrf_k is None:
+                    break
+                continue
+            tokens = self.count_tokens(docs[i].page_content)
+            if kept and self.max_tokens is not None and used + tokens > self.max_tokens:
+                break
+            kept.append(docs[i])
+            used += tokens
+        return kept
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        docs = self.base.invoke(query, config={"callbacks": run_manager.get_child()})
+        if not docs:
+            return docs
+        scores = self.scorer.score(query, docs)
+        return self.select(docs, scores)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        docs = await self.base.ainvoke(
+            query, config={"callbacks": run_manager.get_child()}
+        )
+        if not docs:
+            return docs
+        scores = await self.scorer.ascore(query, docs)
+        return self.select(docs, scores)
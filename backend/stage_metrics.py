@@ -0,0 +1,330 @@
+"""Per-stage latency of the chat chain, recorded in process for ``/metrics``.
+
+A callback handler on the answer chain follows the runs of a sampled share of
+requests (``sample_rate``) and, when the request finishes, adds its timings to
+histograms:
+
+- ``condense``: turning the question into a standalone question;
+- ``retrieve``: the ``FindDocs`` run, of which ``embed`` is spent waiting for
+  the embeddings provider and ``search`` is the rest (vector and keyword
+  search, reranking);
+- ``prompt``: fitting the retrieved documents into the prompt budget;
+- ``ttft`` and ``generate``: the answer model's time to first streamed token
+  and its whole run;
+- ``total``: the whole request.
+
+Prompt and completion tokens of the answer model go to a second histogram. The
+handler runs inline with the chain and does nothing for requests that were not
+sampled beyond a dictionary lookup per callback, so it can stay on under load.
+
+Embedding calls have no callbacks; ``stage_timer`` times them for the request
+running in the current context. ``embed`` also counts embeddings made while
+condensing the question.
+"""
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+# Run name -> stage it times.
+STAGE_RUNS = {
+    "RouteDependingOnChatHistory": "condense",
+    "FindDocs": "retrieve",
+    "FormatDocs": "prompt",
+    "GenerateResponse": "generate",
+}
+
+_current_request: ContextVar[Optional["_Request"]] = ContextVar(
+    "stage_metrics_request", default=None
+)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self) -> Tuple[List[Tuple[str, int]], float, int]:
+        """Cumulative (le, count) pairs, the sum and the count."""
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative, running = [], 0
+        for bound, count in zip(self.buckets, counts):
+            running += count
+            cumulative.append((format_value(float(bound)), running))
+        running += counts[-1]
+        cumulative.append(("+Inf", running))
+        return cumulative, total, running
+
+
+class _Request:
+    __slots__ = ("seconds", "tokens", "retrieving", "retrieve_embed", "last_end", "generating")
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.tokens: Dict[str, int] = {}
+        self.retrieving = 0
+        self.retrieve_embed = 0.0
+        self.last_end = 0.0
+        self.generating = False
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Add the time spent in the block to ``stage`` of the current request."""
+    request = _current_request.get()
+    if request is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        request.add(stage, seconds)
+        if request.retrieving and start >= request.last_end:
+            request.retrieve_embed += seconds
+
+
+class _Run:
+    __slots__ = ("request", "stage", "start", "messages", "first_token")
+
+    def __init__(self, request: _Request, stage: Optional[str]):
+        self.request = request
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.messages: Optional[List[BaseMessage]] = None
+        self.first_token = False
+
+
+class StageMetrics(BaseCallbackHandler):
+    """Callback handler that records stage timings of sampled requests."""
+
+    run_inline = True
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        sample_rate: float = 1.0,
+        stage_runs: Optional[Dict[str, str]] = None,
+    ):
+        self.count_tokens = count_tokens
+        self.sample_rate = sample_rate
+        self.stage_runs = STAGE_RUNS if stage_runs is None else stage_runs
+        self.stages: Dict[str, Histogram] = {}
+        self.tokens: Dict[str, Histogram] = {}
+        self.requests = 0
+        self.sampled = 0
+        self.errors = 0
+        # Runs of sampled requests, by run id.
+        self._runs: Dict[UUID, _Run] = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, histograms: Dict[str, Histogram], key: str, value: float, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(key, Histogram(buckets))
+        histogram.observe(value)
+
+    # -- run bookkeeping ------------------------------------------------------
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: Optional[str]):
+        if parent_run_id is None:
+            self.requests += 1
+            if random.random() >= self.sample_rate:
+                _current_request.set(None)
+                return None
+            self.sampled += 1
+            request = _Request()
+            _current_request.set(request)
+            run = self._runs[run_id] = _Run(request, "total")
+            return run
+        parent = self._runs.get(parent_run_id)
+        if parent is None:
+            return None
+        stage = self.stage_runs.get(name)
+        if stage is None and parent.stage == "generate":
+            # Only the model run of the answer step is timed, but it may be
+            # nested in configurable alternatives.
+            stage = "generate"
+        run = self._runs[run_id] = _Run(parent.request, stage)
+        if stage == "retrieve":
+            run.request.retrieving += 1
+        return run
+
+    def _end(self, run_id: UUID, error: bool = False) -> Optional[_Run]:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return None
+        request, now = run.request, time.perf_counter()
+        if run.stage == "total":
+            if error:
+                self.errors += 1
+            else:
+                self._finish(request, now - run.start)
+        elif run.stage in ("condense", "retrieve", "prompt"):
+            # In a streamed sequence every step starts with the stream, before
+            # its input is ready. The stages run one after another, so each is
+            # timed from the end of the previous one at the earliest.
+            request.add(run.stage, now - max(run.start, request.last_end))
+            request.last_end = now
+            if run.stage == "retrieve":
+                request.retrieving -= 1
+        return run
+
+    def _finish(self, request: _Request, seconds: float) -> None:
+        if "retrieve" in request.seconds:
+            request.add("search", request.seconds["retrieve"] - request.retrieve_embed)
+        request.add("total", seconds)
+        for stage, value in request.seconds.items():
+            self._observe(self.stages, stage, value, SECONDS_BUCKETS)
+        for kind, value in request.tokens.items():
+            self._observe(self.tokens, kind, value, TOKEN_BUCKETS)
+
+    # -- callbacks -------------------------------------------------------------
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get("name"))
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get("name"))
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_chat_model_start(
+        self, serialized, messages, *, run_id, parent_run_id=None, **kwargs
+    ):
+        run = self._start(run_id, parent_run_id, kwargs.get("name"))
+        # Model runs started by the answer model (the router's providers, a
+        # cache's model) are not timed again.
+        if run is not None and run.stage == "generate" and not run.request.generating:
+            run.request.generating = True
+            run.messages = messages[0]
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get("name"))
+
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None and run.messages is not None and not run.first_token and token:
+            run.first_token = True
+            run.request.add("ttft", time.perf_counter() - run.start)
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        self._end(run_id)
+        if run is None or run.messages is None:
+            return
+        request = run.request
+        request.generating = False
+        request.add("generate", time.perf_counter() - run.start)
+        generation = response.generations[0][0] if response.generations else None
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+        if usage:
+            prompt_tokens, completion_tokens = usage["input_tokens"], usage["output_tokens"]
+        else:
+            prompt_tokens = sum(
+                self.count_tokens(m.content) for m in run.messages if isinstance(m.content, str)
+            )
+            completion_tokens = self.count_tokens(generation.text) if generation else 0
+        request.tokens["prompt"] = request.tokens.get("prompt", 0) + prompt_tokens
+        request.tokens["completion"] = request.tokens.get("completion", 0) + completion_tokens
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._end(run_id, error=True)
+        if run is not None and run.messages is not None:
+            run.request.generating = False
+
+    # -- exposition ------------------------------------------------------------
+
+    def render(self) -> str:
+        lines = format_metric(
+            "chat_requests_total", "counter", "Chat requests started.",
+            [({}, self.requests)],
+        )
+        lines += format_metric(
+            "chat_requests_sampled_total", "counter", "Chat requests timed by stage.",
+            [({}, self.sampled)],
+        )
+        lines += format_metric(
+            "chat_requests_failed_total", "counter", "Sampled chat requests that failed.",
+            [({}, self.errors)],
+        )
+        lines += format_histograms(
+            "chat_stage_seconds", "Time per chat request spent in each stage.",
+            "stage", self.stages,
+        )
+        lines += format_histograms(
+            "chat_llm_tokens", "Answer model tokens per chat request.", "kind", self.tokens
+        )
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def format_metric(
+    name: str, kind: str, help: str, samples: Iterable[Tuple[Dict[str, Any], float]]
+) -> List[str]:
+    """Lines of one metric in the Prometheus text format."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(labels)} {format_value(value)}")
+    return lines
+
+
+def format_histograms(
+    name: str, help: str, label: str, histograms: Dict[str, Histogram]
+) -> List[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    for key in sorted(histograms):
+        buckets, total, count = histograms[key].samples()
+        for le, value in buckets:
+            lines.append(f"{name}_bucket{_labels({label: key, 'le': le})} {value}")
+        lines.append(f"{name}_sum{_labels({label: key})} {format_value(total)}")
+        lines.append(f"{name}_count{_labels({label: key})} {count}")
+    return lines
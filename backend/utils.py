@@ -1,8 +1,115 @@
 import os
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+from typing import List
+
+import tiktoken
 from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
 # from langchain_openai import OpenAIEmbeddings
 from langchain_community.embeddings import ZhipuAIEmbeddings
 
+from async_http import get_async_client
+from embedding_cache import CachedEmbeddings, EmbeddingStore
+from llm_cache import CachedChatModel, LLMResponseStore
+
+CACHE_DIR = Path(__file__).parent.parent / ".cache"
+ZHIPUAI_EMBEDDINGS_URL = "https://open.bigmodel.cn/api/paas/v4/embeddings"
+# embedding-3 accepts at most 64 inputs per request.
+ZHIPUAI_MAX_BATCH = 64
+
+_embeddings_model = None
+_embeddings_lock = Lock()
+_llm_response_store = None
+_llm_response_store_lock = Lock()
+
+
+class AsyncZhipuAIEmbeddings(ZhipuAIEmbeddings):
+    """ZhipuAI embeddings with native async calls over the pooled HTTP client.
+
+    The base class only has a sync SDK client, so its async methods would hold a
+    default-executor thread for the whole request.
+    """
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        client = get_async_client()
+        vectors: List[List[float]] = []
+        for start in range(0, len(texts), ZHIPUAI_MAX_BATCH):
+            body = {"model": self.model, "input": texts[start : start + ZHIPUAI_MAX_BATCH]}
+            if self.dimensions is not None:
+                body["dimensions"] = self.dimensions
+            response = await client.post(
+                ZHIPUAI_EMBEDDINGS_URL,
+                json=body,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+            )
+            response.raise_for_status()
+            data = sorted(response.json()["data"], key=lambda item: item["index"])
+            vectors.extend(item["embedding"] for item in data)
+        return vectors
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
 def get_embeddings_model() -> Embeddings:
-    return ZhipuAIEmbeddings(model="embedding-3", dimensions=1024, api_key=os.environ["ZHIPUAI_API_KEY"])
-    # return OpenAIEmbeddings(model="text-embedding-3-small", chunk_size=200)
\ No newline at end of file
+    """Shared embeddings model, cached by content hash in memory and on disk.
+
+    Set EMBEDDING_CACHE_PATH to move the SQLite file, or to an empty string to keep
+    the cache in memory only.
+    """
+    global _embeddings_model
+    with _embeddings_lock:
+        if _embeddings_model is None:
+            underlying = AsyncZhipuAIEmbeddings(
+                model="embedding-3", dimensions=1024, api_key=os.environ["ZHIPUAI_API_KEY"]
+            )
+            # return OpenAIEmbeddings(model="text-embedding-3-small", chunk_size=200)
+            cache_path = os.environ.get(
+                "EMBEDDING_CACHE_PATH", str(CACHE_DIR / "embeddings.sqlite")
+            )
+            _embeddings_model = CachedEmbeddings(
+                underlying,
+                store=EmbeddingStore(cache_path) if cache_path else None,
+                max_memory_items=int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000")),
+            )
+        return _embeddings_model
+
+
+def cache_chat_model(model: BaseChatModel) -> BaseChatModel:
+    """Wrap ``model`` in the shared response cache, with request coalescing.
+
+    Responses are kept in memory (LLM_CACHE_SIZE per model) and in the SQLite
+    file at LLM_CACHE_PATH; set it to an empty string to keep them in memory only.
+    LLM_CACHE_SIZE=0 returns ``model`` unwrapped.
+    """
+    global _llm_response_store
+    max_memory_items = int(os.environ.get("LLM_CACHE_SIZE", "1000"))
+    if not max_memory_items:
+        return model
+    with _llm_response_store_lock:
+        cache_path = os.environ.get("LLM_CACHE_PATH", str(CACHE_DIR / "llm.sqlite"))
+        if _llm_response_store is None and cache_path:
+            _llm_response_store = LLMResponseStore(cache_path)
+    return CachedChatModel(
+        underlying=model,
+        store=_llm_response_store,
+        max_memory_items=max_memory_items,
+    )
+
+
+@lru_cache(maxsize=1)
+def _token_encoding() -> tiktoken.Encoding:
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def token_length(text: str) -> int:
+    """Tokens of ``text``, uncached; for text seen once, such as the corpus at ingest."""
+    return len(_token_encoding().encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=10_000)
+def count_tokens(text: str) -> int:
+    """Prompt tokens of ``text``; cached, as the same chunks come back often."""
+    return token_length(text)
@@ -1,20 +1,280 @@
-"""Database connection management for Weaviate."""
+"""Vector store management: one store per index, on Weaviate or local disk."""
+import json
 import os
+import re
 import weaviate
 
-from typing import Optional
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence
 from langchain_community.vectorstores import Weaviate
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from pathlib import Path
 from threading import Lock
 
+from async_http import get_async_client
+from hybrid_retriever import HybridRetriever
+from keyword_index import KeywordIndex
+from local_vector_store import LocalVectorStore
 from utils import get_embeddings_model
 
+# Index names become Weaviate classes and directory names under the local store
+# and keyword index roots, so nothing that could leave those directories.
+INDEX_NAME_PATTERN = re.compile(r"[A-Za-z][_0-9A-Za-z]{0,127}")
+
+
+def validate_index_name(index_name: str) -> str:
+    """Return ``index_name``, or raise ValueError if it is not a valid index name."""
+    if not isinstance(index_name, str) or not INDEX_NAME_PATTERN.fullmatch(index_name):
+        raise ValueError(
+            f"Invalid index name {index_name!r}: expected a letter followed by up to"
+            " 127 letters, digits or underscores"
+        )
+    return index_name
+
+
+class AsyncWeaviateRetriever(BaseRetriever):
+    """Dense retriever over a Weaviate index with a fully async path.
+
+    The sync path goes through the Weaviate v3 client. The async path embeds with
+    ``aembed_query`` and sends the nearVector GraphQL query over the pooled
+    ``httpx`` client, so concurrent chats don't each hold an executor thread.
+    """
+
+    vectorstore: Weaviate
+    url: str
+    api_key: Optional[str] = None
+    k: int = 6
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        docs = self.vectorstore.similarity_search(query, k=self.k, additional=["id"])
+        for doc in docs:
+            doc.id = doc.metadata.pop("_additional")["id"]
+        return docs
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector = await self.vectorstore.embeddings.aembed_query(query)
+        return await self.asearch_by_vector(vector)
+
+    async def asearch_by_vector(self, vector: List[float]) -> List[Document]:
+        index_name = self.vectorstore._index_name
+        text_key = self.vectorstore._text_key
+        fields = " ".join(self.vectorstore._query_attrs)
+        query = (
+            f"{{Get{{{index_name}(nearVector:{{vector:{json.dumps(vector)}}} "
+            f"limit:{self.k}){{{fields} _additional{{id}}}}}}}}"
+        )
+        docs = []
+        for res in await _aget_objects(self.url, self.api_key, query, index_name):
+            text = res.pop(text_key)
+            _id = res.pop("_additional")["id"]
+            docs.append(Document(id=_id, page_content=text, metadata=res))
+        return docs
+
+
+async def _aget_objects(
+    url: str, api_key: Optional[str], query: str, index_name: str
+) -> List[dict]:
+    """Objects returned by a GraphQL Get on ``index_name``, over the pooled client."""
+    headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+    response = await get_async_client().post(
+        f"{url.rstrip('/')}/v1/graphql", json={"query": query}, headers=headers
+    )
+    response.raise_for_status()
+    result = response.json()
+    if "errors" in result:
+        raise ValueError(f"Error during query: {result['errors']}")
+    return result["data"]["Get"][index_name]
+
+
+def _vectors_query(index_name: str, ids: Sequence[str]) -> str:
+    """GraphQL Get of the stored vectors of objects ``ids`` of an index."""
+    operands = ",".join(
+        f'{{path:["id"],operator:Equal,valueText:{json.dumps(_id)}}}' for _id in ids
+    )
+    return (
+        f"{{Get{{{index_name}(where:{{operator:Or,operands:[{operands}]}} "
+        f"limit:{len(ids)}){{_additional{{id vector}}}}}}}}"
+    )
+
+
+class StoredVectors:
+    """The vectors an index already holds, looked up by document id.
+
+    Lets rerankers score candidates without embedding their text again. Ids the
+    index doesn't know are left out of the result.
+    """
+
+    def __init__(self, backend: "VectorStoreBackend", vectorstore: VectorStore):
+        self.backend = backend
+        self.vectorstore = vectorstore
+
+    def get(self, ids: Sequence[str]) -> Dict[str, Sequence[float]]:
+        return self.backend.get_vectors(self.vectorstore, ids) if ids else {}
+
+    async def aget(self, ids: Sequence[str]) -> Dict[str, Sequence[float]]:
+        return await self.backend.aget_vectors(self.vectorstore, ids) if ids else {}
+
+
+class VectorStoreBackend:
+    """Where VectorStoreManager keeps its indexes.
+
+    Subclasses create the vector store and retriever for an index name, and report
+    whether the database is reachable.
+    """
+
+    def create_vector_store(self, index_name: str, embeddings: Embeddings) -> VectorStore:
+        raise NotImplementedError
+
+    def create_retriever(self, vectorstore: VectorStore, k: int) -> BaseRetriever:
+        return vectorstore.as_retriever(search_kwargs=dict(k=k))
+
+    def count(self, vectorstore: VectorStore) -> int:
+        """Number of vectors stored in an index."""
+        raise NotImplementedError
+
+    def get_vectors(self, vectorstore: VectorStore, ids: Sequence[str]) -> Dict[str, Sequence[float]]:
+        """Stored vectors of documents ``ids``; empty if the backend can't tell."""
+        return {}
+
+    async def aget_vectors(
+        self, vectorstore: VectorStore, ids: Sequence[str]
+    ) -> Dict[str, Sequence[float]]:
+        return self.get_vectors(vectorstore, ids)
+
+    def is_ready(self) -> bool:
+        return True
+
+
+class WeaviateBackend(VectorStoreBackend):
+    """Remote Weaviate cluster from WEAVIATE_URL / WEAVIATE_API_KEY.
+
+    The client is only created on first use, so importing the app does not need the
+    Weaviate environment variables.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._lock = Lock()
+
+    @property
+    def client(self) -> weaviate.Client:
+        with self._lock:
+            if self._client is None:
+                self._client = weaviate.Client(
+                    url=os.environ["WEAVIATE_URL"],
+                    auth_client_secret=weaviate.AuthApiKey(api_key=os.environ["WEAVIATE_API_KEY"]),
+                )
+            return self._client
+
+    def create_vector_store(self, index_name: str, embeddings: Embeddings) -> VectorStore:
+        return Weaviate(
+            client=self.client,
+            index_name=index_name,
+            text_key="text", # TODO: 这是啥？
+            embedding=embeddings,
+            by_text=False,
+            attributes=["source", "title"],
+        )
+
+    def create_retriever(self, vectorstore: VectorStore, k: int) -> BaseRetriever:
+        # Non-blocking async path for the chat endpoints.
+        return AsyncWeaviateRetriever(
+            vectorstore=vectorstore,
+            url=os.environ["WEAVIATE_URL"],
+            api_key=os.environ.get("WEAVIATE_API_KEY"),
+            k=k,
+        )
+
+    def count(self, vectorstore: VectorStore) -> int:
+        index_name = vectorstore._index_name
+        result = self.client.query.aggregate(index_name).with_meta_count().do()
+        return result["data"]["Aggregate"][index_name][0]["meta"]["count"]
+
+    def get_vectors(self, vectorstore: VectorStore, ids: Sequence[str]) -> Dict[str, Sequence[float]]:
+        index_name = vectorstore._index_name
+        result = self.client.query.raw(_vectors_query(index_name, ids))
+        if "errors" in result:
+            raise ValueError(f"Error during query: {result['errors']}")
+        objects = result["data"]["Get"][index_name]
+        return {obj["_additional"]["id"]: obj["_additional"]["vector"] for obj in objects}
+
+    async def aget_vectors(
+        self, vectorstore: VectorStore, ids: Sequence[str]
+    ) -> Dict[str, Sequence[float]]:
+        index_name = vectorstore._index_name
+        objects = await _aget_objects(
+            os.environ["WEAVIATE_URL"],
+            os.environ.get("WEAVIATE_API_KEY"),
+            _vectors_query(index_name, ids),
+            index_name,
+        )
+        return {obj["_additional"]["id"]: obj["_additional"]["vector"] for obj in objects}
+
+    def is_ready(self) -> bool:
+        try:
+            return self.client.is_ready()
+        except Exception:
+            return False
+
+
+class LocalBackend(VectorStoreBackend):
+    """Embedded indexes under LOCAL_VECTOR_STORE_DIR, searched in-process.
+
+    Indexes from LOCAL_ANN_MIN_ROWS rows on are searched through an IVF index;
+    LOCAL_ANN_NPROBE (recall vs. latency) and LOCAL_ANN_NLIST tune it. An index
+    can only be open in one process: run a single API worker with this backend.
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or os.environ.get(
+            "LOCAL_VECTOR_STORE_DIR", str(Path(__file__).parent.parent / ".vector_store")
+        )
+
+    def create_vector_store(self, index_name: str, embeddings: Embeddings) -> VectorStore:
+        nlist = os.environ.get("LOCAL_ANN_NLIST")
+        return LocalVectorStore(
+            os.path.join(self.root, index_name),
+            embeddings,
+            attributes=["source", "title"],
+            ann_min_rows=int(os.environ.get("LOCAL_ANN_MIN_ROWS", "20000")),
+            nprobe=int(os.environ.get("LOCAL_ANN_NPROBE", "16")),
+            nlist=int(nlist) if nlist else None,
+        )
+
+    def count(self, vectorstore: VectorStore) -> int:
+        return len(vectorstore)
+
+    def get_vectors(self, vectorstore: VectorStore, ids: Sequence[str]) -> Dict[str, Sequence[float]]:
+        return vectorstore.get_vectors(ids)
+
+
+BACKENDS = {
+    "weaviate": WeaviateBackend,
+    "local": LocalBackend,
+}
+
 
 class VectorStoreManager:
-    """Singleton class for managing Weaviate VectorStore."""
+    """Singleton class for managing the VectorStore of each index.
+
+    VECTOR_STORE_BACKEND picks where indexes live: "weaviate" (default) or "local".
+    Every index also gets a BM25 keyword index under KEYWORD_INDEX_DIR, and unless
+    HYBRID_SEARCH is "false" retrievers fuse both searches.
+    """
     _instance: Optional['VectorStoreManager'] = None
     _lock = Lock()
-    _client = None # weaviate database client
-    
+
     def __new__(cls):
         with cls._lock:
             if cls._instance is None:
@@ -22,55 +282,108 @@ class VectorStoreManager:
         return cls._instance
     
     def __init__(self):
-        # create weaviate client， only one， 奇怪，这里又没锁， 为什么能实现 singleton weaviate client ?
         if hasattr(self, '_initialized'): # 这tm不是对象的属性吗, 这里为什么要判断啊， _new_不是已经保证单例了吗
             return
-        if self._client is None:
-            self._client = weaviate.Client(
-                url=os.environ["WEAVIATE_URL"],
-                auth_client_secret=weaviate.AuthApiKey(api_key=os.environ["WEAVIATE_API_KEY"]),
+        name = os.environ.get("VECTOR_STORE_BACKEND", "weaviate")
+        if name not in BACKENDS:
+            raise ValueError(
+                f"Unknown VECTOR_STORE_BACKEND {name!r}, expected one of {sorted(BACKENDS)}"
             )
-        
-        """{index_key: vector store instance}
-        
-        self._vector_stores["combined"] = Weaviate(
-            client=self._client,
-            index_name=os.environ["WEAVIATE_DOCS_INDEX_NAME"],
-            text_key="text",
-            embedding=OpenAIEmbeddings(chunk_size=200),
-            by_text=False,
-            attributes=["source", "title"],
-        )
-        """
+        self.backend: VectorStoreBackend = BACKENDS[name]()
+
+        """{index_key: vector store instance}"""
         self._vector_stores = {}
+        self._keyword_indexes = {}
+        # Users (answer chains, ingest jobs) of each index: its stores stay cached,
+        # so they share one instance per directory, until the last one releases it.
+        self._users: Dict[str, int] = {}
+        self.keyword_index_dir = os.environ.get(
+            "KEYWORD_INDEX_DIR", str(Path(__file__).parent.parent / ".keyword_index")
+        )
+        self.hybrid_search = (os.environ.get("HYBRID_SEARCH") or "true").lower() == "true"
+        self.hybrid_fetch_k = int(os.environ.get("HYBRID_FETCH_K", "20"))
         
         self._initialized = True
 
     def get_client(self):
-        return self._client
+        """The Weaviate client, or None for backends without one."""
+        return self.backend.client if isinstance(self.backend, WeaviateBackend) else None
 
 
-    def get_vector_store(self, index_name: str):
+    def get_vector_store(self, index_name: str) -> VectorStore:
+        validate_index_name(index_name)
         with self._lock:
             if self._vector_stores.get(index_name) is None:
-                self._vector_stores[index_name] = Weaviate(
-                    client=self._client,
-                    index_name=index_name,
-                    text_key="text", # TODO: 这是啥？
-                    embedding=get_embeddings_model(), #TODO： 嵌入模型也是一个资源型变量吗？ 需要单例化吗？
-                    by_text=False,
-                    attributes=["source", "title"],
+                self._vector_stores[index_name] = self.backend.create_vector_store(
+                    index_name,
+                    get_embeddings_model(), #TODO： 嵌入模型也是一个资源型变量吗？ 需要单例化吗？
                 )
 
             return self._vector_stores[index_name]
 
+    def get_keyword_index(self, index_name: str) -> KeywordIndex:
+        validate_index_name(index_name)
+        with self._lock:
+            if self._keyword_indexes.get(index_name) is None:
+                self._keyword_indexes[index_name] = KeywordIndex(
+                    os.path.join(self.keyword_index_dir, index_name)
+                )
+            return self._keyword_indexes[index_name]
+
+    def get_retriever(self, index_name: str, k: int = 6) -> BaseRetriever:
+        """Retriever for an index with a non-blocking async path."""
+        vectorstore = self.get_vector_store(index_name)
+        if not self.hybrid_search:
+            return self.backend.create_retriever(vectorstore, k)
+        fetch_k = max(k, self.hybrid_fetch_k)
+        return HybridRetriever(
+            dense=self.backend.create_retriever(vectorstore, fetch_k),
+            keywords=self.get_keyword_index(index_name),
+            k=k,
+            fetch_k=fetch_k,
+        )
+
+    def count(self, index_name: str) -> int:
+        return self.backend.count(self.get_vector_store(index_name))
+
+    def get_stored_vectors(self, index_name: str) -> StoredVectors:
+        """Lookup of the vectors an index holds, for reranking without re-embedding."""
+        return StoredVectors(self.backend, self.get_vector_store(index_name))
+
+    def acquire(self, index_name: str) -> None:
+        """Keep the stores of an index cached until the matching ``release``."""
+        validate_index_name(index_name)
+        with self._lock:
+            self._users[index_name] = self._users.get(index_name, 0) + 1
+
+    def release(self, index_name: str) -> None:
+        """Forget the cached stores of an index once its last user released it.
+
+        Opening a second ``LocalVectorStore`` or ``KeywordIndex`` on a directory
+        another one still writes to would overwrite its rows.
+        """
+        with self._lock:
+            users = self._users.get(index_name, 0) - 1
+            if users > 0:
+                self._users[index_name] = users
+                return
+            self._users.pop(index_name, None)
+            self._vector_stores.pop(index_name, None)
+            self._keyword_indexes.pop(index_name, None)
+
+    @contextmanager
+    def use_index(self, index_name: str) -> Iterator[None]:
+        """``acquire`` an index for the duration of a block."""
+        self.acquire(index_name)
+        try:
+            yield
+        finally:
+            self.release(index_name)
+
     
     def is_ready(self) -> bool:
-        """Check if the Weaviate connection is ready."""
-        try:
-            return self._client.is_ready() if self._client else False
-        except Exception:
-            return False
+        """Check if the vector database is ready."""
+        return self.backend.is_ready()
 
 
 
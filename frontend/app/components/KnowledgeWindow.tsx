@@ -43,8 +43,14 @@ export function KnowledgeWindow(props:{conversationId: string; shouldOpenModal?:
                 body: JSON.stringify({'url': url}),
             });
 
-            const data = await response.json();
-            if (data.code === 200) {
+            let data = await response.json();
+            // 上传在后台执行，轮询任务状态直到完成或失败
+            while (data.code === 200 && data.job_id && !["done", "failed"].includes(data.stage)) {
+                await new Promise((resolve) => setTimeout(resolve, 1000));
+                const jobResponse = await fetch(`http://localhost:8080/knowledge/jobs/${data.job_id}`);
+                data = await jobResponse.json();
+            }
+            if (data.code === 200 && data.stage === "done") {
                 toast({
                     title: "添加成功",
                     description: `已成功添加知识: ${data.title}`,
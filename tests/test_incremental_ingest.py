@@ -0,0 +1,55 @@
+"""Incremental ingest of sources whose new version yields no chunks."""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from langchain.indexes import SQLRecordManager  # noqa: E402
+from langchain.text_splitter import RecursiveCharacterTextSplitter  # noqa: E402
+from langchain_core.documents import Document  # noqa: E402
+from langchain_core.embeddings import DeterministicFakeEmbedding  # noqa: E402
+from langchain_core.vectorstores import InMemoryVectorStore  # noqa: E402
+
+from incremental_ingest import incremental_ingest, plan_incremental_ingest  # noqa: E402
+from ingest_pipeline import transform_documents  # noqa: E402
+
+PAGE = "a page long enough to be kept as a chunk of its own"
+# Shorter than the 10 characters transform_documents keeps.
+STUB = "moved"
+
+
+@pytest.fixture
+def record_manager(tmp_path):
+    record_manager = SQLRecordManager("test/index", db_url=f"sqlite:///{tmp_path}/records.db")
+    record_manager.create_schema()
+    return record_manager
+
+
+def transform(docs):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    return transform_documents(docs, splitter)
+
+
+def docs(**pages):
+    return [
+        Document(page_content=content, metadata={"source": url})
+        for url, content in pages.items()
+    ]
+
+
+def test_source_without_chunks_loses_its_old_ones(record_manager):
+    vectorstore = InMemoryVectorStore(DeterministicFakeEmbedding(size=8))
+    incremental_ingest(docs(a=PAGE, b=PAGE + " too"), transform, record_manager, vectorstore)
+    assert len(vectorstore.store) == 2
+
+    report = plan_incremental_ingest(docs(a=STUB, b=PAGE + " too"), transform, record_manager)
+    assert report.chunks_to_delete == 1
+
+    stats = incremental_ingest(
+        docs(a=STUB, b=PAGE + " too"), transform, record_manager, vectorstore
+    )
+    assert stats["num_deleted"] == 1
+    assert [record["text"] for record in vectorstore.store.values()] == [PAGE + " too"]
+    assert record_manager.list_keys(group_ids=["a"]) == []
@@ -0,0 +1,114 @@
+"""Near-duplicate removal across incremental ingests.
+
+A chunk dropped as a near-duplicate of another source's chunk must come back
+once that chunk leaves the index, whether the other source changes in a later
+run or in the same one.
+"""
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+from langchain.indexes import SQLRecordManager  # noqa: E402
+from langchain.text_splitter import RecursiveCharacterTextSplitter  # noqa: E402
+from langchain_core.documents import Document  # noqa: E402
+from langchain_core.embeddings import DeterministicFakeEmbedding  # noqa: E402
+from langchain_core.vectorstores import InMemoryVectorStore  # noqa: E402
+
+from incremental_ingest import forget_sources, incremental_ingest  # noqa: E402
+from ingest_pipeline import transform_documents  # noqa: E402
+from near_dedup import NearDuplicateFilter, SignatureStore  # noqa: E402
+
+
+def text(seed: int) -> str:
+    rng = random.Random(seed)
+    return " ".join(f"word{rng.randrange(10_000)}" for _ in range(80))
+
+
+SHARED = text(1)
+# SHARED with its last word changed: a near-duplicate.
+SHARED_COPY = SHARED.rsplit(" ", 1)[0] + " changed"
+# A page of its own, then the copy: two chunks, one of them dropped.
+PAGE_B = text(5) + "\n\n" + SHARED_COPY
+
+
+class Index:
+    def __init__(self, workdir: Path):
+        self.record_manager = SQLRecordManager(
+            "test/index", db_url=f"sqlite:///{workdir}/records.db"
+        )
+        self.record_manager.create_schema()
+        self.vectorstore = InMemoryVectorStore(DeterministicFakeEmbedding(size=8))
+        self.signatures = SignatureStore(str(workdir / "signatures.sqlite"))
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+
+    def ingest(self, pages: dict) -> dict:
+        """One incremental run, as ingest.py and main.py do it."""
+        dedup = NearDuplicateFilter(
+            self.record_manager.namespace,
+            self.signatures,
+            exists=self.record_manager.exists,
+            invalidate=lambda source_ids: forget_sources(self.record_manager, source_ids),
+        )
+        docs = [
+            Document(page_content=content, metadata={"source": url})
+            for url, content in pages.items()
+        ]
+        stats = incremental_ingest(
+            docs,
+            lambda source_docs: transform_documents(source_docs, self.splitter, dedup.filter),
+            self.record_manager,
+            self.vectorstore,
+        )
+        stats["invalidated"] = dedup.invalidate_dependents()
+        return stats
+
+    def texts(self) -> set:
+        return {record["text"] for record in self.vectorstore.store.values()}
+
+
+@pytest.fixture
+def index(tmp_path):
+    return Index(tmp_path)
+
+
+def test_duplicate_comes_back_when_the_source_it_duplicated_changes(index):
+    index.ingest({"a": SHARED, "b": PAGE_B})
+    assert index.texts() == {SHARED, text(5)}
+
+    # "a" changes: its chunk, which "b"'s content relied on, is deleted.
+    stats = index.ingest({"a": text(2), "b": PAGE_B})
+    assert stats["invalidated"] == ["b"]
+
+    assert index.texts() == {text(2), text(5)}
+
+    stats = index.ingest({"a": text(2), "b": PAGE_B})
+    assert stats["sources_updated"] == 1
+    assert index.texts() == {text(2), text(5), SHARED_COPY}
+
+    stats = index.ingest({"a": text(2), "b": PAGE_B})
+    assert stats["sources_unchanged"] == 2
+    assert stats["invalidated"] == []
+
+
+def test_duplicate_comes_back_when_both_sources_change_in_one_run(index):
+    index.ingest({"b": text(3), "a": SHARED})
+
+    # "b" now duplicates "a"'s stored chunk, which the same run then replaces.
+    stats = index.ingest({"b": PAGE_B, "a": text(2)})
+    assert stats["invalidated"] == ["b"]
+
+    index.ingest({"b": PAGE_B, "a": text(2)})
+    assert index.texts() == {text(2), text(5), SHARED_COPY}
+
+
+def test_duplicate_stays_dropped_while_the_chunk_it_duplicates_is_indexed(index):
+    index.ingest({"a": SHARED, "b": PAGE_B})
+
+    stats = index.ingest({"a": SHARED, "b": PAGE_B, "c": text(4)})
+    assert stats["sources_unchanged"] == 2
+    assert stats["invalidated"] == []
+    assert index.texts() == {SHARED, text(5), text(4)}